@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import re
+import selectors
+import signal
+import socket
+import time
+
+# Size of the kernel receive buffer, so that bursts are not lost while logs are written
+RECEIVE_BUFFER = 1 << 22
+
+# Largest datagram that can be received
+MAX_DATAGRAM = 1 << 16
+
+# Period of writing the received lines out, in seconds
+FLUSH_INTERVAL = 1.0
+
+
+# Return a name that is safe to use in a file name
+def safe_name(name):
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+# Receives log lines that sessions started with -u send over UDP and writes
+# the lines of every host to its own session log, '{session}-{host}.txt'.
+# Hosts are told apart by the cookie given with -C, or by their address.
+class Collector:
+    def __init__(self, session, address):
+        host, port = address.rsplit(':', 1)
+        self.session = session
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
+        self.sock.bind((host, int(port)))
+        self.sock.setblocking(False)
+
+        self.files = {}
+        self.lines = 0
+        self.datagrams = 0
+        self.die = False
+
+    def kill_handler(self, *_):
+        self.die = True
+
+    # Return the log file of a given host, it is opened once
+    def file(self, host):
+        f = self.files.get(host)
+        if f is None:
+            path = f"{self.session}-{safe_name(host)}.txt"
+            f = self.files[host] = open(path, "a", buffering=1 << 16)
+            print(f"Receiving '{host}' to '{path}'", flush=True)
+        return f
+
+    # Write out the lines of a datagram, each of them can have a cookie
+    def dispatch(self, data, addr):
+        self.datagrams += 1
+        for line in data.decode("utf-8", errors="replace").splitlines():
+            host = addr[0]
+            if line.startswith("["):
+                cookie, found, rest = line[1:].partition("] ")
+                if found:
+                    host, line = cookie, rest
+            self.file(host).write(line + "\n")
+            self.lines += 1
+
+    # Read all the datagrams that are waiting
+    def receive(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.dispatch(data, addr)
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    # Receive until SIGINT or SIGTERM
+    def run(self):
+        signal.signal(signal.SIGTERM, self.kill_handler)
+        signal.signal(signal.SIGINT, self.kill_handler)
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        last_flush = time.monotonic()
+        while not self.die:
+            if selector.select(FLUSH_INTERVAL):
+                self.receive()
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                self.flush()
+                last_flush = time.monotonic()
+
+        selector.close()
+        self.sock.close()
+        for f in self.files.values():
+            f.close()
+        print(f"Received {self.lines} lines in {self.datagrams} datagrams from {len(self.files)} hosts")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import numpy as np
+
+# The default number of buckets, about one per horizontal pixel of a plot
+DEFAULT_RESOLUTION = 1200
+
+
+# Return the index of the equal-time bucket each sample falls into
+def bucket_index(times, buckets, start=None, end=None):
+    start = times[0] if start is None else start
+    end = times[-1] if end is None else end
+    span = max(end - start, 1e-9)
+    index = ((times - start) * (buckets / span)).astype(np.int64)
+    return np.clip(index, 0, buckets - 1)
+
+
+# Return the first sample of every non-empty bucket, `index` has to be sorted
+def bucket_starts(index):
+    return np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+
+
+# Reduce a (samples x columns) series to at most `buckets` equal-time buckets.
+# Return the bucket times (their middles) and per bucket min, max and mean of
+# every column, NaN values are skipped.
+def bucket_stats(times, values, buckets=DEFAULT_RESOLUTION, start=None, end=None):
+    values = np.asarray(values, dtype=np.float64)
+    if len(times) == 0:
+        empty = np.empty((0, values.shape[1]))
+        return np.empty(0), empty, empty, empty
+
+    start = times[0] if start is None else start
+    end = times[-1] if end is None else end
+    index = bucket_index(times, buckets, start, end)
+    starts = bucket_starts(index)
+
+    valid = ~np.isnan(values)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+
+    width = (end - start) / buckets
+    bucket_times = start + (index[starts] + 0.5) * width
+    return (
+        bucket_times,
+        np.fmin.reduceat(values, starts),
+        np.fmax.reduceat(values, starts),
+        mean
+    )
+
+
+# Reduce a (samples x columns) series to at most `buckets` equal-time buckets
+# by keeping, for every bucket, the whole row at which `key` is the highest.
+# Return the bucket times (their middles) and the kept rows, so that columns
+# that are drawn stacked still add up. NaN keys never win.
+def bucket_peaks(times, values, key, buckets=DEFAULT_RESOLUTION):
+    values = np.asarray(values, dtype=np.float64)
+    if len(times) == 0:
+        return np.empty(0), np.empty((0, values.shape[1]))
+
+    index = bucket_index(times, buckets)
+    starts = bucket_starts(index)
+    ends = np.r_[starts[1:], len(times)] - 1
+    by_key = np.lexsort((np.where(np.isnan(key), -np.inf, key), index))
+
+    width = max(times[-1] - times[0], 1e-9) / buckets
+    return times[0] + (index[starts] + 0.5) * width, values[by_key[ends]]
+
+
+# M4 reduction of a single series: keep the first, last, min and max sample of
+# every bucket, with their original timestamps. A line drawn through the result
+# looks the same as one drawn through all the samples.
+def m4(times, series, buckets=DEFAULT_RESOLUTION):
+    times = np.asarray(times)
+    series = np.asarray(series, dtype=np.float64)
+    if len(times) <= 4 * buckets:
+        return times, series
+
+    index = bucket_index(times, buckets)
+    starts = bucket_starts(index)
+    ends = np.r_[starts[1:], len(times)] - 1
+
+    # Sort samples by bucket, then by value, NaN values never win
+    by_min = np.lexsort((np.where(np.isnan(series), np.inf, series), index))
+    by_max = np.lexsort((np.where(np.isnan(series), -np.inf, series), index))
+
+    keep = np.unique(np.concatenate((starts, ends, by_min[starts], by_max[ends])))
+    return times[keep], series[keep]
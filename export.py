@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import csv
+import json
+import os
+
+import numpy as np
+
+from loader import SessionLog
+from segments import log_path, log_size
+
+# Tables of samples: table name, stream and columns. Times are epoch seconds,
+# like the time axes of the plots. The memory table starts with the RAM usage
+# that is plotted, computed from the free memory.
+TABLES = [
+    ("samples",  "sar", ["cpu_load_pct", "disk_used_pct", "received_mbps", "sent_mbps", "gpu_load_pct", "gpu_memory_used_pct"]),
+    ("memory",   "psu", ["ram_used_pct", "free_pct", "cached_pct", "used_pct", "shared_pct", "swap_used_pct", "dirty_pct", "writeback_pct", "slab_pct", "anonymous_pct"]),
+    ("pressure", "psi", ["cpu_some_pct", "cpu_full_pct", "memory_some_pct", "memory_full_pct", "io_some_pct", "io_full_pct",
+                         "cpu_some_stall_ms", "cpu_full_stall_ms", "memory_some_stall_ms", "memory_full_stall_ms", "io_some_stall_ms", "io_full_stall_ms"]),
+    ("disk_io",  "dio", ["read_mbytes_per_s", "written_mbytes_per_s", "reads_per_s", "writes_per_s", "wait_ms", "util_pct"]),
+    ("cpu_time", "cpu", ["user_pct", "nice_pct", "system_pct", "iowait_pct", "steal_pct", "idle_pct"]),
+    ("job",      "job", ["cpu_load_pct", "rss_mib", "read_mbytes_per_s", "written_mbytes_per_s", "context_switches_per_s"]),
+    ("overhead", "ovh", ["cpu_load_pct", "rss_mib", "latency_ms"]),
+]
+
+# Streams that have no table, with their description for the notice. The
+# first filesystem and interface are in the samples table.
+NOT_EXPORTED = {
+    "core": "per-core load",
+    "top": "top consumers",
+    "fs": "usage of every filesystem",
+    "net": "traffic of every network interface",
+}
+
+# Tables that are written even if the session has no rows for them
+REQUIRED = {"samples", "memory", "labels", "summary"}
+
+LABEL_COLUMNS = [("time", "float"), ("name", "str")]
+SUMMARY_COLUMNS = [("scope", "str"), ("name", "str"), ("key", "str"), ("value", "str"), ("number", "float")]
+
+
+# Return the file of a table, e.g. "out.parquet" -> "out-samples.parquet"
+def table_path(path, table):
+    base, ext = os.path.splitext(path)
+    return f"{base}-{table}{ext}"
+
+
+# Return the values of a column as Python objects, None where they are NaN
+def column_values(values):
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'f':
+        return [None if v != v else v for v in values.tolist()]
+    return list(values)
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in columns])
+
+    def write(self, columns):
+        rows = zip(*[column_values(values) for values in columns])
+        self.writer.writerows([["" if v is None else v for v in row] for row in rows])
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w")
+        self.names = [name for name, _ in columns]
+
+    def write(self, columns):
+        for row in zip(*[column_values(values) for values in columns]):
+            self.file.write(json.dumps(dict(zip(self.names, row))) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+# Writes Parquet or Arrow IPC files, it requires pyarrow
+class ArrowWriter:
+    def __init__(self, path, columns, parquet=False):
+        import pyarrow as pa
+        self.pa = pa
+        types = {"float": pa.float64(), "str": pa.string()}
+        self.schema = pa.schema([(name, types[kind]) for name, kind in columns])
+        if parquet:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, columns):
+        # NaN values become nulls, like in the other formats
+        arrays = [self.pa.array(values, type=field.type, from_pandas=True) for values, field in zip(columns, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+FORMATS = {
+    ".csv": CsvWriter,
+    ".jsonl": JsonLinesWriter,
+    ".parquet": lambda path, columns: ArrowWriter(path, columns, parquet=True),
+    ".arrow": ArrowWriter,
+}
+
+
+# Table written in chunks, the file is created with the first chunk
+class Table:
+    def __init__(self, path, name, columns):
+        self.path = table_path(path, name)
+        self.name = name
+        self.columns = columns
+        self.writer = None
+        self.rows = 0
+
+    def write(self, columns):
+        if self.writer is None:
+            self.writer = FORMATS[os.path.splitext(self.path)[1]](self.path, self.columns)
+        self.writer.write(columns)
+        self.rows += len(columns[0])
+
+    def close(self):
+        if self.writer is None and self.name in REQUIRED:
+            self.write([[] for _ in self.columns])
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Text log parser that writes the samples it reads to tables in chunks, so
+# that only a block of the log is kept in memory. Labels and the summary are
+# kept until the whole log is read.
+class ExportLog(SessionLog):
+    def __init__(self, session, path):
+        super().__init__(log_path(session))
+        self.tables = {}
+        self.skipped = set()
+        for name, kind, names in TABLES:
+            self.tables[kind] = (Table(path, name, [("time", "float")] + [(n, "float") for n in names]), len(names))
+
+    def parse(self, text):
+        super().parse(text)
+        for kind, stream in self.streams.items():
+            if kind not in self.tables:
+                self.skipped.add(kind)
+                continue
+            table, width = self.tables[kind]
+            times, values = stream.arrays()
+            if kind == "psu":
+                values = np.hstack((np.round(100 - values[:, :1], 2), values))
+            # Rows can have fewer columns, e.g. when there is no GPU
+            if values.shape[1] < width:
+                values = np.hstack((values, np.full((len(values), width - values.shape[1]), np.nan)))
+            table.write([times] + list(values[:, :width].T))
+        self.streams = {}
+
+
+# Return the rows of the summary table: scope, device or consumer name, key,
+# value and the value as a number where it is one
+def summary_rows(log):
+    rows = []
+    fields = [("session", "", log.summary)]
+    for scope, devices in log.devices.items():
+        fields.extend((scope, name, summary) for name, summary in devices.items())
+    for scope, name, summary in fields:
+        for key, value in summary.items():
+            if isinstance(value, list):
+                value = " ".join(value)
+            number = float(value) if isinstance(value, (int, float)) else np.nan
+            rows.append((scope, name, key, str(value), number))
+    return rows
+
+
+# Export the samples, labels and summary of a session to tables in a given
+# format, one file per table. Return the tables that were written.
+def export(session, path):
+    if os.path.splitext(path)[1] not in FORMATS:
+        raise ValueError(f"unknown export format of '{path}', use one of {', '.join(FORMATS)}")
+
+    # A running session is exported as it was at the start
+    log = ExportLog(session, path)
+    log.read(log_size(log.path))
+    if log.skipped:
+        skipped = [NOT_EXPORTED.get(kind, f"'{kind}' samples") for kind in sorted(log.skipped)]
+        print(f"Warning: session '{session}' has samples that are not exported: {', '.join(skipped)}")
+
+    labels = Table(path, "labels", LABEL_COLUMNS)
+    labels.write([np.array([t for t, _ in log.labels], dtype=np.float64), [name for _, name in log.labels]])
+    summary = Table(path, "summary", SUMMARY_COLUMNS)
+    rows = summary_rows(log)
+    summary.write([[row[i] for row in rows] for i in range(4)] + [np.array([row[4] for row in rows], dtype=np.float64)])
+
+    tables = [table for table, _ in log.tables.values()] + [labels, summary]
+    for table in tables:
+        table.close()
+    return [table for table in tables if table.writer is not None]
@@ -6,15 +6,23 @@
 #
 
 
-import datetime
+import glob
+import multiprocessing
 import os
 import socket
 import subprocess
 import time
 from common import *
 from pathlib import Path
+import shutil
 import tempfile
 
+import numpy as np
+
+import decimate
+from loader import bound_time, consumer_values, format_timestamp
+from store import load_session
+
 global gnuplot
 
 GNUPLOT_VERSION_EXPECTED = "5.0"
@@ -38,6 +46,7 @@ UNAME = "unknown"
 CPUS = 0
 CPU_NAME = "unknown"
 DURATION = 0.0
+MISSED_TICKS = 0
 
 GPU_NAME = None
 GPU_DRIVER = None
@@ -45,6 +54,67 @@ AVERAGE_GPU_LOAD = 0
 TOTAL_GPU_RAM = 0
 MAX_USED_GPU_RAM = 0
 
+# All observed filesystems and network interfaces if there were more of them,
+# and their summaries
+DISKS = []
+IFACES = []
+DEVICES = {}
+
+# Block device I/O of the observed filesystem, if it was recorded
+DISK_IO_PLOT = False
+NAME_IO = "unknown"
+MAX_IO_READ = 0.0
+MAX_IO_WRITTEN = 0.0
+AVERAGE_IO_WAIT = 0.0
+MAX_IO_WAIT = 0.0
+AVERAGE_IO_UTIL = 0.0
+
+# Per-core load and CPU time breakdown, if they were recorded
+CPU_DETAIL_PLOT = False
+CORES = 0
+AVERAGE_IOWAIT = 0.0
+
+# Processes or cgroups that used the most resources, if they were recorded
+TOP_PLOT = False
+CONSUMERS = "processes"
+
+# Number of consumers shown separately in the stacked plots, the rest is summed up
+TOP_SHOWN = 6
+LAYER_COLORS = ['#00af91', '#f15f32', '#f2c71b', '#ee7af0', '#5b9bd5', '#a5d86e', '#8d8a90']
+
+# Resources used by a command run in the session, if it was run with "run"
+JOB_PLOT = False
+JOB_COMMAND = "unknown"
+JOB_EXIT_CODE = None
+JOB_CPU_TIME = 0.0
+JOB_MAX_RSS = 0
+JOB_READ = 0
+JOB_WRITTEN = 0
+JOB_SWITCHES = 0
+
+# Parts of the RAM usage drawn over it as lines, if they were recorded:
+# column of the memory data, title and color
+MEMORY_DETAIL = False
+MEMORY_LAYERS = [
+    (10, "Anonymous", "#5b9bd5"),
+    (9, "Slab", "#a5d86e"),
+    (7, "Dirty", "#f15f32"),
+    (8, "Writeback", "#d83829"),
+    (6, "Swap used", "#ffffff"),
+]
+
+# Pressure stall information, if it was recorded
+PSI_PLOT = False
+CPU_STALL = 0.0
+MEMORY_STALL = 0.0
+IO_STALL = 0.0
+
+# Resources used by sargraph itself, if they were recorded
+OVERHEAD_PLOT = False
+WATCHER_LOAD = 0.0
+WATCHER_MAX_RSS = 0
+WATCHER_MAX_LATENCY = 0.0
+
 HOST = socket.gethostname()
 
 # The number of plots on the graph
@@ -65,36 +135,80 @@ if not is_version_ge(version, GNUPLOT_VERSION_EXPECTED):
     fail(
         f"gnuplot version too low. Need at least {GNUPLOT_VERSION_EXPECTED} found {version}")
 
-def split_data_file(session):
-    sar_data = []
-    psu_data = []
-
-    # Read the input file
-    with open(f"{session}.txt", 'r') as file:
-        in_summary = False
-        for line in file:
-            if line.startswith('#'):
-                sar_data.append(line.strip())
-            else:
-                if line.startswith('sar'):
-                    sar_data.append(line.split(' ', 1)[1].strip())
-                elif line.startswith('psu'):
-                    psu_data.append(line.split(' ', 1)[1].strip())
-
-    temp_dir = tempfile.mkdtemp()
-    with open(os.path.join(temp_dir, 'sar_data.txt'), 'w') as sar_data_file:
-        sar_data_file.write("\n".join(sar_data))
-        print(file=sar_data_file)
-
-    with open(os.path.join(temp_dir, 'psu_data.txt'), 'w') as psu_data_file:
-        psu_data_file.write("\n".join(psu_data))
-        print(file=psu_data_file)
-
-    # in order: sar file, mem file
-    return [
-        os.path.join(temp_dir, 'sar_data.txt'),
-        os.path.join(temp_dir, 'psu_data.txt')
-    ]
+# Write the parsed data streams to files that gnuplot can read. Series longer
+# than `resolution` are reduced to one sample per bucket with the bucket maximum,
+# which is what a box plot of all the samples shows anyway. The memory layers
+# are stacked, so the whole sample with the highest cached and used memory is
+# kept instead.
+def write_plot_data(log, temp_dir, resolution=decimate.DEFAULT_RESOLUTION):
+    files = []
+    for kind in ["sar", "psu", "ovh", "cpu", "dio", "fs", "net", "job", "psi"]:
+        path = os.path.join(temp_dir, f"{kind}_data.txt")
+        times, values = log.arrays(kind)
+        if resolution and len(times) > resolution and kind == "psu":
+            times, values = decimate.bucket_peaks(times, values, values[:, 1] + values[:, 2], resolution)
+        elif resolution and len(times) > resolution:
+            times, _, values, _ = decimate.bucket_stats(times, values, resolution)
+        np.savetxt(path, np.column_stack((times, values)), fmt="%.3f")
+        files.append(path)
+
+    # in order: sar file, mem file, overhead file, cpu time file, disk io file,
+    # filesystems file, network interfaces file, job file, pressure file
+    return files
+
+
+# Write per-core loads as "time core load" rows of a heatmap. Loads are averaged
+# over buckets, as a maximum would hide how much of the time a core was idle.
+# Return the file and the half width of a bucket.
+def write_core_data(log, temp_dir, resolution=decimate.DEFAULT_RESOLUTION):
+    path = os.path.join(temp_dir, "core_data.txt")
+    times, values = log.arrays("core")
+    if resolution and len(times) > resolution:
+        times, _, _, values = decimate.bucket_stats(times, values, resolution)
+    cores = values.shape[1]
+    np.savetxt(path, np.column_stack((
+        np.repeat(times, cores),
+        np.tile(np.arange(cores), len(times)),
+        values.ravel()
+    )), fmt="%.3f")
+    halfwidth = (times[-1] - times[0]) / max(len(times) - 1, 1) / 2 if len(times) else 0.5
+    return path, halfwidth
+
+
+# Return the columns of up to TOP_SHOWN consumers with the highest peaks
+def top_columns(values):
+    if len(values) == 0:
+        return []
+    peaks = values.max(axis=0)
+    return [c for c in np.argsort(-peaks, kind="stable")[:TOP_SHOWN] if peaks[c] > 0]
+
+
+# Write a given column of the "top" lines as running sums over the consumers
+# with the highest peaks and then all the others. Return the file, the names
+# of the layers and the peak of their sum.
+def write_consumer_data(log, temp_dir, column, resolution=decimate.DEFAULT_RESOLUTION):
+    path = os.path.join(temp_dir, f"top{column}_data.txt")
+    times, values = consumer_values(log, column)
+    shown = top_columns(values)
+    stacked = np.cumsum(np.column_stack(
+        [values[:, c] for c in shown] + [values.sum(axis=1) - values[:, shown].sum(axis=1)]
+    ), axis=1)
+    peak = stacked[:, -1].max() if len(times) else 0.0
+    if resolution and len(times) > resolution:
+        times, _, stacked, _ = decimate.bucket_stats(times, stacked, resolution)
+    np.savetxt(path, np.column_stack((times, stacked)), fmt="%.3f")
+    names = [log.consumers.get(c, f"#{c}") for c in shown] + ["other"]
+    return path, names, peak
+
+
+# Return the name and the values of the consumer with the highest peak of a
+# given column of the "top" lines
+def largest_consumer(log, column):
+    times, values = consumer_values(log, column)
+    shown = top_columns(values)
+    if not shown:
+        return "none", times, np.zeros(len(times))
+    return log.consumers.get(shown[0], f"#{shown[0]}"), times, values[:, shown[0]]
 
 
 # Run a command in a running gnuplot process
@@ -140,14 +254,14 @@ def plot(ylabel, title, sar_file, column, space=3, autoscale=None):
     g(f"set title \"{{/:Bold {title}}}" + ("\\n" * space) + "\"")
     g(f"plot '{sar_file}' using 1:{column}:{column} title 'cpu' with boxes palette")
 
-def plot_stacked(ylabel, title, ram_file, column, tmpfs_color, other_cache_color, space=3, autoscale=None):
+def plot_stacked(ylabel, title, ram_file, column, tmpfs_color, other_cache_color, space=3, autoscale=None, detail=False):
     if autoscale is None:
         g("set yrange [0:100]")
         g("set cbrange [0:100]")
     else:
         g("unset xdata")
         g("set yrange [0:*]")
-        g(f"stats '{ram_data}' using {column}")
+        g(f"stats '{ram_file}' using {column}")
         g(f"set yrange [0:STATS_max*{autoscale}]")
         g(f"set cbrange [0:STATS_max*{autoscale}]")
         g("set xdata time")
@@ -161,11 +275,59 @@ def plot_stacked(ylabel, title, ram_file, column, tmpfs_color, other_cache_color
     else:
         g(f"plot '{ram_file}' using 1:($3 + ${column}):{column} title 'RAM' with boxes palette, \
         '' using 1:5 with boxes title 'Shared mem' lc rgb '{tmpfs_color}', \
-        '' using 1:($3 - $5) with boxes title 'Other cache (freed automatically)' lc rgb '{other_cache_color}'")
+        '' using 1:($3 - $5) with boxes title 'Other cache (freed automatically)' lc rgb '{other_cache_color}'"
+        + ("".join(
+            f", '' using 1:{layer} with lines title '{name}' lw 2 lc rgb '{color}'"
+            for layer, name, color in MEMORY_LAYERS
+        ) if detail else ""))
+    g('unset key')
+
+# Plot a few columns of values as lines, `series` are (column, title) pairs
+def plot_lines(ylabel, title, data_file, series, space=3, yrange="[0:100]"):
+    g(f"set yrange {yrange}")
+    g(f"set ylabel '{ylabel}'")
+    g(f"set title \"{{/:Bold {title}}}" + ("\\n" * space) + "\"")
+    g('set key reverse below Left width -25')
+    g("plot " + ", ".join(
+        f"'{data_file if i == 0 else ''}' using 1:{column} with lines title '{name}' lw 2"
+        for i, (column, name) in enumerate(series)
+    ))
     g('unset key')
 
-# Read additional information from 'data.txt' comments
-def read_comments(sar_file):
+# Plot layers stacked on each other, the columns of the file are their running sums
+def plot_layers(ylabel, title, data_file, names, space=3, yrange="[0:*]"):
+    g(f"set yrange {yrange}")
+    g(f"set ylabel '{ylabel}'")
+    g(f"set title \"{{/:Bold {title}}}" + ("\\n" * space) + "\"")
+    g('set key reverse below Left width -25')
+    # The highest sum is drawn first, every following layer covers a part of
+    # it. The last layer holds the rest and is always grey.
+    colors = LAYER_COLORS[:len(names) - 1] + LAYER_COLORS[-1:]
+    layers = [(i, name.replace("'", ""), color) for i, (name, color) in enumerate(zip(names, colors))]
+    g("plot " + ", ".join(
+        f"'{data_file if i == len(names) - 1 else ''}' using 1:{i + 2} with boxes title '{name}' noenhanced lc rgb '{color}'"
+        for i, name, color in reversed(layers)
+    ))
+    g('unset key')
+
+# Plot the load of every core over time as a heatmap
+def plot_heatmap(ylabel, title, core_file, halfwidth, cores, space=3):
+    g(f"set yrange [-0.5:{cores - 0.5}]")
+    g("set cbrange [0:100]")
+    g(f"set ylabel '{ylabel}'")
+    g(f"set title \"{{/:Bold {title}}}" + ("\\n" * space) + "\"")
+    g(f"plot '{core_file}' using 1:2:({halfwidth}):(0.5):3 with boxxyerror fs solid noborder palette")
+
+# Return "name = value" of a summary field of every observed device of a kind
+def device_values(kind, names, key, units):
+    values = []
+    for name in names:
+        value = DEVICES.get(kind, {}).get(name, {}).get(key, 0)
+        values.append(f"{name} = {unit_str(value, units)}")
+    return ", ".join(values)
+
+# Read additional information from the session log comments
+def read_comments(log):
     global START_DATE
     global END_DATE
     global AVERAGE_LOAD
@@ -178,6 +340,7 @@ def read_comments(sar_file):
     global CPUS
     global CPU_NAME
     global DURATION
+    global MISSED_TICKS
     global MAX_RX
     global MAX_TX
     global TOTAL_RX
@@ -188,118 +351,91 @@ def read_comments(sar_file):
     global AVERAGE_GPU_LOAD
     global TOTAL_GPU_RAM
     global MAX_USED_GPU_RAM
+    global DISKS
+    global IFACES
+    global DEVICES
+    global DISK_IO_PLOT
+    global NAME_IO
+    global MAX_IO_READ
+    global MAX_IO_WRITTEN
+    global AVERAGE_IO_WAIT
+    global MAX_IO_WAIT
+    global AVERAGE_IO_UTIL
+    global CPU_DETAIL_PLOT
+    global CORES
+    global AVERAGE_IOWAIT
+    global TOP_PLOT
+    global CONSUMERS
+    global JOB_PLOT
+    global JOB_COMMAND
+    global JOB_EXIT_CODE
+    global JOB_CPU_TIME
+    global JOB_MAX_RSS
+    global JOB_READ
+    global JOB_WRITTEN
+    global JOB_SWITCHES
+    global MEMORY_DETAIL
+    global PSI_PLOT
+    global CPU_STALL
+    global MEMORY_STALL
+    global IO_STALL
+    global OVERHEAD_PLOT
+    global WATCHER_LOAD
+    global WATCHER_MAX_RSS
+    global WATCHER_MAX_LATENCY
     global NUMBER_OF_PLOTS
 
-    data_version = None
-
-    with open(sar_file, "r") as f:
-        for line in f:
-            value = None
-
-            if len(line) <= 0:
-                continue
-
-            if line[0] != '#':
-                if not START_DATE:
-                    START_DATE = scan("^(\\S+)", str, line)
-                END_DATE = scan("^(\\S+)", str, line)
-
-            value = scan("label: (.+)", str, line)
-            if value is not None:
-                key = scan("(\\S+) label:", str, line)
-                labels.append([key, value])
-
-                # Comments are not mixed with anything else, so skip
-                continue
-
-            # Override summary variables. If they're missing, their default values are kept
-            value = scan("sargraph version: (\\d+\\.\\d+)", str, line)
-            if value is not None:
-                data_version = value
-
-            value = scan("psutil version: (\\d+\\.\\d+)", str, line)
-            if value is not None:
-                data_version = value
-
-            value = scan("machine: ([^,]+)", str, line)
-            if value is not None:
-                UNAME = value
-
-            value = scan("cpu count: ([^,]+)", int, line)
-            if value is not None:
-                CPUS = value
-
-            value = scan("cpu: ([^,\n]+)", str, line)
-            if value is not None:
-                CPU_NAME = value
-
-            value = scan("observed disk: ([^,]+)", str, line)
-            if value is not None:
-                NAME_FS = value
-
-            value = scan("observed network: ([^,]+)", str, line)
-            if value is not None:
-                NAME_IFACE = value
-
-            value = scan("total ram: (\\S+)", stof, line)
-            if value is not None:
-                TOTAL_RAM = value
-
-            value = scan("max ram used: (\\S+)", stof, line)
-            if value is not None:
-                MAX_USED_RAM = value
-
-            value = scan("total disk space: (\\S+)", stof, line)
-            if value is not None:
-                TOTAL_FS = value
-
-            value = scan("max received: (\\S+)", stof, line)
-            if value is not None:
-                MAX_RX = value
-
-            value = scan("max sent: (\\S+)", stof, line)
-            if value is not None:
-                MAX_TX = value
-
-            value = scan("total received: (\\S+)", stof, line)
-            if value is not None:
-                TOTAL_RX = value
-
-            value = scan("total sent: (\\S+)", stof, line)
-            if value is not None:
-                TOTAL_TX = value
-
-            value = scan("duration: (\\S+)", stof, line)
-            if value is not None:
-                DURATION = value
-
-            value = scan("max disk used: (\\S+)", stof, line)
-            if value is not None:
-                MAX_USED_FS = value
-
-            value = scan("average load: (\\S+)", stof, line)
-            if value is not None:
-                AVERAGE_LOAD = value
-
-            value = scan("total gpu ram: (\\S+)", stof, line)
-            if value is not None:
-                TOTAL_GPU_RAM = value
-
-            value = scan("max gpu ram used: (\\S+)", stof, line)
-            if value is not None:
-                MAX_USED_GPU_RAM = value
-
-            value = scan("gpu: ([^,\n]+)", str, line)
-            if value is not None:
-                GPU_NAME = value
-
-            value = scan("gpu driver: ([^,\n]+)", str, line)
-            if value is not None:
-                GPU_DRIVER = value
-
-            value = scan("average gpu load: (\\S+)", stof, line)
-            if value is not None:
-                AVERAGE_GPU_LOAD = value
+    labels.extend(log.labels)
+
+    sar_time, _ = log.arrays("sar")
+    if len(sar_time) > 0:
+        START_DATE = format_timestamp(sar_time[0])
+        END_DATE = format_timestamp(sar_time[-1])
+
+    # Override summary variables. If they're missing, their default values are used
+    summary = log.summary
+    data_version = summary.get("sargraph version", summary.get("psutil version"))
+
+    UNAME = summary.get("machine", "unknown")
+    CPUS = summary.get("cpu count", 0)
+    CPU_NAME = summary.get("cpu", "unknown")
+    NAME_FS = summary.get("observed disk", "unknown")
+    NAME_IFACE = summary.get("observed network", "unknown")
+    TOTAL_RAM = summary.get("total ram", 0)
+    MAX_USED_RAM = summary.get("max ram used", 0)
+    TOTAL_FS = summary.get("total disk space", 0)
+    MAX_USED_FS = summary.get("max disk used", 0)
+    MAX_RX = summary.get("max received", 0)
+    MAX_TX = summary.get("max sent", 0)
+    TOTAL_RX = summary.get("total received", 0)
+    TOTAL_TX = summary.get("total sent", 0)
+    DURATION = summary.get("duration", 0.0)
+    MISSED_TICKS = summary.get("missed ticks", 0)
+    AVERAGE_LOAD = summary.get("average load", 0.0)
+    GPU_NAME = summary.get("gpu")
+    GPU_DRIVER = summary.get("gpu driver")
+    TOTAL_GPU_RAM = summary.get("total gpu ram", 0)
+    MAX_USED_GPU_RAM = summary.get("max gpu ram used", 0)
+    AVERAGE_GPU_LOAD = summary.get("average gpu load", 0)
+    NAME_IO = summary.get("io device", "unknown")
+    MAX_IO_READ = summary.get("max io read", 0.0)
+    MAX_IO_WRITTEN = summary.get("max io written", 0.0)
+    AVERAGE_IO_WAIT = summary.get("average io wait", 0.0)
+    MAX_IO_WAIT = summary.get("max io wait", 0.0)
+    AVERAGE_IO_UTIL = summary.get("average io util", 0.0)
+    WATCHER_LOAD = summary.get("watcher load", 0.0)
+    WATCHER_MAX_RSS = summary.get("watcher max rss", 0)
+    WATCHER_MAX_LATENCY = summary.get("watcher max latency", 0.0)
+    JOB_COMMAND = summary.get("job command", "unknown")
+    JOB_EXIT_CODE = summary.get("job exit code")
+    JOB_CPU_TIME = summary.get("job cpu time", 0.0)
+    JOB_MAX_RSS = summary.get("job max rss", 0)
+    JOB_READ = summary.get("job read", 0)
+    JOB_WRITTEN = summary.get("job written", 0)
+    JOB_SWITCHES = summary.get("job context switches", 0)
+    CPU_STALL = summary.get("cpu stall", 0.0)
+    MEMORY_STALL = summary.get("memory stall", 0.0)
+    IO_STALL = summary.get("io stall", 0.0)
 
     if data_version != scan("^(\\d+\\.\\d+)", str, SARGRAPH_VERSION):
         print("Warning: the data comes from an incompatible version of sargraph")
@@ -317,6 +453,16 @@ def read_comments(sar_file):
     TOTAL_RX = unit_str(TOTAL_RX, DATA_UNITS)
     TOTAL_TX = unit_str(TOTAL_TX, DATA_UNITS)
 
+    WATCHER_MAX_RSS = unit_str(WATCHER_MAX_RSS, DATA_UNITS)
+
+    JOB_MAX_RSS = unit_str(JOB_MAX_RSS, DATA_UNITS)
+    JOB_READ = unit_str(JOB_READ, DATA_UNITS)
+    JOB_WRITTEN = unit_str(JOB_WRITTEN, DATA_UNITS)
+    # Long command lines do not fit in plot titles
+    if len(JOB_COMMAND) > 40:
+        JOB_COMMAND = JOB_COMMAND[:37] + "..."
+
+    NUMBER_OF_PLOTS = 5
     if TOTAL_GPU_RAM:
         TOTAL_GPU_RAM = unit_str(TOTAL_GPU_RAM, DATA_UNITS)
         # Add GPU RAM utilization and GPU utilization plots
@@ -324,73 +470,87 @@ def read_comments(sar_file):
     if MAX_USED_GPU_RAM:
         MAX_USED_GPU_RAM = unit_str(MAX_USED_GPU_RAM, DATA_UNITS)
 
-    DURATION = unit_str(DURATION, TIME_UNITS, 60)
+    # Swap, dirty, writeback, slab and anonymous memory are drawn over the
+    # RAM usage if they were recorded
+    _, psu_values = log.arrays("psu")
+    MEMORY_DETAIL = psu_values.shape[1] > 4 and not np.all(np.isnan(psu_values[:, 4:]))
 
+    # Add the pressure stall plot under the RAM usage if it was recorded
+    PSI_PLOT = len(log.arrays("psi")[0]) > 0
+    if PSI_PLOT:
+        NUMBER_OF_PLOTS += 1
 
-def graph(session, tmpfs_color, other_cache_color, fname='plot'):
-    global OUTPUT_TYPE
-    global OUTPUT_EXT
+    # More observed devices are overlaid on the filesystem and network plots
+    DISKS = summary.get("observed disks", []) if len(log.arrays("fs")[0]) else []
+    IFACES = summary.get("observed networks", []) if len(log.arrays("net")[0]) else []
+    DEVICES = log.devices
 
-    global labels
+    # Add disk throughput and utilization plots if they were recorded
+    DISK_IO_PLOT = len(log.arrays("dio")[0]) > 0
+    if DISK_IO_PLOT:
+        NUMBER_OF_PLOTS += 2
 
-    global gnuplot
+    # Add per-core load and CPU time breakdown plots if they were recorded
+    core_time, core_values = log.arrays("core")
+    CPU_DETAIL_PLOT = len(core_time) > 0
+    if CPU_DETAIL_PLOT:
+        CORES = core_values.shape[1]
+        _, cpu_values = log.arrays("cpu")
+        AVERAGE_IOWAIT = float(np.nanmean(cpu_values[:, 3])) if len(cpu_values) else 0.0
+        NUMBER_OF_PLOTS += 2
 
-    labels = []
+    # Add the plots of processes or cgroups that used the most resources
+    TOP_PLOT = len(log.arrays("top")[0]) > 0
+    if TOP_PLOT:
+        CONSUMERS = summary.get("consumers", "processes")
+        NUMBER_OF_PLOTS += 2
+
+    # Add the plots of the command run in the session
+    JOB_PLOT = len(log.arrays("job")[0]) > 0
+    if JOB_PLOT:
+        NUMBER_OF_PLOTS += 3
+
+    # Add the sargraph overhead plot if it was recorded
+    OVERHEAD_PLOT = len(log.arrays("ovh")[0]) > 0
+    if OVERHEAD_PLOT:
+        NUMBER_OF_PLOTS += 1
 
-    # The default format
-    OUTPUT_TYPE = "pngcairo"
-    OUTPUT_EXT = "png"
+    DURATION = unit_str(DURATION, TIME_UNITS, 60)
+
+
+# Return the gnuplot terminal type and the file extension for a given output name
+def output_format(fname):
     if "SARGRAPH_OUTPUT_TYPE" in os.environ:
         otype = os.environ["SARGRAPH_OUTPUT_TYPE"].lower()
 
         # png is the default, so don't change anything
         if otype != "png":
-            OUTPUT_TYPE = otype
-            OUTPUT_EXT = otype
-    elif fname.lower().endswith('.png'):
-        # png is the default, so don't change anything
-        pass
+            return otype, otype
     elif fname.lower().endswith('.svg'):
-        OUTPUT_TYPE = "svg"
-        OUTPUT_EXT = "svg"
+        return "svg", "svg"
     elif fname.lower().endswith('.ascii'):
-        OUTPUT_TYPE = "ascii"
-        OUTPUT_EXT = "ascii"
+        return "ascii", "ascii"
     elif fname.lower().endswith('.html'):
-        OUTPUT_TYPE = "html"
-        OUTPUT_EXT = "html"
-    else:
-        pass
-        # fail("unknown graph extension")
+        return "html", "html"
 
-    # Leave just the base name
-    fname = cut_suffix(fname, f".{OUTPUT_EXT}")
-    sar_file, ram_file = split_data_file(session)
+    # png is the default
+    return "pngcairo", "png"
 
-    # ASCII plots have their own routine
-    if OUTPUT_TYPE == "ascii":
-        return servis_graph(sar_file, ram_file, fname)
 
-    # HTML plots have their own routine
-    if OUTPUT_TYPE == "html":
-        return servis_graph(sar_file, ram_file, fname, "html")
+# Return the name of the file a plot with a given output name is saved to
+def output_path(fname='plot'):
+    _, ext = output_format(fname)
+    return f"{cut_suffix(fname, f'.{ext}')}.{ext}"
 
-    read_comments(sar_file)
+
+# Start gnuplot with the style shared by all plots, writing to a given file
+def start_gnuplot(fname, height=1600):
+    global gnuplot
 
     gnuplot = run_or_fail("gnuplot", stdin=subprocess.PIPE,
                           stdout=subprocess.PIPE)
 
-    sdt = datetime.datetime.strptime(START_DATE, '%Y-%m-%d-%H:%M:%S')
-    edt = datetime.datetime.strptime(END_DATE, '%Y-%m-%d-%H:%M:%S')
-
-    seconds_between = (edt - sdt).total_seconds()
-    if seconds_between < 100:
-        seconds_between = 100
-
-    nsdt = sdt - datetime.timedelta(seconds=(seconds_between * 0.01))
-    nedt = edt + datetime.timedelta(seconds=(seconds_between * 0.01))
-
-    g(f"set terminal {OUTPUT_TYPE} size 1200,1600 background '#332d37' font 'monospace,{fix_size(8)}'")
+    g(f"set terminal {OUTPUT_TYPE} size 1200,{height} background '#332d37' font 'monospace,{fix_size(8)}'")
 
     g(f"set ylabel tc rgb 'white' font 'monospace,{fix_size(8)}'")
 
@@ -400,7 +560,6 @@ def graph(session, tmpfs_color, other_cache_color, fname='plot'):
     g("set xdata time")
     g("set border lc rgb 'white'")
     g("set key tc rgb 'white'")
-    g("set timefmt '%Y-%m-%d-%H:%M:%S'")
     g("set xtics format '%H:%M:%S'")
     g(f"set xtics font 'monospace,{fix_size(8)}' tc rgb 'white'")
     g(f"set ytics font 'monospace,{fix_size(8)}' tc rgb 'white'")
@@ -413,6 +572,59 @@ def graph(session, tmpfs_color, other_cache_color, fname='plot'):
 
     g(f"set output '{fname}.{OUTPUT_EXT}'")
 
+
+def graph(session, tmpfs_color, other_cache_color, fname='plot', snapshot=None, resolution=decimate.DEFAULT_RESOLUTION, window=None):
+    global OUTPUT_TYPE
+    global OUTPUT_EXT
+
+    global labels
+
+    global gnuplot
+
+    labels = []
+
+    OUTPUT_TYPE, OUTPUT_EXT = output_format(fname)
+
+    # Leave just the base name
+    fname = cut_suffix(fname, f".{OUTPUT_EXT}")
+    log = load_session(session, snapshot, window)
+    if window is not None and not len(log.arrays("sar")[0]):
+        fail("There are no samples in the chosen time window")
+    read_comments(log)
+
+    # ASCII plots have their own routine
+    if OUTPUT_TYPE == "ascii":
+        return servis_graph(log, fname, resolution=resolution)
+
+    # HTML plots have their own routine
+    if OUTPUT_TYPE == "html":
+        return servis_graph(log, fname, "html", resolution)
+
+    # Removed once gnuplot is done with it, also if plotting fails
+    temp_dir = tempfile.mkdtemp(prefix="sargraph-")
+    try:
+        plot_session(log, fname, tmpfs_color, other_cache_color, temp_dir, resolution)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+# Plot a session with gnuplot, the plotted data is written to `temp_dir`
+def plot_session(log, fname, tmpfs_color, other_cache_color, temp_dir, resolution):
+    sar_file, ram_file, ovh_file, cpu_file, dio_file, fs_file, net_file, job_file, psi_file = write_plot_data(log, temp_dir, resolution)
+
+    sar_time, _ = log.arrays("sar")
+    sdt = sar_time[0]
+    edt = sar_time[-1]
+
+    seconds_between = edt - sdt
+    if seconds_between < 100:
+        seconds_between = 100
+
+    nsdt = sdt - seconds_between * 0.01
+    nedt = edt + seconds_between * 0.01
+
+    start_gnuplot(fname)
+
     title_machine = f"Running on {{/:Bold {HOST}}} \\@ {{/:Bold {UNAME}}}, {{/:Bold {CPUS}}} threads x {{/:Bold {CPU_NAME}}}"
     title_specs = f"Total ram: {{/:Bold {TOTAL_RAM}}}, Total disk space: {{/:Bold {TOTAL_FS}}}"
     if TOTAL_GPU_RAM != 0:
@@ -420,12 +632,14 @@ def graph(session, tmpfs_color, other_cache_color, fname='plot'):
     else:
         title_gpu = ""
     title_times = f"Duration: {{/:Bold {START_DATE}}} .. {{/:Bold {END_DATE}}} ({DURATION})"
+    if MISSED_TICKS:
+        title_times += f", missed samples: {{/:Bold {MISSED_TICKS}}}"
 
     g(f"set multiplot layout {NUMBER_OF_PLOTS},1 title \"\\n{title_machine}\\n{title_specs}{title_gpu}\\n{title_times}\" offset screen -0.475, 0 left tc rgb 'white'")
 
     g(f"set title tc rgb 'white' font 'monospace,{fix_size(11)}'")
 
-    g(f"set xrange ['{nsdt.strftime('%Y-%m-%d-%H:%M:%S')}':'{nedt.strftime('%Y-%m-%d-%H:%M:%S')}']")
+    g(f"set xrange ['{nsdt:.3f}':'{nedt:.3f}']")
 
     i = 0
     for label in labels:
@@ -442,16 +656,16 @@ def graph(session, tmpfs_color, other_cache_color, fname='plot'):
             length *= 0.75
 
         # Draw the dotted line
-        g(f"set arrow nohead from '{label[0]}', graph 0.01 to '{label[0]}', graph {offset-0.04} front lc rgb '#e74a3c' dt 2")
+        g(f"set arrow nohead from '{label[0]:.3f}', graph 0.01 to '{label[0]:.3f}', graph {offset-0.04} front lc rgb '#e74a3c' dt 2")
 
         # Draw the small rectangle at its bottom
-        g(f"set object rect at '{label[0]}', graph 0.0 size char 0.5, char 0.5 front lc rgb '#d83829' fc rgb '#f15f32'")
+        g(f"set object rect at '{label[0]:.3f}', graph 0.0 size char 0.5, char 0.5 front lc rgb '#d83829' fc rgb '#f15f32'")
 
         # Draw the label rectangle
-        g(f"set object rect at '{label[0]}', graph {offset} size char {length}, char 1.3 fs border lc rgb '#d83829' fc rgb '#f15f32'")
+        g(f"set object rect at '{label[0]:.3f}', graph {offset} size char {length}, char 1.3 fs border lc rgb '#d83829' fc rgb '#f15f32'")
 
         # Add text to the label
-        g(f"set label at '{label[0]}', graph {offset} '{content}' center tc rgb 'white' font 'monospace,{fix_size(7)}'")
+        g(f"set label at '{label[0]:.3f}', graph {offset} '{content}' center tc rgb 'white' font 'monospace,{fix_size(7)}'")
 
     if i <= 0:
         space = 1
@@ -466,16 +680,33 @@ def graph(session, tmpfs_color, other_cache_color, fname='plot'):
     plot("CPU load (%)",
          f"CPU load (average = {AVERAGE_LOAD:.2f} %)", sar_file, 2, space=space)
     plot_stacked(f"RAM usage (100% = {TOTAL_RAM})",
-         f"RAM usage (max = {MAX_USED_RAM})", ram_file, 4, tmpfs_color, other_cache_color, space=space)
-    plot(f"FS usage (100% = {TOTAL_FS})", f"{NAME_FS} usage (max = {MAX_USED_FS})",
-         sar_file, 3, space=space)
-
-    plot(f"{NAME_IFACE} received (Mb/s)",
-         f"{NAME_IFACE} data received (max = {MAX_RX}, total = {TOTAL_RX})",
-         sar_file, 4, space=space, autoscale=1.2)
-    plot(f"{NAME_IFACE} sent (Mb/s)",
-         f"{NAME_IFACE} data sent (max = {MAX_TX}, total = {TOTAL_TX})",
-         sar_file, 5, space=space, autoscale=1.2)
+         f"RAM usage (max = {MAX_USED_RAM})", ram_file, 4, tmpfs_color, other_cache_color, space=space, detail=MEMORY_DETAIL)
+    if PSI_PLOT:
+        plot_lines("Stalled (%, avg10)",
+             f"Pressure stalls (cpu = {CPU_STALL:.2f} s, memory = {MEMORY_STALL:.2f} s, io = {IO_STALL:.2f} s)",
+             psi_file, [(2, "cpu"), (4, "memory"), (5, "memory full"), (6, "io"), (7, "io full")], space=space, yrange="[0:*]")
+    if len(DISKS) > 1:
+        plot_lines("FS usage (%)",
+             f"Filesystem usage (max used: {device_values('disk', DISKS, 'max disk used', DATA_UNITS)})",
+             fs_file, [(i + 2, name) for i, name in enumerate(DISKS)], space=space)
+    else:
+        plot(f"FS usage (100% = {TOTAL_FS})", f"{NAME_FS} usage (max = {MAX_USED_FS})",
+             sar_file, 3, space=space)
+
+    if len(IFACES) > 1:
+        plot_lines("Received (Mb/s)",
+             f"Data received (max: {device_values('network', IFACES, 'max received', SPEED_UNITS)})",
+             net_file, [(2 * i + 2, name) for i, name in enumerate(IFACES)], space=space, yrange="[0:*]")
+        plot_lines("Sent (Mb/s)",
+             f"Data sent (max: {device_values('network', IFACES, 'max sent', SPEED_UNITS)})",
+             net_file, [(2 * i + 3, name) for i, name in enumerate(IFACES)], space=space, yrange="[0:*]")
+    else:
+        plot(f"{NAME_IFACE} received (Mb/s)",
+             f"{NAME_IFACE} data received (max = {MAX_RX}, total = {TOTAL_RX})",
+             sar_file, 4, space=space, autoscale=1.2)
+        plot(f"{NAME_IFACE} sent (Mb/s)",
+             f"{NAME_IFACE} data sent (max = {MAX_TX}, total = {TOTAL_TX})",
+             sar_file, 5, space=space, autoscale=1.2)
 
     # GPU params
     if TOTAL_GPU_RAM != 0:
@@ -484,55 +715,364 @@ def graph(session, tmpfs_color, other_cache_color, fname='plot'):
         plot(f"GPU RAM usage (100% = {TOTAL_GPU_RAM})",
              f"GPU RAM usage (max = {MAX_USED_GPU_RAM})", sar_file, 7, space=space)
 
+    if DISK_IO_PLOT:
+        plot_lines(f"{NAME_IO} I/O (MB/s)",
+             f"{NAME_IO} I/O (max read = {MAX_IO_READ:.2f} MB/s, max written = {MAX_IO_WRITTEN:.2f} MB/s)",
+             dio_file, [(2, "read"), (3, "written")], space=space, yrange="[0:*]")
+        plot(f"{NAME_IO} utilization (%)",
+             f"{NAME_IO} utilization (average = {AVERAGE_IO_UTIL:.2f} %, average wait = {AVERAGE_IO_WAIT:.2f} ms, max wait = {MAX_IO_WAIT:.2f} ms)",
+             dio_file, 7, space=space)
+
+    if CPU_DETAIL_PLOT:
+        plot_lines("CPU time (%)",
+             f"CPU time breakdown (average iowait = {AVERAGE_IOWAIT:.2f} %)",
+             cpu_file, [(2, "user"), (4, "system"), (5, "iowait"), (6, "steal")], space=space)
+        core_file, halfwidth = write_core_data(log, temp_dir, resolution)
+        plot_heatmap("Core", f"Load of every core ({CORES} cores)",
+             core_file, halfwidth, CORES, space=space)
+
+    if TOP_PLOT:
+        top_file, names, peak = write_consumer_data(log, temp_dir, 2, resolution)
+        plot_layers("RSS (MB)", f"Memory used by {CONSUMERS} (max of the top ones = {unit_str(peak * 1024 * 1024, DATA_UNITS)})",
+             top_file, names, space=space)
+        top_file, names, peak = write_consumer_data(log, temp_dir, 1, resolution)
+        plot_layers("CPU load (%)", f"CPU load of {CONSUMERS} (max of the top ones = {peak:.2f} %)",
+             top_file, names, space=space, yrange="[0:100]")
+
+    if JOB_PLOT:
+        plot("Command CPU load (%)",
+             f"{JOB_COMMAND} CPU load (cpu time = {JOB_CPU_TIME:.2f} s, exit code = {JOB_EXIT_CODE})",
+             job_file, 2, space=space)
+        plot("Command RSS (MB)", f"{JOB_COMMAND} memory usage (max = {JOB_MAX_RSS})",
+             job_file, 3, space=space, autoscale=1.2)
+        plot_lines("Command I/O (MB/s)",
+             f"{JOB_COMMAND} I/O (read = {JOB_READ}, written = {JOB_WRITTEN}, context switches = {JOB_SWITCHES:.0f})",
+             job_file, [(4, "read"), (5, "written")], space=space, yrange="[0:*]")
+
+    if OVERHEAD_PLOT:
+        plot("sargraph CPU load (%)",
+             f"sargraph overhead (average load = {WATCHER_LOAD:.2f} %, max RSS = {WATCHER_MAX_RSS}, max tick = {WATCHER_MAX_LATENCY:.3f} ms)",
+             ovh_file, 2, space=space, autoscale=1.2)
+
     g("unset multiplot")
     g("unset output")
     g("quit")
 
 
-def read_data(sar_file, ram_file):
-    xdata = list()
-    xdata_ram = list()
-    ydata = [[] for _ in range(NUMBER_OF_PLOTS)]
-    with open(sar_file, "r") as f:
-        for line in f:
-            if(line[0] != '#'):
-                line = line.split(" ")
-                date = datetime.datetime.strptime(line[0], '%Y-%m-%d-%H:%M:%S')
-                xdata.append(date)
-                for i in range(NUMBER_OF_PLOTS):
-                    if i != RAM_DATA_POSITION:
-                        ydata[i].append(stof(line[i+1 - int(i > RAM_DATA_POSITION)]))
-    with open(ram_file, 'r') as f:
-        for line in f:
-            if(line[0] != '#'):
-                line = line.split(" ")
-                date = datetime.datetime.strptime(line[0], '%Y-%m-%d-%H:%M:%S.%f')
-                xdata_ram.append(date)
-                ydata[RAM_DATA_POSITION].append(100-stof(line[1]))
-
-    return (xdata, xdata_ram, ydata)
+# Plot series from several files as lines, `series` are (file, column, title)
+def plot_files(ylabel, title, series, space=3, yrange="[0:100]"):
+    g(f"set yrange {yrange}")
+    g(f"set ylabel '{ylabel}'")
+    g(f"set title \"{{/:Bold {title}}}" + ("\\n" * space) + "\"")
+    g('set key reverse below Left width -25')
+    g("plot " + ", ".join(
+        f"'{data_file}' using 1:{column} with lines title '{name}' noenhanced lw 2 lc rgb '{LAYER_COLORS[i % len(LAYER_COLORS)]}'"
+        for i, (data_file, column, name) in enumerate(series)
+    ))
+    g('unset key')
+
+
+# Return the hosts of a fleet gathered by the collect command
+def fleet_hosts(session):
+    prefix = f"{session}-"
+    return sorted(cut_suffix(os.path.basename(path), ".txt")[len(prefix):]
+                  for path in glob.glob(f"{glob.escape(prefix)}*.txt"))
+
+
+# Plot the CPU load and RAM usage of every host of a fleet on a shared time
+# axis, either overlaid on two plots or tiled with a row of plots per host
+def fleet_graph(session, fname='fleet', layout='overlay', resolution=decimate.DEFAULT_RESOLUTION):
+    global OUTPUT_TYPE
+    global OUTPUT_EXT
+
+    OUTPUT_TYPE, OUTPUT_EXT = output_format(fname)
+    if OUTPUT_TYPE in ("ascii", "html"):
+        fail("Fleet plots can only be saved as png or svg")
+    fname = cut_suffix(fname, f".{OUTPUT_EXT}")
+
+    hosts = fleet_hosts(session)
+    if not hosts:
+        fail(f"No hosts of fleet '{session}' were found")
+
+    # Removed once gnuplot is done with it
+    temp_dir = tempfile.mkdtemp(prefix="sargraph-")
+    try:
+        files = []
+        start, end = np.inf, -np.inf
+        for i, host in enumerate(hosts):
+            log = load_session(f"{session}-{host}")
+            paths = []
+            for kind, column in [("sar", 0), ("psu", 0)]:
+                times, values = log.arrays(kind)
+                values = values[:, column:column + 1]
+                if kind == "psu":
+                    values = 100 - values
+                if resolution and len(times) > resolution:
+                    times, _, values, _ = decimate.bucket_stats(times, values, resolution)
+                if len(times):
+                    start, end = min(start, times[0]), max(end, times[-1])
+                path = os.path.join(temp_dir, f"{i}_{kind}_data.txt")
+                np.savetxt(path, np.column_stack((times, values)), fmt="%.3f")
+                paths.append(path)
+            files.append(paths)
+        if start > end:
+            fail(f"Fleet '{session}' has no samples")
+
+        margin = max(end - start, 100) * 0.01
+        start_gnuplot(fname, 1600 if layout == "overlay" else max(800, 320 * len(hosts)))
+
+        title = f"Fleet {{/:Bold {session}}}: {{/:Bold {len(hosts)}}} hosts\\n" + \
+                f"Duration: {{/:Bold {format_timestamp(start)}}} .. {{/:Bold {format_timestamp(end)}}}"
+        rows, columns = (2, 1) if layout == "overlay" else (len(hosts), 2)
+        g(f"set multiplot layout {rows},{columns} title \"\\n{title}\" offset screen -0.475, 0 left tc rgb 'white'")
+        g(f"set title tc rgb 'white' font 'monospace,{fix_size(11)}'")
+        g(f"set xrange ['{start - margin:.3f}':'{end + margin:.3f}']")
+        g("set object rectangle from graph 0, graph 0 to graph 2, graph 2 behind fillcolor rgb '#000000' fillstyle solid noborder")
+
+        if layout == "overlay":
+            plot_files("CPU load (%)", "CPU load", [(cpu, 2, host) for host, (cpu, _) in zip(hosts, files)], space=1)
+            plot_files("RAM usage (%)", "RAM usage", [(ram, 2, host) for host, (_, ram) in zip(hosts, files)], space=1)
+        else:
+            for host, (cpu, ram) in zip(hosts, files):
+                plot(f"{host} CPU load (%)", f"{host} CPU load", cpu, 2, space=1)
+                plot(f"{host} RAM usage (%)", f"{host} RAM usage", ram, 2, space=1)
+
+        g("unset multiplot")
+        g("unset output")
+        g("quit")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+# Series overlaid by the compare command: stream, column, y label and title
+COMPARE_SERIES = [
+    ("sar", 0, "CPU load (%)", "CPU load"),
+    ("psu", 0, "RAM usage (%)", "RAM usage"),
+    ("sar", 1, "FS usage (%)", "Filesystem usage"),
+    ("sar", 2, "Received (Mb/s)", "Data received"),
+    ("sar", 3, "Sent (Mb/s)", "Data sent"),
+]
+
+# Summary fields compared by the compare command, with their units
+COMPARE_FIELDS = [
+    ("duration", "s"),
+    ("average load", "%"),
+    ("max ram used", DATA_UNITS),
+    ("total received", DATA_UNITS),
+    ("total sent", DATA_UNITS),
+]
+
+
+# Load a compared session. Return the time it is aligned on, its start time
+# or the time of a given label, its compared series with times relative to
+# that and its summary.
+def compare_session(session, align=None):
+    log = load_session(session)
+    sar_time, _ = log.arrays("sar")
+    if len(sar_time) == 0:
+        raise ValueError(f"Session '{session}' has no samples")
+
+    # A running session has no summary yet, it is computed from the samples
+    if "average load" not in log.summary:
+        log.select((None, None))
+        # RAM is only given in % until the total is known
+        if "total ram" not in log.summary:
+            log.summary.pop("max ram used", None)
+
+    try:
+        origin = sar_time[0] if align is None else bound_time(align, log.labels)
+    except ValueError:
+        raise ValueError(f"Session '{session}' has no label '{align}'")
+
+    series = []
+    for kind, column, _, _ in COMPARE_SERIES:
+        times, values = log.arrays(kind)
+        values = values[:, column:column + 1]
+        if kind == "psu":
+            values = 100 - values
+        series.append((times - origin, values))
+    return origin, series, log.summary
+
+
+# Plot the CPU, RAM, filesystem and network usage of sessions overlaid on a
+# shared time axis, relative to their start or to a label. The sessions are
+# loaded in parallel and reduced to the same time buckets. Return their
+# summaries.
+def compare_graph(sessions, fname='compare', align=None, resolution=decimate.DEFAULT_RESOLUTION):
+    global OUTPUT_TYPE
+    global OUTPUT_EXT
+
+    OUTPUT_TYPE, OUTPUT_EXT = output_format(fname)
+    if OUTPUT_TYPE in ("ascii", "html"):
+        fail("Comparison plots can only be saved as png or svg")
+    fname = cut_suffix(fname, f".{OUTPUT_EXT}")
+
+    with multiprocessing.get_context("fork").Pool(min(len(sessions), os.cpu_count() or 1)) as pool:
+        loaded = pool.starmap(compare_session, [(session, align) for session in sessions])
+
+    start = min(times[0] for _, series, _ in loaded for times, _ in series if len(times))
+    end = max(times[-1] for _, series, _ in loaded for times, _ in series if len(times))
+
+    # Removed once gnuplot is done with it
+    temp_dir = tempfile.mkdtemp(prefix="sargraph-")
+    try:
+        files = []
+        for i, (_, series, _) in enumerate(loaded):
+            paths = []
+            for j, (times, values) in enumerate(series):
+                # Short sessions are put on the same grid too, so their samples line up
+                if resolution:
+                    times, _, values, _ = decimate.bucket_stats(times, values, resolution, start, end)
+                path = os.path.join(temp_dir, f"{i}_{j}_data.txt")
+                np.savetxt(path, np.column_stack((times, values)), fmt="%.3f")
+                paths.append(path)
+            files.append(paths)
+
+        margin = max(end - start, 100) * 0.01
+        start_gnuplot(fname)
+
+        names = [f"{session} ({format_timestamp(origin)})" for session, (origin, _, _) in zip(sessions, loaded)]
+        title = f"Comparison of {{/:Bold {len(sessions)}}} sessions, aligned on " + \
+                (f"label {{/:Bold {align}}}" if align is not None else "their start")
+        g(f"set multiplot layout {len(COMPARE_SERIES)},1 title \"\\n{title}\" offset screen -0.475, 0 left tc rgb 'white'")
+        g(f"set title tc rgb 'white' font 'monospace,{fix_size(11)}'")
+        g(f"set xrange ['{start - margin:.3f}':'{end + margin:.3f}']")
+        # Times are relative, so they are shown as elapsed time
+        g("set xtics format '%tH:%tM:%tS'")
+        g("set object rectangle from graph 0, graph 0 to graph 2, graph 2 behind fillcolor rgb '#000000' fillstyle solid noborder")
+
+        for j, (_, _, ylabel, plot_title) in enumerate(COMPARE_SERIES):
+            yrange = "[0:100]" if ylabel.endswith("(%)") else "[0:*]"
+            plot_files(ylabel, plot_title, [(paths[j], 2, name) for name, paths in zip(names, files)], space=1, yrange=yrange)
+
+        g("unset multiplot")
+        g("unset output")
+        g("quit")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return [summary for _, _, summary in loaded]
+
+
+# Return the lines of a table of the compared summary fields of sessions,
+# with the difference of every session from the first one
+def compare_table(sessions, summaries):
+    def value_str(value, units):
+        if value is None:
+            return "-"
+        if isinstance(units, list):
+            return unit_str(value, units)
+        return f"{value:.2f} {units}"
+
+    header = ["", sessions[0]]
+    for session in sessions[1:]:
+        header.extend([session, "change"])
+    rows = [header]
+    for key, units in COMPARE_FIELDS:
+        base = summaries[0].get(key)
+        row = [key, value_str(base, units)]
+        for summary in summaries[1:]:
+            value = summary.get(key)
+            row.append(value_str(value, units))
+            if value is None or base is None:
+                row.append("-")
+            elif base == 0:
+                row.append("+0.00 %" if value == 0 else "-")
+            else:
+                row.append(f"{100 * (value - base) / base:+.2f} %")
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return ["  ".join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))).rstrip()
+            for row in rows]
+
+
+# Return timestamps (epoch seconds) and values of every plotted series
+def read_data(log):
+    xdata, sar_values = log.arrays("sar")
+    xdata_ram, psu_values = log.arrays("psu")
+    xdatas = []
+    ydata = []
+    for i in range(7 if TOTAL_GPU_RAM != 0 else 5):
+        if i == RAM_DATA_POSITION:
+            xdatas.append(xdata_ram)
+            ydata.append(100 - psu_values[:, 0])
+        else:
+            xdatas.append(xdata)
+            ydata.append(sar_values[:, i - int(i > RAM_DATA_POSITION)])
+
+    # servis plots a single series at a time, so the most stalled resource is shown
+    if PSI_PLOT:
+        xdata_psi, psi_values = log.arrays("psi")
+        xdatas.insert(RAM_DATA_POSITION + 1, xdata_psi)
+        ydata.insert(RAM_DATA_POSITION + 1, np.nanmax(psi_values[:, [0, 2, 4]], axis=1))
+
+    # servis plots a single series at a time, so every other observed device
+    # gets its own plots
+    if len(DISKS) > 1:
+        xdata_fs, fs_values = log.arrays("fs")
+        for i in range(1, len(DISKS)):
+            xdatas.append(xdata_fs)
+            ydata.append(fs_values[:, i])
+    if len(IFACES) > 1:
+        xdata_net, net_values = log.arrays("net")
+        for i in range(1, len(IFACES)):
+            xdatas.extend([xdata_net, xdata_net])
+            ydata.extend([net_values[:, 2 * i], net_values[:, 2 * i + 1]])
+
+    if DISK_IO_PLOT:
+        xdata_dio, dio_values = log.arrays("dio")
+        xdatas.extend([xdata_dio, xdata_dio])
+        ydata.extend([dio_values[:, 0] + dio_values[:, 1], dio_values[:, 5]])
+
+    # servis has no heatmaps, the busiest core shows serialized work instead
+    if CPU_DETAIL_PLOT:
+        xdata_core, core_values = log.arrays("core")
+        xdata_cpu, cpu_values = log.arrays("cpu")
+        xdatas.extend([xdata_core, xdata_cpu])
+        ydata.extend([np.nanmax(core_values, axis=1), cpu_values[:, 3]])
+
+    # servis plots a single series at a time, so only the largest consumers are shown
+    if TOP_PLOT:
+        for column in [2, 1]:
+            _, xdata_top, values = largest_consumer(log, column)
+            xdatas.append(xdata_top)
+            ydata.append(values)
+
+    if JOB_PLOT:
+        xdata_job, job_values = log.arrays("job")
+        xdatas.extend([xdata_job] * 3)
+        ydata.extend([job_values[:, 0], job_values[:, 1], job_values[:, 2] + job_values[:, 3]])
+
+    if OVERHEAD_PLOT:
+        xdata_ovh, ovh_values = log.arrays("ovh")
+        xdatas.append(xdata_ovh)
+        ydata.append(ovh_values[:, 0])
+
+    return (xdatas, ydata)
 
 
 def convert_labels_to_tags(labels):
     tags = []
-    for [label_date, label_name] in labels:
-        label_date = datetime.datetime.strptime(
-            label_date, '%Y-%m-%d-%H:%M:%S')
-        label_ts = int(label_date.replace(
-            tzinfo=datetime.timezone.utc).timestamp()*1000)/1000
+    for [label_ts, label_name] in labels:
         tags.append({'name': label_name,
-                     'timestamp': label_ts})
+                     'timestamp': round(float(label_ts), 3)})
     return tags
 
 
-def servis_graph(sar_file, ram_file, fname='plot', output_ext='ascii'):
-    read_comments(sar_file)
-    xdata, xdata_ram, ydata = read_data(sar_file, ram_file)
+def servis_graph(log, fname='plot', output_ext='ascii', resolution=decimate.DEFAULT_RESOLUTION):
+    # Every plot gets its own time axis, as the reduction keeps different samples
+    xdatas, ydata = read_data(log)
+    plots = len(ydata)
+    if resolution:
+        for i in range(plots):
+            xdatas[i], ydata[i] = decimate.m4(xdatas[i], ydata[i], resolution)
     titles = [f"""CPU load (average = {AVERAGE_LOAD} %)""",
               f"""RAM usage (max = {MAX_USED_RAM})""",
               f"""{NAME_FS} usage (max = {MAX_USED_FS})""",
               f"""{NAME_IFACE} data received (max = {MAX_RX})""",
               f"""{NAME_IFACE} data sent (max = {MAX_TX})"""]
+    if PSI_PLOT:
+        titles.insert(RAM_DATA_POSITION + 1, f"Highest pressure stall (cpu = {CPU_STALL:.2f} s, memory = {MEMORY_STALL:.2f} s, io = {IO_STALL:.2f} s)")
 
     if TOTAL_GPU_RAM != 0:
         titles.extend([
@@ -540,11 +1080,51 @@ def servis_graph(sar_file, ram_file, fname='plot', output_ext='ascii'):
             f"GPU RAM usage (max = {MAX_USED_GPU_RAM})"
         ])
 
+    for name in DISKS[1:]:
+        titles.append(f"{name} usage (max = {device_values('disk', [name], 'max disk used', DATA_UNITS)})")
+    for name in IFACES[1:]:
+        titles.extend([
+            f"{name} data received (max = {device_values('network', [name], 'max received', SPEED_UNITS)})",
+            f"{name} data sent (max = {device_values('network', [name], 'max sent', SPEED_UNITS)})"
+        ])
+
+    if DISK_IO_PLOT:
+        titles.extend([
+            f"{NAME_IO} I/O (max read = {MAX_IO_READ:.2f} MB/s, max written = {MAX_IO_WRITTEN:.2f} MB/s)",
+            f"{NAME_IO} utilization (average = {AVERAGE_IO_UTIL:.2f} %, average wait = {AVERAGE_IO_WAIT:.2f} ms)"
+        ])
+
+    if CPU_DETAIL_PLOT:
+        titles.extend([
+            f"Busiest core load ({CORES} cores)",
+            f"CPU iowait (average = {AVERAGE_IOWAIT:.2f} %)"
+        ])
+
+    if TOP_PLOT:
+        largest, _, values = largest_consumer(log, 2)
+        busiest, _, loads = largest_consumer(log, 1)
+        titles.extend([
+            f"Memory of the largest of {CONSUMERS}: {largest} (max = {unit_str(values.max(initial=0) * 1024 * 1024, DATA_UNITS)})",
+            f"CPU load of the busiest of {CONSUMERS}: {busiest} (max = {loads.max(initial=0):.2f} %)"
+        ])
+
+    if JOB_PLOT:
+        titles.extend([
+            f"{JOB_COMMAND} CPU load (cpu time = {JOB_CPU_TIME:.2f} s, exit code = {JOB_EXIT_CODE})",
+            f"{JOB_COMMAND} memory usage (max = {JOB_MAX_RSS})",
+            f"{JOB_COMMAND} I/O (read = {JOB_READ}, written = {JOB_WRITTEN}, context switches = {JOB_SWITCHES:.0f})"
+        ])
+
+    if OVERHEAD_PLOT:
+        titles.append(f"sargraph overhead (average load = {WATCHER_LOAD:.2f} %, max RSS = {WATCHER_MAX_RSS}, max tick = {WATCHER_MAX_LATENCY:.3f} ms)")
+
     y_titles = ["CPU load (%)",
                 f"RAM usage (100% = {TOTAL_RAM})",
                 f"FS usage (100% = {TOTAL_FS})",
                 f"{NAME_IFACE} received",
                 f"{NAME_IFACE} sent"]
+    if PSI_PLOT:
+        y_titles.insert(RAM_DATA_POSITION + 1, "Stalled (%, avg10)")
 
     if TOTAL_GPU_RAM != 0:
         y_titles.extend([
@@ -552,15 +1132,36 @@ def servis_graph(sar_file, ram_file, fname='plot', output_ext='ascii'):
             f"GPU RAM usage (100% = {TOTAL_GPU_RAM})"
         ])
 
-    xdata_to_int = [int(timestamp.replace(
-        tzinfo=datetime.timezone.utc).timestamp()*1000)/1000
-        for timestamp in xdata]
+    for name in DISKS[1:]:
+        y_titles.append(f"{name} usage (%)")
+    for name in IFACES[1:]:
+        y_titles.extend([f"{name} received", f"{name} sent"])
+
+    if DISK_IO_PLOT:
+        y_titles.extend([f"{NAME_IO} read + written (MB/s)", f"{NAME_IO} utilization (%)"])
+
+    if CPU_DETAIL_PLOT:
+        y_titles.extend(["Core load (%)", "CPU iowait (%)"])
+
+    if TOP_PLOT:
+        y_titles.extend([f"{largest} RSS (MB)", f"{busiest} CPU load (%)"])
+
+    if JOB_PLOT:
+        y_titles.extend(["Command CPU load (%)", "Command RSS (MB)", "Command read + written (MB/s)"])
+
+    if OVERHEAD_PLOT:
+        y_titles.append("sargraph CPU load (%)")
+
+    xdatas = [np.round(xd, 3).tolist() for xd in xdatas]
+    ydata = [yd.tolist() for yd in ydata]
 
     summary = f"Running on {UNAME}, {CPUS} threads x {CPU_NAME}\n"
     summary += f"Total ram: {TOTAL_RAM}, Total disk space: {TOTAL_FS}\n"
     if TOTAL_GPU_RAM != 0:
         summary += f"GPU:  {GPU_NAME} (driver {GPU_DRIVER}), total ram: {TOTAL_GPU_RAM}"
     summary += f"Duration: {START_DATE} .. {END_DATE} ({DURATION})"
+    if MISSED_TICKS:
+        summary += f", missed samples: {MISSED_TICKS}"
 
     y_ranges = [
         (0, 100),
@@ -569,6 +1170,8 @@ def servis_graph(sar_file, ram_file, fname='plot', output_ext='ascii'):
         None,
         None,
     ]
+    if PSI_PLOT:
+        y_ranges.insert(RAM_DATA_POSITION + 1, None)
 
     if TOTAL_GPU_RAM != 0:
         y_ranges.extend([
@@ -576,24 +1179,35 @@ def servis_graph(sar_file, ram_file, fname='plot', output_ext='ascii'):
             (0, 100)
         ])
 
+    y_ranges.extend([(0, 100)] * len(DISKS[1:]))
+    y_ranges.extend([None, None] * len(IFACES[1:]))
+
+    if DISK_IO_PLOT:
+        y_ranges.extend([None, (0, 100)])
+
+    if CPU_DETAIL_PLOT:
+        y_ranges.extend([(0, 100), (0, 100)])
+
+    if TOP_PLOT:
+        y_ranges.extend([None, (0, 100)])
+
+    if JOB_PLOT:
+        y_ranges.extend([(0, 100), None, None])
+
+    if OVERHEAD_PLOT:
+        y_ranges.append(None)
+
     from servis import render_multiple_time_series_plot
     if output_ext == 'ascii':
-        xdatas = [[xdata_to_int]] * (NUMBER_OF_PLOTS - 1)
-        xdatas.insert(1, [[
-            int(timestamp.replace(
-            tzinfo=datetime.timezone.utc).timestamp()*1000)/1000
-            for timestamp in xdata_ram
-        ]])
-
         render_multiple_time_series_plot(
             ydatas=[[yd] for yd in ydata],
-            xdatas=xdatas,
+            xdatas=[[xd] for xd in xdatas],
             title=summary,
             subtitles=titles,
-            xtitles=['time'] * NUMBER_OF_PLOTS,
-            xunits=[None] * NUMBER_OF_PLOTS,
+            xtitles=['time'] * plots,
+            xunits=[None] * plots,
             ytitles=y_titles,
-            yunits=[None] * NUMBER_OF_PLOTS,
+            yunits=[None] * plots,
             y_ranges=y_ranges,
             outpath=Path(fname),
             trimxvalues=False,
@@ -602,26 +1216,20 @@ def servis_graph(sar_file, ram_file, fname='plot', output_ext='ascii'):
         )
     elif output_ext == 'html':
         converted_labels = convert_labels_to_tags(labels)
-        xdatas = [
-            int(timestamp.replace(
-            tzinfo=datetime.timezone.utc).timestamp()*1000)/1000
-            for timestamp in xdata_ram
-        ] 
-        xdatas = [xdata_to_int] + [xdatas] + [xdata_to_int * (NUMBER_OF_PLOTS - 2)]
         render_multiple_time_series_plot(
             ydatas=ydata,
             xdatas=xdatas,
             title=summary,
             subtitles=titles,
-            xtitles=['time'] * NUMBER_OF_PLOTS,
-            xunits=[None] * NUMBER_OF_PLOTS,
+            xtitles=['time'] * plots,
+            xunits=[None] * plots,
             ytitles=y_titles,
-            yunits=[None] * NUMBER_OF_PLOTS,
+            yunits=[None] * plots,
             y_ranges=y_ranges,
             outpath=Path(fname),
             outputext=['html'],
             trimxvalues=False,
             figsize=(1200, 1600),
-            tags=[converted_labels] * NUMBER_OF_PLOTS,
+            tags=[converted_labels] * plots,
             setgradientcolors=True
         )
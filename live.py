@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import collections
+import shutil
+import sys
+import time
+
+from common import *
+
+# Characters of a sparkline, from the lowest to the highest value
+SPARKS = " ▁▂▃▄▅▆▇█"
+
+# Minimal time between two redraws of the dashboard, in seconds
+REDRAW_INTERVAL = 0.5
+
+# Series shown on the dashboard once their stream sends them: title, stream,
+# function of the line values and unit. Percentages are drawn on a fixed scale.
+SERIES = [
+    ("CPU load",     "sar", lambda v: v[0],       "%"),
+    ("RAM usage",    "psu", lambda v: 100 - v[0], "%"),
+    ("Memory stall", "psi", lambda v: v[2],       "%"),
+    ("FS usage",     "sar", lambda v: v[1],       "%"),
+    ("Received",     "sar", lambda v: v[2],       "Mb/s"),
+    ("Sent",         "sar", lambda v: v[3],       "Mb/s"),
+    ("GPU load",     "sar", lambda v: v[4],       "%"),
+    ("GPU RAM",      "sar", lambda v: v[5],       "%"),
+    ("CPU iowait",   "cpu", lambda v: v[3],       "%"),
+    ("Disk read",    "dio", lambda v: v[0],       "MB/s"),
+    ("Disk written", "dio", lambda v: v[1],       "MB/s"),
+    ("Disk util",    "dio", lambda v: v[5],       "%"),
+    ("Command CPU",  "job", lambda v: v[0],       "%"),
+    ("Command RSS",  "job", lambda v: v[1],       "MB"),
+    ("sargraph CPU", "ovh", lambda v: v[0],       "%"),
+]
+
+
+# Return a sparkline of values, scaled to 0..100 or to the largest value
+def sparkline(values, percent):
+    top = 100.0 if percent else max(max(values, default=0.0), 1e-9)
+    steps = len(SPARKS) - 1
+    return "".join(SPARKS[min(max(int(round(v / top * steps)), 0), steps)] for v in values)
+
+
+# Terminal dashboard of a running session, updated with the log lines the
+# watcher sends to its live views
+class Dashboard:
+    def __init__(self, session, out=sys.stdout):
+        self.session = session
+        self.out = out
+        self.width = max(shutil.get_terminal_size().columns - 32, 10)
+        self.history = {title: collections.deque(maxlen=self.width) for title, _, _, _ in SERIES}
+        self.last_stamp = None
+        self.last_label = None
+        self.last_draw = 0.0
+
+    # Add a log line, either a data line or a comment
+    def update(self, line):
+        if line.startswith("#"):
+            stamp, _, rest = line[1:].strip().partition(" ")
+            if rest.startswith("label: "):
+                self.last_label = f"{rest[len('label: '):]} ({stamp})"
+            return
+
+        kind, stamp, *fields = line.split()
+        try:
+            values = [stof(f) for f in fields]
+        except ValueError:
+            return
+        self.last_stamp = stamp
+        for title, stream, function, _ in SERIES:
+            if stream != kind:
+                continue
+            try:
+                self.history[title].append(function(values))
+            except IndexError:
+                pass
+
+    # Redraw the whole screen, at most every REDRAW_INTERVAL seconds unless forced
+    def draw(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_draw < REDRAW_INTERVAL:
+            return
+        self.last_draw = now
+
+        lines = [f"sargraph session '{self.session}', last sample: {self.last_stamp or 'none yet'}"]
+        if self.last_label:
+            lines.append(f"last label: {self.last_label}")
+        lines.append("")
+        for title, _, _, unit in SERIES:
+            values = self.history[title]
+            if not values:
+                continue
+            lines.append(f"{title:13} {values[-1]:9.2f} {unit:5} |{sparkline(values, unit == '%')}")
+
+        # Move to the top left corner and clear the screen before drawing
+        self.out.write("\033[H\033[2J" + "\n".join(lines) + "\n")
+        self.out.flush()
@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import datetime
+import os
+import re
+
+import numpy as np
+
+import segments
+from common import *
+
+# Number of bytes read from the session log at once
+BLOCK_SIZE = 1 << 24
+
+# Number of data lines gathered before they are converted to arrays
+CHUNK_LINES = 1 << 16
+
+# Lines this many seconds around a time window are read too, as the lines of
+# different streams are not strictly in time order
+WINDOW_MARGIN = 60.0
+
+# Number of bytes at the start and at the end of a log read for its header
+# and summary when only a time window of it is read
+HEAD_SIZE = 1 << 20
+TAIL_SIZE = 1 << 20
+
+# Bisection of a log by time stops once this many bytes are left
+BISECT_SIZE = 1 << 16
+
+LABEL_LINE = re.compile(r"^# (\S+) label: (.*)$", re.M)
+CONSUMER_LINE = re.compile(r"^# \S+ consumer id: (\d+) (.*)$", re.M)
+
+# Timestamps accepted as window bounds, as in the log or with a space
+TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}[- ]\d{2}:\d{2}:\d{2}(\.\d+)?")
+
+
+# Return the leading number of a summary value, e.g. "12.00 B" -> 12.0
+def leading_float(s):
+    return stof(s.split(' ', 1)[0])
+
+
+# Return the "major.middle" part of a version string
+def short_version(s):
+    return scan("^(\\d+\\.\\d+)", str, s)
+
+
+# Fields that can be found in header and summary comments, with converters
+COMMENT_FIELDS = {
+    "sargraph version": short_version,
+    "psutil version": short_version,
+    "machine": str,
+    "cpu count": int,
+    "cpu": str,
+    "gpu": str,
+    "gpu driver": str,
+    "observed disk": str,
+    "observed network": str,
+    "observed disks": str.split,
+    "observed networks": str.split,
+    "total ram": leading_float,
+    "total disk space": leading_float,
+    "max ram used": leading_float,
+    "max disk used": leading_float,
+    "average load": leading_float,
+    "max received": leading_float,
+    "max sent": leading_float,
+    "total received": leading_float,
+    "total sent": leading_float,
+    "duration": leading_float,
+    "total gpu ram": leading_float,
+    "max gpu ram used": leading_float,
+    "average gpu load": leading_float,
+    "interval": leading_float,
+    "memory interval": leading_float,
+    "missed ticks": int,
+    "io device": str,
+    "max io read": leading_float,
+    "max io written": leading_float,
+    "max iops": leading_float,
+    "average io wait": leading_float,
+    "max io wait": leading_float,
+    "average io util": leading_float,
+    "max io util": leading_float,
+    "watcher load": leading_float,
+    "watcher max rss": leading_float,
+    "watcher max latency": leading_float,
+    "consumers": str,
+    "cpu time": leading_float,
+    "max cpu": leading_float,
+    "max rss": leading_float,
+    "job command": str,
+    "job exit code": int,
+    "job cpu time": leading_float,
+    "job max rss": leading_float,
+    "job read": leading_float,
+    "job written": leading_float,
+    "job context switches": leading_float,
+    "cpu stall": leading_float,
+    "cpu full stall": leading_float,
+    "memory stall": leading_float,
+    "memory full stall": leading_float,
+    "io stall": leading_float,
+    "io full stall": leading_float,
+}
+
+
+# Convert "YYYY-MM-DD-HH:MM:SS[.ffffff]" log timestamps to epoch seconds.
+# Timestamps are wall-clock times, so they are treated as if they were UTC.
+def parse_timestamps(stamps):
+    iso = [s[:10] + ' ' + s[11:] for s in stamps]
+    return np.array(iso, dtype='datetime64[us]').astype(np.int64) / 1e6
+
+
+# Convert epoch seconds back to the log timestamp format
+def format_timestamp(t, fmt='%Y-%m-%d-%H:%M:%S'):
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime(fmt)
+
+
+# Column store for one kind of data lines, e.g. "sar" or "psu"
+class Stream:
+    def __init__(self):
+        self.width = 0
+        self.chunks = []
+        self.stamps = []
+        self.rows = []
+
+    # Add the part of a data line that follows the stream name
+    def append(self, body):
+        stamp, _, values = body.partition(' ')
+        self.stamps.append(stamp)
+        self.rows.append(values.replace(',', '.').split())
+        if len(self.rows) >= CHUNK_LINES:
+            self.flush()
+
+    # Convert the gathered lines to arrays
+    def flush(self):
+        if not self.rows:
+            return
+
+        # Rows can be shorter, e.g. when GPU readouts stopped mid-session
+        width = max(map(len, self.rows))
+        for row in self.rows:
+            if len(row) < width:
+                row.extend(['nan'] * (width - len(row)))
+
+        self.chunks.append((
+            parse_timestamps(self.stamps),
+            np.array(self.rows, dtype=np.float64).reshape(-1, width)
+        ))
+        self.width = max(self.width, width)
+        self.stamps = []
+        self.rows = []
+
+    # Return timestamps and a (samples x columns) array of values
+    def arrays(self):
+        self.flush()
+        if not self.chunks:
+            return np.empty(0), np.empty((0, 0))
+
+        if len(self.chunks) > 1:
+            values = []
+            for _, chunk in self.chunks:
+                if chunk.shape[1] < self.width:
+                    pad = np.full((len(chunk), self.width - chunk.shape[1]), np.nan)
+                    chunk = np.hstack((chunk, pad))
+                values.append(chunk)
+            times = np.concatenate([t for t, _ in self.chunks])
+            self.chunks = [(times, np.concatenate(values))]
+        return self.chunks[0]
+
+    def __len__(self):
+        return sum(len(t) for t, _ in self.chunks) + len(self.rows)
+
+
+# Parser for '{session}.txt', or for the segments of a session log, that
+# splits data and comments in a single pass
+class SessionLog:
+    def __init__(self, path):
+        self.path = path
+        # Bytes parsed so far, summed over all segments of a segmented log
+        self.offset = 0
+        self.segment = 0
+        self.segment_offset = 0
+        self.streams = {}
+        self.summary = {}
+        self.labels = []
+        # Summaries of single devices when more of them were observed, e.g.
+        # devices["disk"]["/dev/sda1"]["max disk used"]
+        self.devices = {}
+        # Names of the processes or cgroups in the "top" lines, by id
+        self.consumers = {}
+        # Start and end time of the samples returned by arrays(), if limited
+        self.window = None
+
+    # Parse the log from the last read position up to the last complete line,
+    # or up to `limit` bytes to read a consistent snapshot of a running session
+    def read(self, limit=None):
+        if os.path.isdir(self.path):
+            return self.read_segments(limit)
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            self.offset += self.read_file(f, float("inf") if limit is None else limit - self.offset)
+        return self
+
+    # Continue parsing from a given number of bytes, e.g. where an earlier
+    # parser of the same log stopped
+    def seek(self, offset):
+        self.offset = self.segment_offset = offset
+        self.segment = 0
+        if os.path.isdir(self.path):
+            names = [name for name, _ in segments.read_manifest(self.path)]
+            while self.segment + 1 < len(names):
+                size = os.path.getsize(os.path.join(self.path, names[self.segment]))
+                if self.segment_offset < size:
+                    break
+                self.segment_offset -= size
+                self.segment += 1
+        return self
+
+    # Parse the segments in the order of the manifest, moving on to the next
+    # one only when the current one was read completely
+    def read_segments(self, limit=None):
+        names = [name for name, _ in segments.read_manifest(self.path)]
+        while self.segment < len(names):
+            path = os.path.join(self.path, names[self.segment])
+            size = os.path.getsize(path)
+            available = size - self.segment_offset
+            if limit is not None:
+                available = min(available, limit - self.offset)
+            with open(path, "rb") as f:
+                f.seek(self.segment_offset)
+                used = self.read_file(f, available, segments.compression_of(path))
+            self.segment_offset += used
+            self.offset += used
+            if self.segment_offset < size or self.segment + 1 == len(names):
+                break
+            self.segment += 1
+            self.segment_offset = 0
+        return self
+
+    # Parse complete lines, or complete compressed members, reading at most
+    # `available` bytes. Return the number of bytes that were parsed.
+    def read_file(self, f, available, compression=None):
+        used = 0
+        if compression is not None:
+            for text, size in segments.read_members(f, available, compression, BLOCK_SIZE):
+                self.parse(text)
+                used += size
+            return used
+
+        pending = b""
+        while available > 0:
+            block = f.read(min(BLOCK_SIZE, available))
+            if not block:
+                break
+            available -= len(block)
+            block = pending + block
+            end = block.rfind(b"\n") + 1
+            pending = block[end:]
+            self.parse(block[:end].decode("utf-8", errors="replace"))
+            used += end
+        return used
+
+    def parse(self, text):
+        streams = self.streams
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line[0] == '#':
+                self.parse_comment(line[1:].strip())
+                continue
+            kind, _, body = line.partition(' ')
+            stream = streams.get(kind)
+            if stream is None:
+                stream = streams[kind] = Stream()
+            stream.append(body)
+
+    # Dispatch a comment on its prefix: either a label, a consumer id, a summary
+    # of a single device or top consumer, or "key: value" fields
+    def parse_comment(self, text):
+        stamp, _, rest = text.partition(' ')
+        if rest.startswith("label: "):
+            self.labels.append((float(parse_timestamps([stamp])[0]), rest[len("label: "):]))
+            return
+        if rest.startswith("consumer id: "):
+            consumer, _, name = rest[len("consumer id: "):].partition(' ')
+            self.consumers[int(consumer)] = name
+            return
+
+        summary = self.summary
+        if text.startswith(("disk: ", "network: ", "top consumer: ")):
+            kind, _, text = text.partition(": ")
+            name, _, text = text.partition(", ")
+            summary = self.devices.setdefault(kind, {}).setdefault(name, {})
+
+        for field in text.split(", "):
+            key, _, value = field.partition(": ")
+            conv = COMMENT_FIELDS.get(key)
+            if conv is None:
+                continue
+            try:
+                value = conv(value.strip())
+            except ValueError:
+                continue
+            if value is not None:
+                summary[key] = value
+
+    # Limit the samples and labels to a (start, end) window of epoch seconds,
+    # either of which can be None, and recompute the summary for the window
+    def select(self, window):
+        start, end = window
+        self.window = window
+        self.labels = [(t, name) for t, name in self.labels
+                       if (start is None or t >= start) and (end is None or t <= end)]
+        summarize_window(self)
+        return self
+
+    # Return the arrays of a given stream, empty if it was never logged
+    def arrays(self, kind):
+        if kind not in self.streams:
+            return np.empty(0), np.empty((0, 0))
+        return crop(*self.streams[kind].arrays(), self.window)
+
+
+# Parser that only reads the comments of a log, e.g. its header and summary
+class CommentLog(SessionLog):
+    def parse(self, text):
+        for line in text.splitlines():
+            if line.startswith('#'):
+                self.parse_comment(line[1:].strip())
+
+
+# Parser that only reads the labels of a log, much faster than parsing all of it
+class LabelLog(SessionLog):
+    def parse(self, text):
+        for stamp, name in LABEL_LINE.findall(text):
+            self.labels.append((float(parse_timestamps([stamp])[0]), name))
+
+
+# Parser that only reads the names of top consumers by their ids
+class ConsumerLog(SessionLog):
+    def parse(self, text):
+        for consumer, name in CONSUMER_LINE.findall(text):
+            self.consumers[int(consumer)] = name
+
+
+# Return the samples of a stream within a (start, end) window of epoch
+# seconds, either of which can be None. Samples of a stream are in time order.
+def crop(times, values, window):
+    if window is None:
+        return times, values
+    start, end = window
+    first = 0 if start is None else np.searchsorted(times, start, "left")
+    last = len(times) if end is None else np.searchsorted(times, end, "right")
+    return times[first:last], values[first:last]
+
+
+# Return timestamps and a (samples x consumers) array of a given column of the
+# "top" lines: 1 for CPU load, 2 for RSS. Consumers are columns by their ids
+# and are zero in samples they were not among the top ones.
+def consumer_values(log, column):
+    times, values = log.arrays("top")
+    ids = values[:, 0::3]
+    data = np.nan_to_num(values[:, column::3])
+    rows, slots = np.nonzero(~np.isnan(ids))
+    consumers = int(ids[rows, slots].max()) + 1 if len(rows) else 0
+    result = np.zeros((len(times), consumers))
+    result[rows, ids[rows, slots].astype(int)] = data[rows, slots]
+    return times, result
+
+
+# Return the time of a window bound: a log timestamp, or a label given as
+# "label:N" for the N-th label of the session or "label:NAME" (also just NAME)
+def bound_time(bound, labels):
+    if not is_label_bound(bound):
+        return float(parse_timestamps([bound])[0])
+    name = bound[len("label:"):] if bound.startswith("label:") else bound
+    if name.isdigit() and 0 < int(name) <= len(labels):
+        return labels[int(name) - 1][0]
+    for t, label in labels:
+        if label == name:
+            return t
+    raise ValueError(f"'{bound}' is neither a timestamp nor a label of the session")
+
+
+# Return whether a window bound refers to a label
+def is_label_bound(bound):
+    return TIMESTAMP.fullmatch(bound) is None
+
+
+# Return the offsets of the first lines after the (low, high) range of a plain
+# log that the first data line at or after a given time falls within
+def bisect_log(path, t):
+    with open(path, "rb") as f:
+        low, high = 0, os.fstat(f.fileno()).st_size
+        while high - low > BISECT_SIZE:
+            middle = (low + high) // 2
+            f.seek(middle)
+            f.readline()
+            stamp = next_stamp(f)
+            if stamp is None or stamp >= t:
+                high = middle
+            else:
+                low = middle
+
+        offsets = []
+        for offset in (low, high):
+            f.seek(offset)
+            if offset:
+                f.readline()
+            offsets.append(f.tell())
+    return offsets
+
+
+# Return the time of the next data line in a file, None at its end
+def next_stamp(f):
+    for line in f:
+        if line[:1] == b"#" or not line.strip():
+            continue
+        try:
+            return float(parse_timestamps([line.split()[1].decode()])[0])
+        except (IndexError, UnicodeDecodeError, ValueError):
+            return None
+    return None
+
+
+# Return the offset of a log to start reading from (or to read up to, if `end`
+# is set) to get the lines around a given time. Plain logs are bisected,
+# segments are found by the start times in the manifest and compressed ones
+# can only be read whole.
+def time_offset(path, t, end=False):
+    if not os.path.isdir(path):
+        return bisect_log(path, t)[end]
+    manifest = segments.read_manifest(path)
+    if not manifest:
+        return 0
+    sizes = [os.path.getsize(os.path.join(path, name)) for name, _ in manifest]
+    starts = parse_timestamps([start for _, start in manifest])
+    i = max(int(np.searchsorted(starts, t, "right")) - 1, 0)
+    name = manifest[i][0]
+    if segments.compression_of(name) is None:
+        return sum(sizes[:i]) + bisect_log(os.path.join(path, name), t)[end]
+    return sum(sizes[:i + 1] if end else sizes[:i])
+
+
+# Return a given offset of a log, moved to the start (or to the end) of its
+# segment if the segment is compressed
+def align_offset(path, offset, end=False):
+    if not os.path.isdir(path):
+        return offset
+    base = 0
+    for name, _ in segments.read_manifest(path):
+        size = os.path.getsize(os.path.join(path, name))
+        if offset < base + size:
+            if segments.compression_of(name) is None:
+                return offset
+            return base + size if end else base
+        base += size
+    return base
+
+
+# Return the largest value of a series, 0 if it has none
+def peak(values):
+    values = values[~np.isnan(values)]
+    return float(values.max()) if len(values) else 0.0
+
+
+# Return the average of a series, 0 if it has none
+def average(values):
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else 0.0
+
+
+# Return the total of a series of rates, each rate lasting since the previous sample
+def integral(times, values):
+    if len(times) < 2:
+        return 0.0
+    return float(np.nansum(values[1:] * np.diff(times)))
+
+
+# Recompute the summary of a log from the samples in its window. Fields that
+# describe the system, e.g. the total RAM, are kept.
+def summarize_window(log):
+    summary = log.summary
+    cpus = summary.get("cpu count", 0)
+    mib = 1024 * 1024
+    # Rates in Mb/s are kB/s divided by 128, totals are in bytes
+    mbps = 128 * 1024
+
+    summary.pop("missed ticks", None)
+
+    times, values = log.arrays("sar")
+    summary["duration"] = float(times[-1] - times[0]) if len(times) else 0.0
+    if values.shape[1] >= 4:
+        summary["average load"] = average(values[:, 0])
+        summary["max disk used"] = peak(values[:, 1]) / 100 * summary.get("total disk space", 0)
+        summary["max received"] = peak(values[:, 2])
+        summary["max sent"] = peak(values[:, 3])
+        summary["total received"] = integral(times, values[:, 2]) * mbps
+        summary["total sent"] = integral(times, values[:, 3]) * mbps
+    if values.shape[1] >= 6:
+        summary["average gpu load"] = average(values[:, 4])
+        summary["max gpu ram used"] = peak(values[:, 5]) / 100 * summary.get("total gpu ram", 0)
+
+    _, values = log.arrays("psu")
+    if len(values):
+        summary["max ram used"] = peak(100 - values[:, 0]) / 100 * summary.get("total ram", 0)
+
+    _, values = log.arrays("dio")
+    if len(values):
+        summary.update({
+            "max io read": peak(values[:, 0]),
+            "max io written": peak(values[:, 1]),
+            "max iops": peak(values[:, 2] + values[:, 3]),
+            "average io wait": average(values[:, 4]),
+            "max io wait": peak(values[:, 4]),
+            "average io util": average(values[:, 5]),
+            "max io util": peak(values[:, 5]),
+        })
+
+    _, values = log.arrays("ovh")
+    if len(values):
+        summary["watcher load"] = average(values[:, 0])
+        summary["watcher max rss"] = peak(values[:, 1]) * mib
+        summary["watcher max latency"] = peak(values[:, 2])
+
+    _, values = log.arrays("psi")
+    if len(values):
+        # Stall times are in ms since the previous sample
+        for i, key in enumerate(["cpu stall", "cpu full stall", "memory stall",
+                                 "memory full stall", "io stall", "io full stall"]):
+            if not np.all(np.isnan(values[:, 6 + i])):
+                summary[key] = float(np.nansum(values[:, 6 + i])) / 1000
+
+    times, values = log.arrays("job")
+    if len(values):
+        summary.update({
+            "job cpu time": integral(times, values[:, 0]) / 100 * cpus,
+            "job max rss": peak(values[:, 1]) * mib,
+            "job read": integral(times, values[:, 2]) * mib,
+            "job written": integral(times, values[:, 3]) * mib,
+            "job context switches": integral(times, values[:, 4]),
+        })
+
+    disks = log.devices.get("disk", {})
+    _, values = log.arrays("fs")
+    for i, name in enumerate(summary.get("observed disks", [])[:values.shape[1]]):
+        device = disks.setdefault(name, {})
+        device["max disk used"] = peak(values[:, i]) / 100 * device.get("total disk space", 0)
+
+    networks = log.devices.get("network", {})
+    times, values = log.arrays("net")
+    for i, name in enumerate(summary.get("observed networks", [])[:values.shape[1] // 2]):
+        device = networks.setdefault(name, {})
+        device["max received"] = peak(values[:, 2 * i])
+        device["max sent"] = peak(values[:, 2 * i + 1])
+        device["total received"] = integral(times, values[:, 2 * i]) * mbps
+        device["total sent"] = integral(times, values[:, 2 * i + 1]) * mbps
+
+    if "top consumer" in log.devices:
+        times, loads = consumer_values(log, 1)
+        _, rss = consumer_values(log, 2)
+        log.devices["top consumer"] = {
+            log.consumers.get(c, f"#{c}"): {
+                "cpu time": integral(times, loads[:, c]) / 100 * cpus,
+                "max cpu": peak(loads[:, c]),
+                "max rss": peak(rss[:, c]) * mib,
+            }
+            for c in range(loads.shape[1]) if loads[:, c].any() or rss[:, c].any()
+        }
+
+
+# Read the log of a given session, optionally limited to a snapshot of file sizes
+def load_session(session, snapshot=None):
+    path = segments.log_path(session)
+    return SessionLog(path).read((snapshot or {}).get(path))
+
+
+# Return the labels of a session, without parsing the rest of its log
+def read_labels(session, snapshot=None):
+    path = segments.log_path(session)
+    return LabelLog(path).read((snapshot or {}).get(path)).labels
+
+
+# Read a (start, end) time window of the log of a session. Only the lines
+# around the window are parsed, together with the header and the summary at
+# the ends of the log, and the summary is recomputed for the window.
+def load_window(session, window, snapshot=None):
+    path = segments.log_path(session)
+    limit = (snapshot or {}).get(path, segments.log_size(path))
+    start, end = window
+
+    first = 0 if start is None else time_offset(path, start - WINDOW_MARGIN)
+    last = limit if end is None else min(limit, time_offset(path, end + WINDOW_MARGIN, end=True))
+    log = SessionLog(path).seek(first).read(last)
+
+    comments = CommentLog(path).read(min(align_offset(path, HEAD_SIZE, end=True), limit))
+    comments.seek(max(align_offset(path, limit - TAIL_SIZE), comments.offset)).read(limit)
+    # Consumers are named once, when they are first seen before the window
+    consumers = ConsumerLog(path).read(first)
+
+    summary, log.summary = log.summary, comments.summary
+    log.summary.update(summary)
+    for kind, devices in comments.devices.items():
+        log.devices.setdefault(kind, {}).update(devices)
+    log.consumers.update(comments.consumers)
+    log.consumers.update(consumers.consumers)
+    return log.select(window)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import http.server
+import math
+from threading import Thread
+
+from common import *
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Values of the latest sample of every stream exposed as gauges: stream,
+# column, metric name, unit, labels and help
+SAMPLES = [
+    ("sar", 0, "sargraph_cpu_load_percent",                 "percent", {}, "CPU load"),
+    ("sar", 1, "sargraph_filesystem_used_percent",          "percent", {}, "Usage of the observed filesystem"),
+    ("sar", 2, "sargraph_network_received_mbps",            "mbps",    {}, "Data received by the observed interface"),
+    ("sar", 3, "sargraph_network_sent_mbps",                "mbps",    {}, "Data sent by the observed interface"),
+    ("sar", 4, "sargraph_gpu_load_percent",                 "percent", {}, "GPU load"),
+    ("sar", 5, "sargraph_gpu_memory_used_percent",          "percent", {}, "GPU memory used"),
+    ("psu", 0, "sargraph_memory_percent",                   "percent", {"state": "free"},      "Memory usage by state"),
+    ("psu", 1, "sargraph_memory_percent",                   "percent", {"state": "cached"},    "Memory usage by state"),
+    ("psu", 2, "sargraph_memory_percent",                   "percent", {"state": "used"},      "Memory usage by state"),
+    ("psu", 3, "sargraph_memory_percent",                   "percent", {"state": "shared"},    "Memory usage by state"),
+    ("psu", 4, "sargraph_memory_percent",                   "percent", {"state": "swap"},      "Memory usage by state"),
+    ("psu", 5, "sargraph_memory_percent",                   "percent", {"state": "dirty"},     "Memory usage by state"),
+    ("psu", 6, "sargraph_memory_percent",                   "percent", {"state": "writeback"}, "Memory usage by state"),
+    ("psu", 7, "sargraph_memory_percent",                   "percent", {"state": "slab"},      "Memory usage by state"),
+    ("psu", 8, "sargraph_memory_percent",                   "percent", {"state": "anonymous"}, "Memory usage by state"),
+    ("dio", 0, "sargraph_disk_read_mbytes_per_second",      "mbytes_per_second", {}, "Data read from the observed disk"),
+    ("dio", 1, "sargraph_disk_written_mbytes_per_second",   "mbytes_per_second", {}, "Data written to the observed disk"),
+    ("dio", 4, "sargraph_disk_wait_milliseconds",           "milliseconds", {}, "Average wait of the observed disk"),
+    ("dio", 5, "sargraph_disk_utilization_percent",         "percent", {}, "Utilization of the observed disk"),
+    ("psi", 0, "sargraph_pressure_avg10_percent",           "percent", {"resource": "cpu", "kind": "some"},    "Pressure stalls over the last 10 seconds"),
+    ("psi", 2, "sargraph_pressure_avg10_percent",           "percent", {"resource": "memory", "kind": "some"}, "Pressure stalls over the last 10 seconds"),
+    ("psi", 3, "sargraph_pressure_avg10_percent",           "percent", {"resource": "memory", "kind": "full"}, "Pressure stalls over the last 10 seconds"),
+    ("psi", 4, "sargraph_pressure_avg10_percent",           "percent", {"resource": "io", "kind": "some"},     "Pressure stalls over the last 10 seconds"),
+    ("psi", 5, "sargraph_pressure_avg10_percent",           "percent", {"resource": "io", "kind": "full"},     "Pressure stalls over the last 10 seconds"),
+    ("job", 0, "sargraph_job_cpu_load_percent",             "percent", {}, "CPU load of the command run in the session"),
+    ("job", 1, "sargraph_job_memory_mbytes",                "mbytes",  {}, "Memory used by the command run in the session"),
+    ("ovh", 0, "sargraph_watcher_cpu_load_percent",         "percent", {}, "CPU load of sargraph itself"),
+]
+
+
+# Return the metric families of the latest samples, given the latest line of
+# every stream by its name. Families are (name, type, unit, help, samples)
+# tuples, the samples are (labels, value) pairs.
+def sample_families(latest):
+    families = {}
+    for kind, column, name, unit, labels, help in SAMPLES:
+        if kind not in latest:
+            continue
+        _, line = latest[kind]
+        if column + 1 >= len(line):
+            continue
+        try:
+            value = stof(str(line[column + 1]))
+        except ValueError:
+            continue
+        family = families.setdefault(name, (name, "gauge", unit, help, []))
+        family[4].append((labels, value))
+
+    stamps = [({"stream": kind}, now.timestamp()) for kind, (now, _) in sorted(latest.items())]
+    families["sargraph_sample_timestamp_seconds"] = (
+        "sargraph_sample_timestamp_seconds", "gauge", "seconds", "Time of the latest sample of every stream", stamps
+    )
+    return list(families.values())
+
+
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Return metric families in the OpenMetrics text format, every sample gets the session label
+def exposition(session, families):
+    lines = []
+    for name, kind, unit, help, samples in families:
+        if not samples:
+            continue
+        lines.append(f"# TYPE {name} {kind}")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {escape(help)}")
+        suffix = "_total" if kind == "counter" else ""
+        for labels, value in samples:
+            labels = ",".join(f'{k}="{escape(v)}"' for k, v in {"session": session, **labels}.items())
+            lines.append(f"{name}{suffix}{{{labels}}} {format_value(value)}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+# Serves the metrics of a session over HTTP, every request on a thread of its
+# own, so that a stalled scraper does not hold up the others. The metrics are
+# gathered by `collect` from values that the sampling thread only ever
+# replaces, so serving them takes no locks and never delays sampling.
+class MetricsServer:
+    def __init__(self, address, session, collect):
+        host, port = address.rsplit(':', 1)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # A client that stops responding is dropped
+            timeout = 5
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exposition(session, collect()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
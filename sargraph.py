@@ -6,9 +6,18 @@
 #
 
 import argparse
+import importlib.util
+import json
+import select
+import signal
 import sys
 
+import collect
+import export
 import graph
+import live
+import segments
+import store
 import watch
 import warnings
 
@@ -18,48 +27,230 @@ from common import *
 parser = argparse.ArgumentParser()
 parser.add_argument('session', metavar='SESSION-NAME', type=str, nargs='?',                                       help='sargraph session name')
 parser.add_argument('command', metavar='COMMAND',      type=str, nargs='*',                                       help='send command')
-parser.add_argument('-f',      metavar='DEVICE-NAME',  type=str, nargs='?', default=None,      dest='fsdev',      help='observe a chosen filesystem')
-parser.add_argument('-m',      metavar='MOUNT-DIR',    type=str, nargs='?', default=None,      dest='fspath',     help='observe a chosen filesystem')
-parser.add_argument('-n',      metavar='IFACE-NAME',   type=str, nargs='?', default=None,      dest='iface',      help='observe chosen network iface')
+parser.add_argument('-f',      metavar='DEVICE-NAME',  type=str, action='append', default=[], dest='fsdev',      help='observe chosen filesystems by device, or all of them')
+parser.add_argument('-m',      metavar='MOUNT-DIR',    type=str, action='append', default=[], dest='fspath',     help='observe chosen filesystems by mount point')
+parser.add_argument('-n',      metavar='IFACE-NAME',   type=str, action='append', default=[], dest='iface',      help='observe chosen network ifaces, or all of them')
 parser.add_argument('-o',      metavar='OUTPUT-NAME',  type=str, nargs='?', default='data',    dest='name',       help='set output base names')
 parser.add_argument('-t',      metavar='TMPFS-COLOR',  type=str, nargs='?', default='#f2c71b', dest='tmpfs',      help='set tmpfs plot color' )
 parser.add_argument('-c',      metavar='CACHE-COLOR',  type=str, nargs='?', default='#ee7af0', dest='cache',      help='set cache plot color' )
 parser.add_argument('-u',      metavar='UDP',          type=str, nargs='?', default=None,      dest='udp',        help='set udp server address')
 parser.add_argument('-C',      metavar='UDP_COOKIE',   type=str, nargs='?', default=None,      dest='udp_cookie', help='set udp message cookie')
 parser.add_argument('-p',      action='store_true',                                            dest='psutil',     help='use psutil instead of sar')
-args = parser.parse_args()
+parser.add_argument('-P',      action='store_true',                                            dest='proc',       help='read /proc directly instead of running sar')
+parser.add_argument('-b',      action='store_true',                                            dest='binary',     help='also keep a binary sample store')
+parser.add_argument('-i',      metavar='INTERVAL',     type=float, nargs='?', default=1.0,     dest='interval',   help='set cpu, disk and network sampling interval in seconds')
+parser.add_argument('-M',      metavar='MEM-INTERVAL', type=float, nargs='?', default=0.1,     dest='mem_interval', help='set memory sampling interval in seconds')
+parser.add_argument('-A',      action='store_true',                                            dest='cpu_detail', help='record per-core cpu load and cpu time breakdown')
+parser.add_argument('-O',      action='store_true',                                            dest='overhead',   help='record resources used by sargraph itself')
+parser.add_argument('-T',      metavar='TOP-COUNT',    type=int, nargs='?', default=0, const=5, dest='top',        help='record the top processes by cpu load and memory usage')
+parser.add_argument('-I',      metavar='TOP-INTERVAL', type=float, nargs='?', default=5.0,     dest='top_interval', help='set the top processes sampling interval in seconds')
+parser.add_argument('-G',      action='store_true',                                            dest='top_cgroups', help='record the top cgroups instead of processes')
+parser.add_argument('-S',      metavar='CGROUP',       type=str, nargs='?', default=None, const='', dest='pressure', help='record pressure stalls of the system, or of a cgroup')
+parser.add_argument('-E',      metavar='EXPORTER',     type=str, default=None,                 dest='exporter',   help='serve metrics in the OpenMetrics format on an address, e.g. localhost:9469')
+parser.add_argument('-z',      metavar='COMPRESSION',  type=str, nargs='?', default=None, const='gzip', choices=['gzip', 'zstd'], dest='compression', help='compress the log with gzip or zstd')
+parser.add_argument('-R',      metavar='SEGMENT',      type=str, default=None,                 dest='segment',    help='split the log into segments of a size (e.g. 256M) or a period (e.g. 6h)')
+parser.add_argument('--from',  metavar='START',        type=str, default=None,                 dest='window_from', help='plot from a timestamp or a label, e.g. label:3')
+parser.add_argument('--to',    metavar='END',          type=str, default=None,                 dest='window_to',  help='plot up to a timestamp or a label, e.g. label:4')
+parser.add_argument('--align', metavar='LABEL',        type=str, default=None,                 dest='align',      help='align compared sessions on a label instead of their start')
+parser.add_argument('-r',      metavar='RESOLUTION',   type=int, nargs='?', default=1200,      dest='resolution', help='set max plotted samples per series, 0 plots all')
 
-def send(session: str, message: str):
+# Everything after "--" is a command for "run"
+argv = sys.argv[1:]
+run_argv = []
+if "--" in argv:
+    split = argv.index("--")
+    argv, run_argv = argv[:split], argv[split + 1:]
+args = parser.parse_args(argv)
+
+if args.interval <= 0 or args.mem_interval <= 0 or args.top_interval <= 0:
+    fail("Sampling intervals have to be positive")
+
+if args.top < 0:
+    fail("The number of top processes cannot be negative")
+
+# Processes are grouped by the unified hierarchy
+if args.top_cgroups:
+    if not file_exists("/sys/fs/cgroup/cgroup.controllers"):
+        fail("Recording the top cgroups requires cgroup v2")
+    args.top = args.top or 5
+
+# Pressure stalls of a cgroup are read from its directory in the unified hierarchy
+if args.pressure:
+    if not args.pressure.startswith("/sys/"):
+        args.pressure = os.path.join("/sys/fs/cgroup", args.pressure.lstrip("/"))
+    if not file_exists(os.path.join(args.pressure, "memory.pressure")):
+        fail(f"'{args.pressure}' is not a cgroup with pressure stall information")
+elif args.pressure is not None and not file_exists("/proc/pressure/memory"):
+    fail("Recording pressure stalls requires a kernel with PSI enabled")
+
+# Metrics are served on a TCP port of a given host
+if args.exporter is not None:
+    _, colon, port = args.exporter.rpartition(':')
+    if not colon or not port.isdigit() or int(port) > 65535:
+        fail(f"Invalid metrics exporter address: '{args.exporter}', expected HOST:PORT")
+
+# Plots can be limited to a time window, between timestamps or labels
+window_bounds = (args.window_from, args.window_to)
+
+# The log is rotated either by size or by time
+args.segment_size = args.segment_period = None
+if args.segment is not None:
+    try:
+        args.segment_size, args.segment_period = segments.parse_rotation(args.segment)
+    except ValueError as e:
+        fail(e)
+
+if args.compression == 'zstd' and importlib.util.find_spec("zstandard") is None:
+    fail("zstd compression requires the 'zstandard' package")
+
+# sar is used unless another backend was chosen
+uses_sar = not (is_darwin() or args.psutil or args.proc or is_windows())
+
+# sar only takes whole seconds
+if uses_sar and not args.interval.is_integer():
+    fail("sar supports only whole-second intervals, use -p or -P for shorter ones")
+
+# Send a message and yield the replies to it, up to the final one with the
+# "ok" or "error" status
+def request(session: str, message: str):
     socket_path = watch.get_socket_path(session)
     if not file_exists(socket_path):
         fail(f"Session '{session}' does not exist")
 
     sock = watch.get_socket()
-    sock.connect(socket_path)
-    sock.send(message.encode("utf-8"))
-    sock.close()
+    try:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            fail(f"Session '{session}' does not respond")
+        watch.send_message(sock, message)
+        reader = watch.MessageReader(sock)
+        while True:
+            reply = reader.receive()
+            if reply is None:
+                fail(f"Session '{session}' has exited")
+            reply = json.loads(reply)
+            yield reply
+            if reply["status"] in ("ok", "error"):
+                break
+    finally:
+        sock.close()
+
+# Send a message and return the final reply, fail if it is an error
+def send(session: str, message: str):
+    for reply in request(session, message):
+        pass
+    if reply["status"] == "error":
+        fail(reply["error"])
+    return reply
+
+# Start a watcher process of a session with given flags
+def start_session(session: str, flags):
+    socket_path = watch.get_socket_path(session)
+    if file_exists(socket_path):
+        fail("Session with this name already exists")
+
+    # The watcher writes to the pipe once it accepts commands or why it could
+    # not start, the pipe gets closed without that if it fails otherwise
+    ready, notify = os.pipe()
+    p = subprocess.Popen(
+        args=[sys.executable, os.path.realpath(__file__), session, *flags],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True, pass_fds=[notify], env=dict(os.environ, SARGRAPH_READY_FD=str(notify))
+    )
+    os.close(notify)
+
+    rlist, _, _ = select.select([ready], [], [], 10)
+    status = os.read(ready, 4096).decode("utf-8", errors="replace") if rlist else ""
+    os.close(ready)
+    if status == "ready":
+        print(f"Session '{session}' started")
+        return
+    if status.startswith("error:"):
+        fail(status[len("error:"):])
+
+    fail("Session did not start")
+
+# Stop a session, it saves a plot to a given file unless it is "none". Return
+# once the session is closed.
+def stop_session(session: str, output: str = ""):
+    print(f"Terminating sargraph session '{session}'")
+    reply = send(session, f"command:q:{output}")
+    if reply.get("output"):
+        print(f"Graph saved to '{reply['output']}'")
+    print(f"Session '{session}' killed")
+
+# Run a command in a new session that follows its process tree, stop the
+# session when the command exits and return its exit code
+def run_command(session: str, flags, command):
+    start_session(session, flags)
+    name = os.path.basename(command[0])
+    send(session, f"label:{name} started")
+    try:
+        p = subprocess.Popen(command)
+    except OSError as e:
+        stop_session(session, "none")
+        fail(f"Cannot run '{command[0]}': {e.strerror}")
+
+    # Messages are single lines
+    cmdline = " ".join(subprocess.list2cmdline(command).split())
+    send(session, f"command:j:{p.pid} {cmdline}")
+
+    # Interrupting the command still stops the session and saves the plot
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(os, "wait4"):
+        # The resource usage covers all the descendants the command waited for
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = code = os.waitstatus_to_exitcode(status)
+        totals = [
+            usage.ru_utime + usage.ru_stime,
+            usage.ru_inblock * 512, # blocks are always 512 bytes long
+            usage.ru_oublock * 512,
+            usage.ru_nvcsw + usage.ru_nivcsw
+        ]
+    else:
+        code = p.wait()
+        totals = []
+
+    send(session, f"label:{name} exited ({code})")
+    send(session, " ".join([f"command:e:{code}"] + [str(v) for v in totals]))
+    stop_session(session)
+    return code
+
+# Split lists of names given as separate flags or separated with commas
+def split_names(values):
+    return [name for value in values for name in value.split(",") if name]
+
+# Return the device mounted on a given directory
+def find_device(fspath):
+    fspath = os.path.realpath(fspath)
+    with open("/proc/self/mounts", "r") as f:
+        for line in f:
+            device = scan(f"^(/dev/\\S+)\\s+{re.escape(fspath)}\\s+", str, line)
+            if device:
+                return device
+    fail(f"No device is mounted on {fspath}")
 
 def create_session():
-    # Find requested disk device
-    if args.fspath:
-        args.fspath = os.path.realpath(args.fspath)
-        with open("/proc/self/mounts", "r") as f:
-            while args.fsdev is None:
-                args.fsdev = scan(f"^(/dev/\\S+)\\s+{re.escape(args.fspath)}\\s+", str, f.readline())
-        if not args.fsdev:
-            fail(f"No device is mounted on {args.fspath}")
+    # Find requested disk devices
+    args.fsdev = split_names(args.fsdev)
+    args.fsdev.extend(find_device(fspath) for fspath in split_names(args.fspath))
+    args.iface = split_names(args.iface)
 
     params = (args.session, args.fsdev, args.iface, args.tmpfs, args.cache, args.udp, args.udp_cookie)
+    options = dict(binary=args.binary, resolution=args.resolution, mem_interval=args.mem_interval, overhead=args.overhead, cpu_detail=args.cpu_detail, top=args.top, top_interval=args.top_interval, top_cgroups=args.top_cgroups, compression=args.compression, segment_size=args.segment_size, segment_period=args.segment_period, pressure=args.pressure, exporter=args.exporter)
     if is_darwin() or args.psutil or is_windows():
-        watcher = watch.PsUtilWatcher(*params)
+        watcher = watch.PsUtilWatcher(*params, interval=args.interval, **options)
+    elif args.proc:
+        watcher = watch.ProcWatcher(*params, interval=args.interval, **options)
     else:
-        watcher = watch.SarWatcher(*params)
+        watcher = watch.SarWatcher(*params, interval=int(args.interval), **options)
 
     watcher.start()
     sys.exit(0)
 
 # Check if sar is available
-if not (is_darwin() or is_windows()):
+if uses_sar:
     p = run_or_fail("sar", "-V", stdout=subprocess.PIPE)
 
 if args.name != "data":
@@ -75,39 +266,26 @@ if len(args.command) == 0:
         create_session()
 
 if args.command[0] == "start":
-    socket_path = watch.get_socket_path(args.session)
-    if file_exists(socket_path):
-        fail("Session with this name already exists")
-    
-    # Start watcher process
-    p = subprocess.Popen(
-        args=[sys.executable, os.path.realpath(__file__), args.session, *sys.argv[3:]],
-        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-        start_new_session=True
-    )
-
-    # Spinloop to see whether the subprocess even starts
-    if spinloop(lambda: file_exists(socket_path), 0.1, 10):
-        print(f"Session '{args.session}' started")
-        sys.exit(0)
-    
-    fail("Session did not start")
+    start_session(args.session, sys.argv[3:])
+    sys.exit(0)
 
 elif args.command[0] == "stop":
-    socket_path = watch.get_socket_path(args.session)
-    
-    print(f"Terminating sargraph session '{args.session}'")
     if len(args.command) < 2:
-        send(args.session, "command:q:")
+        stop_session(args.session)
     else:
-        send(args.session, f"command:q:{args.command[1]}")
+        stop_session(args.session, args.command[1])
+    sys.exit(0)
 
-    # Spinloop to see whether the subprocess even dies
-    if spinloop(lambda: not file_exists(socket_path), 0.5, 10):
-        print(f"Session '{args.session}' killed")
-        sys.exit(0)
+elif args.command[0] == "run":
+    # Flags of the session go before the command, optionally separated with "--"
+    command = run_argv or args.command[1:]
+    if not command:
+        fail("run command requires a command to run")
+    flags = sys.argv[3:len(sys.argv) - len(command) - int(bool(run_argv))]
 
-    fail("Session did not respond")
+    code = run_command(args.session, flags, command)
+    # Negative codes are signals, report them like shells do
+    sys.exit(code if code >= 0 else 128 - code)
 
 
 elif args.command[0] == "label":
@@ -121,15 +299,113 @@ elif args.command[0] == "label":
 
 elif args.command[0] == 'save':
     print(f"Saving graph from session '{args.session}'.")
-    if len(args.command) < 2:
-        send(args.session, "command:s:")
-    else:
-        send(args.session, f"command:s:{args.command[1]}")
+    message = "command:s:"
+    # A window is sent before the output name, an unset bound is "*"
+    if window_bounds != (None, None):
+        message += "\t".join(b or "*" for b in window_bounds) + "\t"
+    if len(args.command) >= 2:
+        message += args.command[1]
+
+    # The plot is rendered in the background, wait until it is finished
+    for reply in request(args.session, message):
+        if reply["status"] == "pending":
+            print(f"Rendering job {reply['job']} started")
+        elif reply["status"] == "ok":
+            print(f"Graph saved to '{reply['output']}'")
+        else:
+            fail(reply["error"])
+
+elif args.command[0] in ('watch', 'tail'):
+    # New log lines are sent by the session, the log file is not read
+    dashboard = live.Dashboard(args.session) if args.command[0] == 'watch' else None
+    try:
+        for reply in request(args.session, "command:w:"):
+            if reply["status"] != "line":
+                print(f"Session '{args.session}' has finished")
+            elif dashboard is None:
+                print(reply["line"], flush=True)
+            else:
+                dashboard.update(reply["line"])
+                dashboard.draw()
+    except KeyboardInterrupt:
+        pass
+
+elif args.command[0] == 'status':
+    # Aggregates are kept by the session, the log file is not read
+    for key, value in send(args.session, "command:i:").items():
+        if key != "status":
+            print(f"{key}: {value}")
 
 elif args.command[0] == 'plot':
+    window = None
+    if window_bounds != (None, None):
+        try:
+            window = store.find_window(args.session, window_bounds)
+        except ValueError as e:
+            fail(e)
     if len(args.command) < 2:
-        graph.graph(args.session, args.tmpfs, args.cache)
+        graph.graph(args.session, args.tmpfs, args.cache, resolution=args.resolution, window=window)
     else:
-        graph.graph(args.session, args.tmpfs, args.cache, args.command[1])
+        graph.graph(args.session, args.tmpfs, args.cache, args.command[1], resolution=args.resolution, window=window)
+
+elif args.command[0] == 'collect':
+    if len(args.command) < 2:
+        fail("collect command requires an address to listen on, e.g. 0.0.0.0:9999")
+
+    try:
+        collector = collect.Collector(args.session, args.command[1])
+    except (OSError, ValueError) as e:
+        fail(f"Cannot listen on '{args.command[1]}': {e}")
+    print(f"Collecting fleet '{args.session}' on {args.command[1]}")
+    collector.run()
+
+elif args.command[0] == 'fleet':
+    fname = args.command[1] if len(args.command) > 1 else 'fleet'
+    layout = args.command[2] if len(args.command) > 2 else 'overlay'
+    if layout not in ('overlay', 'tile'):
+        fail(f"unknown fleet layout '{layout}', use 'overlay' or 'tile'")
+    graph.fleet_graph(args.session, fname, layout, resolution=args.resolution)
+
+elif args.command[0] == 'compare':
+    # The plot is saved to the last argument if it names a png or svg file
+    sessions = [args.session] + args.command[1:]
+    fname = 'compare'
+    if len(sessions) > 2 and sessions[-1].lower().endswith(('.png', '.svg')):
+        fname = sessions.pop()
+    if len(sessions) < 2:
+        fail("compare command requires at least one more session, e.g. 'before compare after'")
+    for session in sessions:
+        if not file_exists(segments.log_path(session)):
+            fail(f"Log of session '{session}' does not exist")
+
+    try:
+        summaries = graph.compare_graph(sessions, fname, args.align, resolution=args.resolution)
+    except ValueError as e:
+        fail(e)
+    for line in graph.compare_table(sessions, summaries):
+        print(line)
+    print(f"Comparison saved to '{graph.output_path(fname)}'")
+
+elif args.command[0] == 'export':
+    if len(args.command) < 2:
+        fail("export command requires an output file, e.g. out.parquet, out.arrow, out.csv or out.jsonl")
+    if not file_exists(segments.log_path(args.session)):
+        fail(f"Log of session '{args.session}' does not exist")
+    if args.command[1].endswith(('.parquet', '.arrow')) and importlib.util.find_spec("pyarrow") is None:
+        fail("Parquet and Arrow export requires the 'pyarrow' package")
+
+    try:
+        tables = export.export(args.session, args.command[1])
+    except ValueError as e:
+        fail(e)
+    for table in tables:
+        print(f"Table '{table.name}' of session '{args.session}' saved to '{table.path}' ({table.rows} rows)")
+
+elif args.command[0] == 'convert':
+    if not file_exists(segments.log_path(args.session)):
+        fail(f"Log of session '{args.session}' does not exist")
+
+    path = store.convert(args.session)
+    print(f"Binary store of session '{args.session}' saved to '{path}'")
 else:
     fail(f"unknown command '{args.command[0]}'")
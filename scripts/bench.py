@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+# Benchmark of parsing, plotting and logging of long sessions. Synthetic
+# session logs are generated in a temporary directory, every stage is timed
+# and its throughput and peak memory usage are reported. Results can be saved
+# and compared with a previous run to spot regressions.
+
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from common import *
+
+# Number of samples generated at once
+GENERATE_CHUNK = 1 << 16
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+FORMATS = ["png", "svg", "ascii", "html"]
+
+
+# Convert a duration like "90s", "12h" or "2w" to seconds
+def parse_duration(s):
+    unit = s[-1] if s[-1] in DURATION_UNITS else "s"
+    return float(s.rstrip("".join(DURATION_UNITS))) * DURATION_UNITS[unit]
+
+
+# Return log timestamps of samples taken every `interval` seconds
+def timestamps(start, first, count, interval, unit):
+    offsets = (np.arange(first, first + count) * interval * 1e6).astype("timedelta64[us]")
+    stamps = np.datetime_as_string(start + offsets, unit=unit)
+    return [s.replace("T", "-") for s in stamps]
+
+
+# Write a synthetic session log, return the number of data lines
+def generate(path, duration, interval, mem_interval, gpu, labels):
+    start = np.datetime64("2026-01-01T00:00:00")
+    rng = np.random.default_rng(0)
+    sar_count = int(duration / interval)
+    psu_count = int(duration / mem_interval)
+
+    header = [
+        f"# sargraph version: {SARGRAPH_VERSION}",
+        "pid: 1",
+        "machine: Linux 6.1.0",
+        "cpu count: 8",
+        "cpu: synthetic",
+        f"interval: {interval} s",
+        f"memory interval: {mem_interval} s"
+    ]
+    if gpu:
+        header.extend(["gpu: synthetic", "gpu driver: 1.0"])
+
+    # Labels are spread evenly over the session
+    label_samples = [i * sar_count // labels for i in range(labels)]
+    with open(path, "w") as f:
+        print(", ".join(header), file=f)
+
+        # Interleave both streams chunk by chunk, as the watcher does
+        ratio = psu_count / max(sar_count, 1)
+        for first in range(0, sar_count, GENERATE_CHUNK):
+            count = min(GENERATE_CHUNK, sar_count - first)
+            values = rng.uniform(0, 100, (count, 6 if gpu else 4))
+            lines = [
+                "sar " + stamp + " " + " ".join(f"{v:.2f}" for v in row)
+                for stamp, row in zip(timestamps(start, first, count, interval, "s"), values)
+            ]
+
+            psu_first = int(first * ratio)
+            psu_chunk = int((first + count) * ratio) - psu_first
+            free = rng.uniform(0, 50, psu_chunk)
+            cached = rng.uniform(0, 25, psu_chunk)
+            lines.extend(
+                f"psu {stamp} {fr:.2f} {ca:.2f} {100 - fr - ca:.2f} {ca / 10:.2f}"
+                for stamp, fr, ca in zip(timestamps(start, psu_first, psu_chunk, mem_interval, "us"), free, cached)
+            )
+
+            for i, sample in enumerate(label_samples):
+                if first <= sample < first + count:
+                    stamp = timestamps(start, sample, 1, interval, "s")[0]
+                    lines.append(f"# {stamp} label: label {i}")
+            f.write("\n".join(lines) + "\n")
+
+        summary = [
+            f"# total ram: {16 << 30:.2f} B",
+            f"total disk space: {512 << 30:.2f} B",
+            f"max ram used: {12 << 30:.2f} B",
+            f"max disk used: {300 << 30:.2f} B",
+            "average load: 50.00 %",
+            "observed disk: /dev/sda1",
+            "max received: 100.00 Mb/s",
+            "max sent: 100.00 Mb/s",
+            "observed network: eth0",
+            f"duration: {duration} seconds",
+            "total received: 0 b",
+            "total sent: 0 b",
+            "missed ticks: 0"
+        ]
+        if gpu:
+            summary.extend([
+                f"total gpu ram: {8 << 30:.2f} B",
+                f"max gpu ram used: {6 << 30:.2f} B",
+                "average gpu load: 50.00 %"
+            ])
+        print(", ".join(summary), file=f)
+
+    return sar_count + psu_count
+
+
+# Reset the peak memory usage counter, return False if it is not supported
+def reset_peak_memory():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# Return the peak memory usage in bytes, since the last reset if supported
+def peak_memory():
+    try:
+        with open("/proc/self/status") as f:
+            return scan(r"VmHWM:\s+(\d+)", int, f.read()) * 1024
+    except OSError:
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if is_darwin() else peak * 1024
+
+
+# Time a function, return its result and a result entry
+def measure(name, function, amount=None, unit=None):
+    reset_peak_memory()
+    start = time.perf_counter()
+    try:
+        result = function()
+        error = None
+    except (Exception, SystemExit) as e:
+        result = None
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+
+    entry = {"stage": name, "seconds": seconds, "peak memory": peak_memory()}
+    if error is not None:
+        entry["error"] = error
+    elif amount is not None:
+        entry["throughput"] = amount / seconds
+        entry["unit"] = unit
+    return result, entry
+
+
+# Log samples through the watcher as it does while running
+def write_samples(session, count, binary):
+    import watch
+
+    watcher = watch.ProcWatcher(session, None, None, "#f2c71b", "#ee7af0", binary=binary)
+    now = datetime.datetime.now()
+    stamp = now.strftime("%Y-%m-%d-%H:%M:%S")
+    for i in range(count):
+        watcher.log_sample("sar", now, [stamp, "12.50", "40.00", i / 128, 0.5])
+    watcher.writer.close()
+    if watcher.store is not None:
+        watcher.store.close()
+
+
+def run(args):
+    results = []
+    for gpu in ([False, True] if args.gpu == "both" else [args.gpu == "yes"]):
+        session = "bench-gpu" if gpu else "bench"
+        lines = generate(f"{session}.txt", args.duration, args.interval, args.mem_interval, gpu, args.labels)
+        size = os.path.getsize(f"{session}.txt")
+        print(f"Generated '{session}.txt': {lines} lines, {unit_str(size, DATA_UNITS)}")
+
+        # Modules are imported after the logs are generated, graph requires gnuplot
+        import graph
+        import store
+
+        def stage(name, function, amount=None, unit=None):
+            result, entry = measure(name, function, amount, unit)
+            entry["session"] = session
+            results.append(entry)
+            report(entry)
+            return result
+
+        # Sessions are loaded the way graph loads them, a new process starts
+        # without previously parsed logs
+        store.parsed_logs.clear()
+        log = stage("parse log", lambda: store.load_session(session), size / (1 << 20), "MB/s")
+        stage("read comments", lambda: graph.read_comments(log))
+        os.makedirs("plot-data", exist_ok=True)
+        stage("write plot data", lambda: graph.write_plot_data(log, "plot-data", args.resolution), lines, "lines/s")
+        stage("convert to store", lambda: store.convert(session), size / (1 << 20), "MB/s")
+        stage("load store", lambda: store.load_session(session))
+        for fmt in args.formats:
+            stage(f"graph {fmt}", lambda: graph.graph(session, "#f2c71b", "#ee7af0", f"{session}.{fmt}", resolution=args.resolution))
+        shutil.rmtree(store.store_path(session), ignore_errors=True)
+
+    for binary in [False, True]:
+        name = "write samples" + (" with store" if binary else "")
+        _, entry = measure(name, lambda: write_samples("bench-write", args.writes, binary), args.writes, "lines/s")
+        entry["session"] = "bench-write"
+        results.append(entry)
+        report(entry)
+        shutil.rmtree("bench-write.store", ignore_errors=True)
+    return results
+
+
+def report(entry):
+    line = f"{entry['session']:12} {entry['stage']:20} {entry['seconds']:9.3f} s {unit_str(entry['peak memory'], DATA_UNITS):>10}"
+    if "error" in entry:
+        line += f"  failed: {entry['error']}"
+    elif "throughput" in entry:
+        line += f"  {entry['throughput']:12.1f} {entry['unit']}"
+    print(line, flush=True)
+
+
+# Print stages that got slower or use more memory than in a previous run
+def compare(results, baseline, tolerance):
+    previous = {(e["session"], e["stage"]): e for e in baseline}
+    regressions = 0
+    for entry in results:
+        old = previous.get((entry["session"], entry["stage"]))
+        if old is None or "error" in old or "error" in entry:
+            continue
+        for key in ["seconds", "peak memory"]:
+            if old[key] > 0 and entry[key] > old[key] * (1 + tolerance):
+                print(f"Regression: {entry['session']} {entry['stage']} {key}: {old[key]:.3f} -> {entry[key]:.3f}")
+                regressions += 1
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Benchmark sargraph on synthetic sessions")
+parser.add_argument('-d', metavar='DURATION',     type=parse_duration, default="1h",  dest='duration',     help='session length, e.g. 12h, 3d or 2w')
+parser.add_argument('-i', metavar='INTERVAL',     type=float,          default=1.0,   dest='interval',     help='cpu, disk and network sampling interval in seconds')
+parser.add_argument('-M', metavar='MEM-INTERVAL', type=float,          default=0.1,   dest='mem_interval', help='memory sampling interval in seconds')
+parser.add_argument('-g', metavar='GPU',          choices=["yes", "no", "both"], default="both", dest='gpu', help='generate sessions with GPU columns')
+parser.add_argument('-l', metavar='LABELS',       type=int,            default=100,   dest='labels',       help='number of labels in a session')
+parser.add_argument('-f', metavar='FORMATS',      type=lambda s: s.split(','), default=FORMATS, dest='formats', help='comma-separated plot formats')
+parser.add_argument('-r', metavar='RESOLUTION',   type=int,            default=1200,  dest='resolution',   help='max plotted samples per series, 0 plots all')
+parser.add_argument('-w', metavar='WRITES',       type=int,            default=100000, dest='writes',      help='number of samples logged through the watcher')
+parser.add_argument('-o', metavar='OUTPUT',       type=str,            default=None,  dest='output',       help='save results to a JSON file')
+parser.add_argument('-c', metavar='BASELINE',     type=str,            default=None,  dest='baseline',     help='compare results with a saved JSON file')
+parser.add_argument('-t', metavar='TOLERANCE',    type=float,          default=0.2,   dest='tolerance',    help='allowed relative slowdown when comparing')
+parser.add_argument('-k', action='store_true',                                        dest='keep',         help='keep the generated files')
+args = parser.parse_args()
+
+for path in ["output", "baseline"]:
+    if getattr(args, path):
+        setattr(args, path, os.path.realpath(getattr(args, path)))
+
+work_dir = tempfile.mkdtemp(prefix="sargraph-bench-")
+os.chdir(work_dir)
+try:
+    results = run(args)
+finally:
+    os.chdir("/")
+    if args.keep:
+        print(f"Generated files kept in '{work_dir}'")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+if args.baseline:
+    with open(args.baseline) as f:
+        if compare(results, json.load(f), args.tolerance):
+            sys.exit(1)
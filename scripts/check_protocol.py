@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+# Checks of the framing of messages on the control socket of a session. Exits
+# with a non-zero code and prints the failed check if any of them fails.
+
+
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import watch
+
+
+def frame(message):
+    data = message.encode("utf-8")
+    return watch.FRAME_HEADER.pack(len(data)) + data
+
+
+def check(name, result, expected):
+    if result != expected:
+        print(f"Failed: {name}: got {result!r}, expected {expected!r}")
+        sys.exit(1)
+    print(f"Passed: {name}")
+
+
+# A frame split across reads is returned once it is complete
+frames = watch.FrameBuffer()
+data = frame("split message")
+check("first part of a frame", frames.feed(data[:3]), [])
+check("middle part of a frame", frames.feed(data[3:7]), [])
+check("last part of a frame", frames.feed(data[7:]), ["split message"])
+
+# Frames received at once are all returned, and so is a frame that follows
+# them in parts
+data = frame("first") + frame("second") + frame("third")
+check("frames in one read", frames.feed(data[:-2]), ["first", "second"])
+check("rest of a frame after others", frames.feed(data[-2:]), ["third"])
+
+# Frames longer than the limit end the connection
+frames = watch.FrameBuffer(watch.MAX_FRAME)
+check("oversized frame", frames.feed(watch.FRAME_HEADER.pack(watch.MAX_FRAME + 1)), None)
+
+# The blocking reader keeps messages that came together with the previous one
+sender, receiver = socket.socketpair()
+watch.send_message(sender, "one")
+watch.send_message(sender, "two")
+sender.close()
+reader = watch.MessageReader(receiver)
+check("messages sent together", [reader.receive(), reader.receive(), reader.receive()], ["one", "two", None])
+receiver.close()
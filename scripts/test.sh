@@ -3,3 +3,7 @@
 set -e
 
 tuttest README.md | grep -v '^\$' | bash -
+./scripts/check_protocol.py
+
+# The README session with one-second segments has to have more than one
+test "$(wc -l < rotated.segments/manifest.txt)" -gt 1
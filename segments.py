@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import datetime
+import gzip
+import os
+import re
+import time
+import zlib
+
+# File that lists the segments of a session log in order, with their start times
+MANIFEST = "manifest.txt"
+
+# File name suffixes of the segments, by compression
+SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# Compressed segments are written in members of at most this many bytes of
+# text, or of the text gathered in this many seconds, whichever comes first.
+# Every member can be decompressed on its own, so the log stays readable
+# while it is written.
+MEMBER_SIZE = 1 << 18
+MEMBER_DELAY = 10.0
+
+# Units of the segment sizes and periods given with -R
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+PERIOD_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+# Return the directory with the log segments of a session
+def segments_path(session):
+    return f"{session}.segments"
+
+
+# Return the log of a session, the directory of its segments if it was
+# written in segments and '{session}.txt' otherwise
+def log_path(session):
+    path = segments_path(session)
+    return path if os.path.isdir(path) else f"{session}.txt"
+
+
+# Return the names and start times of the segments of a log, the last line
+# of the manifest is ignored until it is complete
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST), "r") as f:
+            lines = f.read().split("\n")[:-1]
+    except FileNotFoundError:
+        return []
+    return [tuple(line.split(" ", 1)) for line in lines if line]
+
+
+# Return the size of a log in bytes, summed over all its segments
+def log_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name, _ in read_manifest(path))
+
+
+# Return the compression of a segment from its name
+def compression_of(name):
+    for compression, suffix in SUFFIXES.items():
+        if compression is not None and name.endswith(suffix):
+            return compression
+    return None
+
+
+# Parse a segment size like "512M" or a period like "6h", return a tuple of
+# the size in bytes and the period in seconds, one of them is None
+def parse_rotation(value):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMG]?|[smhd])", value.strip())
+    if match is None:
+        raise ValueError(f"invalid segment size or period: '{value}'")
+    number, unit = float(match[1]), match[2]
+    if number <= 0:
+        raise ValueError(f"invalid segment size or period: '{value}'")
+    if unit in PERIOD_UNITS:
+        return None, number * PERIOD_UNITS[unit]
+    return int(number * SIZE_UNITS[unit]), None
+
+
+def compress(compression, data):
+    if compression == "gzip":
+        return gzip.compress(data, mtime=0)
+    import zstandard
+    return zstandard.ZstdCompressor().compress(data)
+
+
+# Return a decompressor of a single gzip member or zstd frame
+def decompressor(compression):
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# Read compressed members from a file, at most `available` bytes of them.
+# Yield the text of every complete member and the number of bytes it took,
+# a member that is still being written is left for the next read.
+def read_members(f, available, compression, block_size):
+    data = b""
+    member = decompressor(compression)
+    text = []
+    size = 0
+    while True:
+        if not data:
+            data = f.read(min(block_size, available)) if available > 0 else b""
+            if not data:
+                return
+            available -= len(data)
+        text.append(member.decompress(data))
+        if not member.eof:
+            size += len(data)
+            data = b""
+            continue
+
+        rest = member.unused_data
+        yield b"".join(text).decode("utf-8", errors="replace"), size + len(data) - len(rest)
+        data = rest
+        member = decompressor(compression)
+        text = []
+        size = 0
+
+
+# Append-only session log written in segments, optionally compressed. A new
+# segment is started once the current one reaches `max_size` bytes or gets
+# older than `max_age` seconds. Segments are only ever added at the end of
+# the manifest, so the log can be read while it is written.
+class SegmentWriter:
+    def __init__(self, path, compression=None, max_size=None, max_age=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compression = compression
+        self.max_size = max_size
+        self.max_age = max_age
+
+        # Text gathered for the next compressed member
+        self.pending = []
+        self.pending_size = 0
+        self.last_member = time.monotonic()
+
+        # A continued session gets a new segment after the existing ones
+        self.index = len(read_manifest(path))
+        self.file = None
+        self.open_segment()
+
+    def open_segment(self):
+        if self.file is not None:
+            self.file.close()
+        name = f"{self.index:05d}.txt{SUFFIXES[self.compression]}"
+        self.file = open(os.path.join(self.path, name), "ab")
+        self.started = time.monotonic()
+        self.index += 1
+
+        # The segment is listed only once it exists
+        with open(os.path.join(self.path, MANIFEST), "a") as f:
+            f.write(f"{name} {datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')}\n")
+
+    def write(self, text):
+        if self.compression is None:
+            self.file.write(text.encode())
+            self.file.flush()
+            self.rotate()
+            return
+
+        # The segment is closed with the member, so that it ends on time
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= MEMBER_SIZE or time.monotonic() - self.last_member >= MEMBER_DELAY or self.expired():
+            self.flush()
+
+    # Write out the gathered text as a complete member
+    def flush(self):
+        self.last_member = time.monotonic()
+        if not self.pending:
+            return
+        data = "".join(self.pending).encode()
+        self.pending = []
+        self.pending_size = 0
+        self.file.write(compress(self.compression, data))
+        self.file.flush()
+        self.rotate()
+
+    # Return whether the current segment is old enough to be replaced
+    def expired(self):
+        return self.max_age is not None and time.monotonic() - self.started >= self.max_age
+
+    # Start a new segment if the current one is full or old enough
+    def rotate(self):
+        if self.max_size is not None and self.file.tell() >= self.max_size:
+            self.open_segment()
+        elif self.expired():
+            self.open_segment()
+
+    def close(self):
+        self.flush()
+        self.file.close()
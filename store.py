@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+#
+# (c) 2019-2026 Antmicro <www.antmicro.com>
+# License: Apache-2.0
+#
+
+
+import datetime
+import os
+import shutil
+import struct
+from threading import Lock
+
+import numpy as np
+
+from common import *
+from loader import SessionLog, bound_time, crop, is_label_bound, load_window, read_labels
+from loader import load_session as load_text_session
+from segments import log_path, log_size
+
+# Every stream file starts with a magic and the number of value columns
+STORE_MAGIC = b"SGB1"
+HEADER = struct.Struct("<4sI")
+
+# Timestamps are wall-clock times, like in the text log
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# Return the directory with the binary store of a session
+def store_path(session):
+    return f"{session}.store"
+
+
+# Return the record layout of a stream with a given number of value columns
+def record_dtype(ncols):
+    return np.dtype([("time", "<i8"), ("values", "<f4", (ncols,))])
+
+
+# Convert a datetime to epoch nanoseconds
+def datetime_to_ns(dt):
+    delta = dt - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds) * 1000
+
+
+# Return the number of value columns of a stream file
+def read_header(path):
+    with open(path, "rb") as f:
+        magic, ncols = HEADER.unpack(f.read(HEADER.size))
+    if magic != STORE_MAGIC:
+        raise ValueError(f"'{path}' is not a sargraph store file")
+    return ncols
+
+
+# Return the size of the text log that a store mirrors, None if it is not known
+def read_source_offset(path):
+    try:
+        with open(os.path.join(path, "source"), "r") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_source_offset(path, offset):
+    with open(os.path.join(path, "source"), "w") as f:
+        print(offset, file=f)
+
+
+# Memory-map a stream file, return epoch seconds and a (samples x columns) array.
+# If `size` is given, only records within the first `size` bytes are read.
+def read_stream(path, size=None):
+    ncols = read_header(path)
+    dtype = record_dtype(ncols)
+
+    # Ignore a record that is still being written
+    if size is None:
+        size = os.path.getsize(path)
+    count = (size - HEADER.size) // dtype.itemsize
+    if count <= 0:
+        return np.empty(0), np.empty((0, ncols), dtype=np.float32)
+
+    records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER.size, shape=(count,))
+    return records["time"] / 1e9, records["values"]
+
+
+# Rewrite a stream file with more value columns, the records written so far
+# get NaN in the new ones. Readers keep the old file until they open it again.
+def widen_stream(path, ncols):
+    old_ncols = read_header(path)
+    dtype = record_dtype(old_ncols)
+    count = (os.path.getsize(path) - HEADER.size) // dtype.itemsize
+    old = np.fromfile(path, dtype=dtype, count=count, offset=HEADER.size)
+    records = np.empty(count, dtype=record_dtype(ncols))
+    records["time"] = old["time"]
+    records["values"] = np.nan
+    records["values"][:, :old_ncols] = old["values"]
+    with open(f"{path}.new", "wb") as f:
+        f.write(HEADER.pack(STORE_MAGIC, ncols))
+        f.write(records.tobytes())
+    os.replace(f"{path}.new", path)
+
+
+# Append-only writer of fixed-width records, one file per stream. Samples and
+# comments are written from different threads of the watcher, so every
+# public method holds the lock.
+class StoreWriter:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.files = {}
+        self.comments = open(os.path.join(path, "comments.txt"), "a")
+        self.lock = Lock()
+
+    # Open the file of a stream, it is widened if it has fewer than `ncols` columns
+    def open_stream(self, kind, ncols):
+        path = os.path.join(self.path, f"{kind}.bin")
+        if file_exists(path) and os.path.getsize(path) >= HEADER.size and read_header(path) < ncols:
+            widen_stream(path, ncols)
+        f = open(path, "ab")
+        if f.tell() == 0:
+            f.write(HEADER.pack(STORE_MAGIC, ncols))
+            f.flush()
+        else:
+            ncols = read_header(path)
+        self.files[kind] = (f, ncols, struct.Struct(f"<q{ncols}f"))
+        return self.files[kind]
+
+    # Return the file of a stream with at least `ncols` columns
+    def stream(self, kind, ncols):
+        if kind in self.files and self.files[kind][1] < ncols:
+            f, _, _ = self.files.pop(kind)
+            f.close()
+        return self.files.get(kind) or self.open_stream(kind, ncols)
+
+    # Append a single sample, missing values are stored as NaN
+    def append(self, kind, now, values):
+        with self.lock:
+            f, ncols, record = self.stream(kind, len(values))
+            values = [stof(str(v)) for v in values[:ncols]]
+            values.extend([float("nan")] * (ncols - len(values)))
+            f.write(record.pack(datetime_to_ns(now), *values))
+
+    # Append samples in bulk from epoch nanoseconds and a 2D array of values
+    def extend(self, kind, times, values):
+        with self.lock:
+            f, ncols, _ = self.stream(kind, values.shape[1])
+            records = np.empty(len(times), dtype=record_dtype(ncols))
+            records["time"] = times
+            records["values"] = np.nan
+            width = min(ncols, values.shape[1])
+            records["values"][:, :width] = values[:, :width]
+            f.write(records.tobytes())
+
+    def comment(self, line):
+        with self.lock:
+            print(line, file=self.comments)
+
+    def flush(self):
+        with self.lock:
+            for f, _, _ in self.files.values():
+                f.flush()
+            self.comments.flush()
+
+    def close(self):
+        with self.lock:
+            for f, _, _ in self.files.values():
+                f.close()
+            self.files = {}
+            self.comments.close()
+
+
+# Session log read from a binary store, only comments are parsed as text
+class SessionStore(SessionLog):
+    def __init__(self, path, snapshot=None):
+        super().__init__(os.path.join(path, "comments.txt"))
+        self.directory = path
+        self.snapshot = snapshot or {}
+
+    def read(self):
+        return super().read(self.snapshot.get(self.path))
+
+    def arrays(self, kind):
+        path = os.path.join(self.directory, f"{kind}.bin")
+        if not file_exists(path):
+            return np.empty(0), np.empty((0, 0))
+        return crop(*read_stream(path, self.snapshot.get(path)), self.window)
+
+
+# Text log parser that passes everything it reads to a store writer
+class StoreConverter(SessionLog):
+    def __init__(self, session, writer, offset=0):
+        super().__init__(log_path(session))
+        self.writer = writer
+        self.seek(offset)
+
+    def parse(self, text):
+        super().parse(text)
+        for kind, stream in self.streams.items():
+            times, values = stream.arrays()
+            # Log timestamps have at most microsecond resolution
+            self.writer.extend(kind, np.rint(times * 1e6).astype(np.int64) * 1000, values)
+        self.streams = {}
+
+    def parse_comment(self, text):
+        self.writer.comment(f"# {text}")
+
+
+# Build or update the binary store of a session from its text log
+def convert(session):
+    path = store_path(session)
+    offset = read_source_offset(path)
+
+    # Stores that do not know their log or were built from a different one are rebuilt
+    if offset is None or offset > log_size(log_path(session)):
+        shutil.rmtree(path, ignore_errors=True)
+        offset = 0
+
+    writer = StoreWriter(path)
+    converter = StoreConverter(session, writer, offset).read()
+    writer.close()
+    write_source_offset(path, converter.offset)
+    return path
+
+
+# Return the current sizes of the files of a session. Passed to load_session
+# it allows reading a consistent state of a session that is still running.
+def snapshot(session):
+    sizes = {}
+    log_file = log_path(session)
+    if file_exists(log_file):
+        sizes[log_file] = log_size(log_file)
+    path = store_path(session)
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            sizes[os.path.join(path, name)] = os.path.getsize(os.path.join(path, name))
+    return sizes
+
+
+# Text logs parsed so far by this process, only their new tails are parsed on
+# following loads. Forked rendering workers inherit it from the watcher.
+parsed_logs = {}
+
+# Parsed logs are kept only while their samples take less memory than this,
+# larger ones are parsed again on every load
+CACHE_SIZE = 1 << 28
+
+
+# Return the memory taken by the parsed samples of a log, in bytes
+def parsed_size(log):
+    return sum(t.nbytes + v.nbytes for stream in log.streams.values() for t, v in stream.chunks)
+
+
+# Return a parsed text log, reusing and updating a previously parsed one
+def load_cached_session(session, snapshot=None):
+    log_file = log_path(session)
+    stat = os.stat(log_file)
+    inode, log = parsed_logs.get(log_file, (None, None))
+    limit = (snapshot or {}).get(log_file)
+
+    # The log was replaced or truncated, parse it from scratch
+    if inode != (stat.st_ino, stat.st_dev) or log_size(log_file) < log.offset:
+        log = load_text_session(session, snapshot)
+        parsed_logs[log_file] = ((stat.st_ino, stat.st_dev), log)
+    elif limit is None or limit > log.offset:
+        log.read(limit)
+    if parsed_size(log) > CACHE_SIZE:
+        del parsed_logs[log_file]
+    return log
+
+
+# Return whether a session has a binary store that is up to date with its log
+def store_current(session):
+    path = store_path(session)
+    if not os.path.isdir(path):
+        return False
+    offset = read_source_offset(path)
+    log_file = log_path(session)
+    if not file_exists(log_file):
+        return offset is not None
+    return offset == log_size(log_file)
+
+
+# Load a session from its binary store if it is up to date, from the text log
+# otherwise. With a (start, end) window of epoch seconds only the samples in
+# it are returned and the summary describes them.
+def load_session(session, snapshot=None, window=None):
+    path = store_path(session)
+    if store_current(session):
+        log = SessionStore(path, snapshot).read()
+        return log if window is None else log.select(window)
+    if os.path.isdir(path):
+        print(f"Warning: binary store of session '{session}' is out of date, reading the text log")
+    if window is not None:
+        return load_window(session, window, snapshot)
+    return load_cached_session(session, snapshot)
+
+
+# Return the (start, end) window of epoch seconds given by two bounds, each
+# of them a timestamp, a label or None. Raises ValueError for unknown labels.
+def find_window(session, bounds, snapshot=None):
+    labels = []
+    if any(b is not None and is_label_bound(b) for b in bounds):
+        if store_current(session):
+            labels = SessionStore(store_path(session), snapshot).read().labels
+        else:
+            labels = read_labels(session, snapshot)
+    start, end = [None if b is None else bound_time(b, labels) for b in bounds]
+    if start is not None and end is not None and start > end:
+        raise ValueError("The window starts after it ends")
+    return start, end
@@ -15,14 +15,20 @@ import time
 import psutil
 import sched
 import platform
-import logging
+import multiprocessing
 import socket
 import abc
 import traceback
-from threading import Thread
-from logging.handlers import DatagramHandler
+import collections
+import json
+import struct
+from threading import Lock, Thread
 
+import decimate
 import graph
+import metrics
+import segments
+import store
 
 from common import *
 
@@ -33,34 +39,102 @@ START_DATE = ""
 END_DATE = ""
 TOTAL_LOAD = 0.0
 MAX_USED_RAM = 0
-MAX_USED_FS = 0
-TOTAL_FS = 0
-MAX_TX = 0
-MAX_RX = 0
-START_TX = 0
-START_RX = 0
-END_TX = 0
-END_RX = 0
 
 TOTAL_GPU_LOAD = 0.0
 TOTAL_GPU_RAM = 0
 MAX_USED_GPU_RAM = 0
 
-FS_NAME = None
-FS_SAR_INDEX = None
-
-IFACE_NAME = None
-IFACE_SAR_INDEX = None
-
-class UDPHandler(DatagramHandler):
-    def emit(self, msg):
+# Keep UDP datagrams small enough not to be fragmented
+UDP_PAYLOAD = 1400
+
+# Messages on the control socket are prefixed with their length
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME = 1 << 20
+
+# Bytes queued for a client, above which lines for live views are dropped
+MAX_QUEUED = 1 << 20
+
+# Buffers log lines in memory and writes them in batches: when enough lines were
+# gathered, when the last batch is old enough or on request. Lines are queued
+# without locking, only writing a batch out is serialized.
+class SampleWriter:
+    def __init__(self, file, udp=None, udp_cookie=None, max_lines=256, max_delay=1.0):
+        self.file = file
+        self.lines = collections.deque()
+        self.lock = Lock()
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.last_flush = time.monotonic()
+
+        # Called after every batch is written, e.g. to keep the binary store in
+        # step with the log
+        self.synced = None
+
+        # Optionally mirror every line to a remote UDP server
+        self.udp = None
+        if udp is not None:
+            host, port = udp.rsplit(':', 1)
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_address = (host, int(port))
+            self.udp_prefix = "" if udp_cookie is None else f"[{udp_cookie}] "
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush(sync=False)
+
+    # Write out the buffered lines. Unless `sync` is set, a compressed log may
+    # keep them until it has enough of them to compress.
+    def flush(self, sync=True):
+        with self.lock:
+            self.last_flush = time.monotonic()
+            lines = []
+            while self.lines:
+                lines.append(self.lines.popleft())
+            if lines:
+                self.file.write("\n".join(lines) + "\n")
+            if sync:
+                self.file.flush()
+            if lines and self.synced is not None:
+                self.synced()
+            if lines and self.udp is not None:
+                self.send_udp(lines)
+
+    # Send lines to the UDP server, as many in a single datagram as fit
+    def send_udp(self, lines):
+        datagram = ""
+        for line in lines:
+            line = f"{self.udp_prefix}{line}\n"
+            if datagram and len(datagram) + len(line) > UDP_PAYLOAD:
+                self.send_datagram(datagram)
+                datagram = ""
+            datagram += line
+        self.send_datagram(datagram)
+
+    def send_datagram(self, datagram):
         try:
-            if self.sock is None:
-                self.createSocket()
-            self.sock.sendto(self.format(msg).encode(), self.address)
-        except Exception as e:
+            self.udp.sendto(datagram.encode(), self.udp_address)
+        except Exception:
             pass
 
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.udp is not None:
+            self.udp.close()
+
+# Plot rendered in the background for a client. The log is parsed on a thread
+# of the watcher and the plot is drawn by a process forked from it.
+class RenderJob:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.thread = None
+        self.process = None
+        self.error = None
+        # Arguments of graph.graph, set once the log is parsed
+        self.render = None
+
 # Read a single table from sar output
 def read_table(psar):
     # Find the header
@@ -101,36 +175,698 @@ def read_iface_stats(iface):
         tx = scan(r"(\d+)", int, f.readline())
     return rx, tx
 
+# Return the names of devices to observe out of the available ones, given as a
+# dict of values to compare: the chosen ones, all of them if "all" was chosen,
+# or the one with the largest value otherwise. Skipped devices are left out
+# unless they were chosen explicitly.
+def choose_devices(chosen, available, skip=()):
+    if "all" in chosen:
+        return [name for name in available if name not in skip]
+    for name in chosen:
+        if name not in available:
+            raise ValueError(f"Device '{name}' is not available")
+    if chosen:
+        return list(chosen)
+    candidates = [name for name in available if name not in skip] or list(available)
+    return [max(candidates, key=lambda name: available[name])]
+
+# Usage of an observed filesystem over the session, in MB
+class FsStats:
+    def __init__(self, name):
+        self.name = name
+        self.total = 0
+        self.max_used = 0
+
+    def update(self, used, total):
+        if self.total == 0 and total == total:
+            self.total = total
+        if self.max_used < used:
+            self.max_used = used
+
+    def summary(self):
+        return [
+            f"total disk space: {self.total * 1024 * 1024:.2f} B",
+            f"max disk used: {self.max_used * 1024 * 1024:.2f} B"
+        ]
+
+# Traffic of an observed network interface, rates in kB/s and totals in bytes
+class IfaceStats:
+    def __init__(self, name):
+        self.name = name
+        self.max_rx = 0
+        self.max_tx = 0
+        self.start = None
+        self.end = None
+
+    def update(self, rx, tx, rx_bytes, tx_bytes):
+        if self.max_rx < rx:
+            self.max_rx = rx
+        if self.max_tx < tx:
+            self.max_tx = tx
+        if self.start is None:
+            self.start = (rx_bytes, tx_bytes)
+        self.end = (rx_bytes, tx_bytes)
+
+    def summary(self):
+        start = self.start or (0, 0)
+        end = self.end or start
+        return [
+            f"max received: {self.max_rx / 128:.2f} Mb/s", # kB/s to Mb/s
+            f"max sent: {self.max_tx / 128:.2f} Mb/s", # kB/s to Mb/s
+            f"total received: {end[0] - start[0]} b",
+            f"total sent: {end[1] - start[1]} b"
+        ]
+
+# Return sar-like %user, %nice, %system, %iowait, %steal and %idle from two
+# readouts of a cpu line of /proc/stat
+def cpu_breakdown(last, curr):
+    d = [c - l for c, l in zip(curr, last)]
+    d.extend([0] * (10 - len(d)))
+    user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice = d[:10]
+    total = max(sum(d[:8]), 1)
+    return [100 * v / total for v in (user - guest, nice - guest_nice, system + irq + softirq, iowait, steal, idle)]
+
+# I/O statistics of the block device of the observed filesystem, read from
+# /proc/diskstats, or from psutil where it is not available
+class DiskIO:
+    def __init__(self, device):
+        self.name = os.path.basename(os.path.realpath(device))
+        self.fd = os.open("/proc/diskstats", os.O_RDONLY) if file_exists("/proc/diskstats") else None
+        self.last = None
+
+        self.samples = 0
+        self.max_read = 0.0
+        self.max_write = 0.0
+        self.max_iops = 0.0
+        self.max_await = 0.0
+        self.max_util = 0.0
+        self.total_await = 0.0
+        self.total_util = 0.0
+
+    # Return reads, writes, bytes read, bytes written, ms spent reading, ms
+    # spent writing and ms the device was busy, None if the device is unknown
+    def read(self):
+        if self.fd is None:
+            c = psutil.disk_io_counters(perdisk=True).get(self.name)
+            if c is None:
+                return None
+            return (c.read_count, c.write_count, c.read_bytes, c.write_bytes,
+                    c.read_time, c.write_time, getattr(c, "busy_time", 0))
+
+        for line in os.pread(self.fd, 1 << 16, 0).split(b"\n"):
+            f = line.split()
+            if len(f) > 12 and f[2].decode() == self.name:
+                # Sectors are always 512 bytes long in diskstats
+                return (int(f[3]), int(f[7]), int(f[5]) * 512, int(f[9]) * 512,
+                        int(f[6]), int(f[10]), int(f[12]))
+        return None
+
+    # Return read and write throughput (MB/s), read and write IOPS, average
+    # wait (ms) and utilization (%) since the last call, None if not known yet
+    def sample(self):
+        clock = time.monotonic()
+        counters = self.read()
+        last, self.last = self.last, (clock, counters)
+        if last is None or last[1] is None or counters is None:
+            return None
+
+        elapsed = clock - last[0]
+        reads, writes, read, written, read_ms, write_ms, busy_ms = [c - l for c, l in zip(counters, last[1])]
+        stats = [
+            read / elapsed / (1024 * 1024),
+            written / elapsed / (1024 * 1024),
+            reads / elapsed,
+            writes / elapsed,
+            (read_ms + write_ms) / (reads + writes) if reads + writes else 0.0,
+            min(100 * busy_ms / (elapsed * 1000), 100.0)
+        ]
+
+        self.samples += 1
+        self.max_read = max(self.max_read, stats[0])
+        self.max_write = max(self.max_write, stats[1])
+        self.max_iops = max(self.max_iops, stats[2] + stats[3])
+        self.max_await = max(self.max_await, stats[4])
+        self.max_util = max(self.max_util, stats[5])
+        self.total_await += stats[4]
+        self.total_util += stats[5]
+        return stats
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+# Fields of /proc/meminfo read with a single pread. The fields are always in
+# the same lines, so their line numbers are found once and only those lines
+# are parsed on following reads.
+class MemInfo:
+    FIELDS = ["MemTotal", "MemFree", "Buffers", "Cached", "SReclaimable", "Shmem",
+              "SwapTotal", "SwapFree", "Dirty", "Writeback", "Slab", "AnonPages"]
+
+    def __init__(self):
+        self.fd = os.open("/proc/meminfo", os.O_RDONLY)
+        self.lines = None
+
+    # Find the line number and the prefix of every field
+    def index(self, lines):
+        numbers = {line.partition(b":")[0].decode(): i for i, line in enumerate(lines)}
+        self.lines = [(numbers.get(field), f"{field}:".encode()) for field in self.FIELDS]
+
+    # Return the values of FIELDS in kB, 0 for fields the kernel does not have
+    def read(self):
+        lines = os.pread(self.fd, 1 << 13, 0).split(b"\n")
+        if self.lines is None:
+            self.index(lines)
+        values = []
+        for number, prefix in self.lines:
+            if number is None:
+                values.append(0)
+                continue
+            line = lines[number]
+            if not line.startswith(prefix):
+                # The layout changed, e.g. after a kernel module added fields
+                self.index(lines)
+                return self.read()
+            values.append(int(line[len(prefix):-3]))
+        return values
+
+    def close(self):
+        os.close(self.fd)
+
+# Pressure stall information of the system, from /proc/pressure, or of a
+# cgroup, from its *.pressure files. The files are kept open and reread.
+class Pressure:
+    RESOURCES = ["cpu", "memory", "io"]
+
+    def __init__(self, cgroup=None):
+        self.fds = []
+        for resource in self.RESOURCES:
+            path = os.path.join(cgroup, f"{resource}.pressure") if cgroup else f"/proc/pressure/{resource}"
+            try:
+                self.fds.append(os.open(path, os.O_RDONLY))
+            except OSError:
+                self.fds.append(None)
+        self.first = None
+        self.last = None
+
+    # Return the avg10 (%) and the total stall time (us) of the "some" and
+    # "full" lines of every resource, NaN where they are not known
+    def read(self):
+        averages = []
+        totals = []
+        for fd in self.fds:
+            lines = {}
+            if fd is not None:
+                for line in os.pread(fd, 1 << 12, 0).decode().splitlines():
+                    kind, *fields = line.split()
+                    lines[kind] = dict(f.split("=", 1) for f in fields)
+            for kind in ("some", "full"):
+                fields = lines.get(kind)
+                averages.append(float(fields["avg10"]) if fields else float("nan"))
+                totals.append(int(fields["total"]) if fields else float("nan"))
+        return averages, totals
+
+    # Return the avg10 values (%) and the stall times (ms) since the last
+    # call, of "some" and "full" of every resource, None on the first call
+    def sample(self):
+        averages, totals = self.read()
+        last, self.last = self.last, totals
+        if last is None:
+            self.first = totals
+            return None
+        return averages + [(t - l) / 1000 for t, l in zip(totals, last)]
+
+    # Return the resource, the kind and the stall time (s) since the first
+    # call of sample() of every known stall
+    def stalls(self):
+        first, last = self.first, self.last
+        if first is None:
+            return []
+        stalls = []
+        for i, resource in enumerate(self.RESOURCES):
+            for j, kind in enumerate(["some", "full"]):
+                stall = (last[2 * i + j] - first[2 * i + j]) / 1e6
+                if stall == stall:
+                    stalls.append((resource, kind, stall))
+        return stalls
+
+    def summary(self):
+        return [
+            f"{resource}{' full' if kind == 'full' else ''} stall: {stall:.2f} s"
+            for resource, kind, stall in self.stalls()
+        ]
+
+    def close(self):
+        for fd in self.fds:
+            if fd is not None:
+                os.close(fd)
+
+# Run a function periodically on absolute deadlines of a monotonic clock, so
+# that the period does not drift by the run time of the function. Deadlines
+# that already passed when the function gets to run are skipped and counted.
+class Ticker:
+    def __init__(self, scheduler, interval, function):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.function = function
+        self.missed = 0
+        self.deadline = scheduler.timefunc()
+        scheduler.enterabs(self.deadline, 1, self.tick)
+
+    def tick(self):
+        late = int((self.scheduler.timefunc() - self.deadline) // self.interval)
+        if late > 0:
+            self.missed += late
+            self.deadline += late * self.interval
+        self.deadline += self.interval
+        self.scheduler.enterabs(self.deadline, 1, self.tick)
+        self.function()
+
+# Measures the resources used by the watcher itself and by the processes it
+# runs, e.g. sar or nvidia-smi, to show how much it disturbs the observed system
+class Overhead:
+    def __init__(self):
+        self.process = psutil.Process()
+        self.children = []
+        # CPU time by pid, kept after a process exits so that the total never drops
+        self.cpu_times = {}
+        self.start_clock = self.last_clock = time.monotonic()
+        self.start_cpu = self.last_cpu = self.cpu_time()
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.max_rss = 0
+
+    # Account also for a given child process and its own children
+    def watch_child(self, pid):
+        try:
+            self.children.append(psutil.Process(pid))
+        except psutil.Error:
+            pass
+
+    def processes(self):
+        processes = [self.process]
+        for child in self.children:
+            processes.append(child)
+            try:
+                processes.extend(child.children(recursive=True))
+            except psutil.Error:
+                pass
+        return processes
+
+    def cpu_time(self):
+        for p in self.processes():
+            try:
+                t = p.cpu_times()
+                self.cpu_times[p.pid] = t.user + t.system
+            except psutil.Error:
+                pass
+        return sum(self.cpu_times.values())
+
+    def rss(self):
+        rss = 0
+        for p in self.processes():
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    # Record the time it took to process a single tick
+    def record(self, seconds):
+        self.latency = max(self.latency, seconds)
+
+    # Return a wrapper of a function that records its run time
+    def timed(self, function):
+        def run():
+            start = time.perf_counter()
+            function()
+            self.record(time.perf_counter() - start)
+        return run
+
+    # Return CPU load (%), RSS (MiB) and the longest tick (ms) since the last call
+    def sample(self):
+        clock = time.monotonic()
+        cpu = self.cpu_time()
+        load = 100 * (cpu - self.last_cpu) / max(clock - self.last_clock, 1e-9)
+        self.last_clock, self.last_cpu = clock, cpu
+
+        rss = self.rss()
+        self.max_rss = max(self.max_rss, rss)
+        latency, self.latency = self.latency, 0.0
+        self.max_latency = max(self.max_latency, latency)
+        return load, rss / (1024 * 1024), latency * 1000
+
+    # Return the CPU load (%) averaged over the whole session
+    def average_load(self):
+        return 100 * (self.last_cpu - self.start_cpu) / max(self.last_clock - self.start_clock, 1e-9)
+
+# Resources used by the processes of the observed system, summed up by process
+# name or by cgroup. The process table is kept between samples, so that only
+# processes started since the previous sample are inspected in full. CPU load
+# is a share of all the CPUs, like the load in the "sar" lines.
+class TopConsumers:
+    def __init__(self, count, cgroups=False):
+        self.count = count
+        self.cgroups = cgroups
+        self.cpus = psutil.cpu_count() or 1
+        # [process, consumer name, last cpu time] by pid
+        self.processes = {}
+        self.last_clock = None
+
+        # Ids of the consumers in the log, and their totals over the session
+        self.ids = {}
+        self.cpu_time = collections.Counter()
+        self.max_load = collections.Counter()
+        self.max_rss = collections.Counter()
+
+    # Return the name a process is accounted under
+    def consumer(self, process):
+        if self.cgroups:
+            with open(f"/proc/{process.pid}/cgroup") as f:
+                group = scan(r"(?m)^0::(\S+)", str, f.read())
+            return group or "unknown"
+        # Commas separate summary fields
+        return process.name().replace(",", " ") or "unknown"
+
+    # Return the consumers with the largest CPU load or RSS since the last call,
+    # as (name, load %, rss B) tuples
+    def sample(self):
+        clock = time.monotonic()
+        first = self.last_clock is None
+        elapsed = max(clock - (self.last_clock or clock), 1e-9)
+        self.last_clock = clock
+
+        pids = set(psutil.pids())
+        for pid in list(self.processes):
+            if pid not in pids:
+                del self.processes[pid]
+
+        cpu = collections.Counter()
+        rss = collections.Counter()
+        for pid in pids:
+            entry = self.processes.get(pid)
+            try:
+                if entry is None:
+                    process = psutil.Process(pid)
+                    # Processes started since the last sample are accounted from their start
+                    entry = self.processes[pid] = [process, self.consumer(process), None if first else 0.0]
+                process, name, last = entry
+                with process.oneshot():
+                    times = process.cpu_times()
+                    memory = process.memory_info().rss
+            except (psutil.Error, OSError):
+                self.processes.pop(pid, None)
+                continue
+            entry[2] = times.user + times.system
+            if last is not None:
+                cpu[name] += max(entry[2] - last, 0.0)
+            rss[name] += memory
+
+        load = {name: 100 * seconds / elapsed / self.cpus for name, seconds in cpu.items()}
+        self.cpu_time.update(cpu)
+        for name, value in load.items():
+            self.max_load[name] = max(self.max_load[name], value)
+        for name, value in rss.items():
+            self.max_rss[name] = max(self.max_rss[name], value)
+
+        busiest = [name for name in sorted(load, key=load.get, reverse=True) if load[name] > 0][:self.count]
+        largest = sorted(rss, key=rss.get, reverse=True)[:self.count]
+        return [(name, load.get(name, 0.0), rss[name]) for name in dict.fromkeys(busiest + largest)]
+
+    # Return the consumers that used the most CPU time or memory over the session
+    def leaders(self):
+        busiest = [name for name, _ in self.cpu_time.most_common(self.count)]
+        largest = [name for name, _ in self.max_rss.most_common(self.count)]
+        return list(dict.fromkeys(busiest + largest))
+
+# Resources used by a command run in the session and all its descendants. CPU
+# time of descendants that exited is included once their parents collected
+# them, I/O and context switches are counted for the processes seen running.
+# Exact totals can be given by the parent of the command once it exits.
+class Job:
+    def __init__(self, pid, command):
+        self.command = command
+        try:
+            self.root = psutil.Process(pid)
+        except psutil.Error:
+            self.root = None
+        self.cpus = psutil.cpu_count() or 1
+        # Bytes read and written and context switches by pid, kept after a
+        # process exits so that the totals never drop
+        self.counters = {}
+        self.last_clock = time.monotonic()
+        self.cpu_time = 0.0
+        self.last = [0.0, 0, 0, 0]
+        self.max_rss = 0
+        self.exit_code = None
+
+    def processes(self):
+        if self.root is None:
+            return []
+        try:
+            return [self.root] + self.root.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    # Return CPU time, bytes read and written and context switches so far
+    def totals(self):
+        return [self.cpu_time] + [sum(c[i] for c in self.counters.values()) for i in range(3)]
+
+    # Return CPU load (%), RSS (MiB), read and write throughput (MB/s) and
+    # context switches per second since the last call
+    def sample(self):
+        clock = time.monotonic()
+        cpu = 0.0
+        rss = 0
+        for p in self.processes():
+            try:
+                with p.oneshot():
+                    t = p.cpu_times()
+                    memory = p.memory_info().rss
+                    switches = p.num_ctx_switches()
+                    io = p.io_counters() if hasattr(p, "io_counters") else None
+            except psutil.Error:
+                continue
+            cpu += t.user + t.system + t.children_user + t.children_system
+            rss += memory
+            self.counters[p.pid] = (
+                io.read_bytes if io else 0,
+                io.write_bytes if io else 0,
+                switches.voluntary + switches.involuntary
+            )
+        self.cpu_time = max(self.cpu_time, cpu)
+        self.max_rss = max(self.max_rss, rss)
+
+        elapsed = max(clock - self.last_clock, 1e-9)
+        totals = self.totals()
+        cpu_time, read, written, switches = [(t - l) / elapsed for t, l in zip(totals, self.last)]
+        self.last_clock, self.last = clock, totals
+        return [
+            100 * cpu_time / self.cpus,
+            rss / (1024 * 1024),
+            read / (1024 * 1024),
+            written / (1024 * 1024),
+            switches
+        ]
+
+    # Record the exit code and the totals reported by the parent of the command
+    def finish(self, exit_code, totals):
+        self.exit_code = exit_code
+        if totals:
+            cpu_time, read, written, switches = totals
+            self.cpu_time = cpu_time
+            self.counters = {None: (read, written, switches)}
+            # The next sample does not see the difference as a burst
+            self.last = self.totals()
+
+    def summary(self):
+        cpu_time, read, written, switches = self.totals()
+        return [
+            f"job command: {self.command}",
+            f"job exit code: {self.exit_code}",
+            f"job cpu time: {cpu_time:.2f} s",
+            f"job max rss: {self.max_rss:.2f} B",
+            f"job read: {read:.2f} B",
+            f"job written: {written:.2f} B",
+            f"job context switches: {switches:.0f}"
+        ]
+
 def get_socket_path(session):
     return fr"\\.\pipe\sargraph-{session}" if is_windows() else f"/tmp/sargraph-{session}.sock"
 
 def get_socket():
-    return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
 def get_bound_socket(sock_path):
     sock = get_socket()
     sock.bind(sock_path)
+    sock.listen()
     return sock
 
+# Send a message as a single frame
+def send_message(sock, message):
+    data = message.encode("utf-8")
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+# Assembles framed messages from the data received on a connection. Data
+# that follows a complete frame is kept for the next one.
+class FrameBuffer:
+    def __init__(self, limit=None):
+        self.data = b""
+        self.limit = limit
+
+    # Add received data and return the messages completed by it, None if a
+    # frame is longer than the limit
+    def feed(self, data):
+        self.data += data
+        messages = []
+        while len(self.data) >= FRAME_HEADER.size:
+            size, = FRAME_HEADER.unpack_from(self.data)
+            if self.limit is not None and size > self.limit:
+                return None
+            end = FRAME_HEADER.size + size
+            if len(self.data) < end:
+                break
+            messages.append(self.data[FRAME_HEADER.size:end].decode("utf-8", errors="replace"))
+            self.data = self.data[end:]
+        return messages
+
+# Blocking reader of the messages sent over a connection, one at a time
+class MessageReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.frames = FrameBuffer()
+        self.messages = collections.deque()
+
+    # Return the next message, None if the connection was closed
+    def receive(self):
+        while not self.messages:
+            data = self.sock.recv(1 << 16)
+            if not data:
+                return None
+            self.messages.extend(self.frames.feed(data))
+        return self.messages.popleft()
+
+# Connection of a client to the control socket of a session. Frames are
+# assembled as the data comes and replies are queued, so that a slow client
+# never blocks the watcher.
+class Client:
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.incoming = FrameBuffer(MAX_FRAME)
+        self.outgoing = b""
+        # Replies are sent from the sampling thread as well
+        self.lock = Lock()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # Return the messages received so far, None if the connection was closed
+    # or a message is too long
+    def receive(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if not data:
+            return None
+        return self.incoming.feed(data)
+
+    # Queue a reply and send as much as possible without blocking, return
+    # False if the client is gone. Replies that can be missed are dropped when
+    # too much is queued already.
+    def send(self, reply, droppable=False):
+        data = json.dumps(reply).encode("utf-8")
+        with self.lock:
+            if droppable and len(self.outgoing) > MAX_QUEUED:
+                return True
+            self.outgoing += FRAME_HEADER.pack(len(data)) + data
+        return self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.outgoing:
+                return True
+            try:
+                sent = self.sock.send(self.outgoing)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            self.outgoing = self.outgoing[sent:]
+            return True
+
+    # Send out the queued replies, waiting for them a while, and disconnect
+    def close(self, timeout=1.0):
+        with self.lock:
+            try:
+                self.sock.settimeout(timeout)
+                self.sock.sendall(self.outgoing)
+            except OSError:
+                pass
+            self.sock.close()
+
 class Watcher(abc.ABC):
     sock: socket.socket
 
-    def __init__(self, session, fsdev, iface, tmpfs_color, other_cache_color, udp=None, udp_cookie=None):
+    def __init__(self, session, fsdev, iface, tmpfs_color, other_cache_color, udp=None, udp_cookie=None, binary=False, resolution=decimate.DEFAULT_RESOLUTION, interval=1, mem_interval=0.1, overhead=False, cpu_detail=False, top=0, top_interval=5.0, top_cgroups=False, compression=None, segment_size=None, segment_period=None, pressure=None, exporter=None):
         super().__init__()
 
         self.session = session
 
-        self.fsdev = fsdev
-        self.iface = iface
+        # Lists of chosen devices, empty to observe the largest or busiest one
+        self.fsdev = fsdev or []
+        self.iface = iface or []
+        self.filesystems = {}
+        self.interfaces = {}
         self.tmpfs_color = tmpfs_color
         self.other_cache_color = other_cache_color
+        self.resolution = resolution
+
+        # Also record the load of every core and where the CPU time goes
+        self.cpu_detail = cpu_detail
+
+        # Opened once the observed filesystem is known
+        self.disk_io = None
+
+        # Sampling periods in seconds
+        self.interval = interval
+        self.mem_interval = mem_interval
+        self.tickers = []
+
+        # The log is written in segments if it is compressed or rotated
+        if compression or segment_size or segment_period:
+            log = segments.SegmentWriter(segments.segments_path(session), compression, segment_size, segment_period)
+        else:
+            log = open(f"{session}.txt", "a", buffering=1)
+        self.writer = SampleWriter(log, udp, udp_cookie)
+
+        # Optionally measure the resources used by sargraph itself
+        self.overhead = Overhead() if overhead else None
 
-        self.logger = logging.getLogger("sargraph")
-        self.logger.setLevel(logging.INFO)
+        # /proc/meminfo, opened on the first memory sample
+        self.meminfo = None
 
-        file_handler = logging.FileHandler(f"{session}.txt")
-        file_handler.setFormatter(logging.Formatter("%(message)s"))
-        self.logger.addHandler(file_handler)
+        # Optionally record pressure stalls of the system, or of a cgroup
+        # if its directory is given
+        self.pressure = Pressure(pressure) if pressure is not None else None
+
+        # Command run in the session, if any
+        self.job = None
+
+        # Latest line of every stream, as (time, line) by stream. Entries are
+        # only ever replaced, so the metrics exporter reads them without locks.
+        self.latest = {}
+
+        # Optionally serve the latest samples and the aggregates over HTTP
+        self.exporter = exporter
+        self.metrics_server = None
+
+        # Optionally record which processes or cgroups used the most resources
+        self.top = TopConsumers(top, top_cgroups) if top else None
+        self.top_interval = top_interval
 
         self.socket_path = get_socket_path(session)
 
@@ -140,14 +876,27 @@ class Watcher(abc.ABC):
         # Should we die?
         self.die = False
 
-        if udp is not None:
-            spl = udp.rsplit(':', 1)
-            udp_handler = UDPHandler(spl[0], int(spl[1]))
-            if udp_cookie is None:
-                udp_handler.setFormatter(logging.Formatter("%(message)s\n"))
-            else:
-                udp_handler.setFormatter(logging.Formatter(f"[{udp_cookie}] %(message)s\n"))
-            self.logger.addHandler(udp_handler)
+        # Connected clients, live views among them get every new log line
+        self.clients = []
+        self.subscribers = set()
+
+        # Reply to the stop command, sent once the session is closed
+        self.stop_reply = None
+
+        # Plots being rendered in the background, by job id. Logs are parsed
+        # for them one at a time.
+        self.jobs = {}
+        self.last_job = 0
+        self.render_lock = Lock()
+
+        # Keep a binary copy of the samples next to the text log
+        self.store = None
+        if binary:
+            # Catch up with the data already in the text log, if any
+            store.convert(session)
+            self.store = store.StoreWriter(store.store_path(session))
+            # From now on the store is kept in sync with the text log
+            self.writer.synced = self.sync_store
 
     # Initialize 'data.txt' where the data is dumped
     @abc.abstractmethod
@@ -162,9 +911,228 @@ class Watcher(abc.ABC):
     def kill_handler(self, *_):
         self.die = True
 
-    def recv_data(self) -> str:
-        data = self.sock.recv(1 << 10)  # 1024 bytes should be enough
-        return data.decode("utf-8").replace("\n", "").strip()
+    # Write a data line of a given stream, the first item of `line` is its timestamp
+    def log_sample(self, kind, now, line):
+        text = " ".join([kind]+[str(i) for i in line])
+        self.latest[kind] = (now, line)
+        # The store gets the line first, so that it is not behind the log
+        # once the line is written out
+        if self.store is not None:
+            self.store.append(kind, now, line[1:])
+        self.writer.write(text)
+        self.publish(text)
+
+    # Write the CPU time breakdown (%user, %nice, %system, %iowait, %steal
+    # and %idle) and the load of every core, rounded to keep the log small
+    def log_cpu_detail(self, now, timestamp, breakdown, cores):
+        self.log_sample("cpu", now, [timestamp] + [f"{v:.2f}" for v in breakdown])
+        self.log_sample("core", now, [timestamp] + [f"{v:.0f}" for v in cores])
+
+    # Start observing given filesystems and network interfaces, the first of
+    # each is the one reported in the "sar" lines
+    def observe(self, filesystems, interfaces):
+        self.filesystems = {name: FsStats(name) for name in filesystems}
+        self.interfaces = {name: IfaceStats(name) for name in interfaces}
+        if len(filesystems) > 1 or len(interfaces) > 1:
+            self.log_comment(f"# observed disks: {' '.join(filesystems)}, observed networks: {' '.join(interfaces)}")
+
+    # Update the statistics of the observed devices, given used and total MB of
+    # every filesystem and received and sent kB/s and bytes of every interface.
+    # If there are more of them, every one gets its own column in the "fs" and
+    # "net" lines. Return %fsused, received and sent Mb/s of the first ones.
+    def log_devices(self, now, timestamp, fs, net):
+        nan = float("nan")
+        for name, stats in self.filesystems.items():
+            stats.update(*fs.get(name, (nan, nan)))
+        for name, stats in self.interfaces.items():
+            if name in net:
+                stats.update(*net[name])
+
+        usage = [100 * used / total if total else nan for used, total in (fs.get(name, (nan, nan)) for name in self.filesystems)]
+        traffic = []
+        for name in self.interfaces:
+            rx, tx = net[name][:2] if name in net else (nan, nan)
+            traffic.extend([rx / 128, tx / 128]) # kB/s to Mb/s
+
+        if len(usage) > 1:
+            self.log_sample("fs", now, [timestamp] + [f"{v:.2f}" for v in usage])
+        if len(self.interfaces) > 1:
+            self.log_sample("net", now, [timestamp] + traffic)
+        return [f"{usage[0]:.2f}", traffic[0], traffic[1]]
+
+    # Write the resources used by the command run in the session
+    def log_job(self):
+        now = datetime.datetime.now()
+        line = [now.strftime("%Y-%m-%d-%H:%M:%S.%f")] + [f"{v:.2f}" for v in self.job.sample()]
+        self.log_sample("job", now, line)
+
+    # Write the processes or cgroups that use the most resources, each as its
+    # id, CPU load (%) and RSS (MiB). Ids are given in comments when consumers
+    # show up for the first time. Lines are padded, so that they have the same
+    # number of columns.
+    def log_top(self):
+        now = datetime.datetime.now()
+        timestamp = now.strftime("%Y-%m-%d-%H:%M:%S.%f")
+        line = [timestamp]
+        for name, load, rss in self.top.sample():
+            if name not in self.top.ids:
+                self.top.ids[name] = len(self.top.ids)
+                self.log_comment(f"# {timestamp} consumer id: {self.top.ids[name]} {name}")
+            line.extend([self.top.ids[name], f"{load:.2f}", f"{rss / (1024 * 1024):.2f}"])
+        line.extend(["nan"] * (1 + 6 * self.top.count - len(line)))
+        self.log_sample("top", now, line)
+
+    # Write the avg10 values and the stall times of the pressure stall information
+    def log_pressure(self):
+        now = datetime.datetime.now()
+        stats = self.pressure.sample()
+        if stats is not None:
+            self.log_sample("psi", now, [now.strftime("%Y-%m-%d-%H:%M:%S.%f")]
+                            + [f"{v:.2f}" for v in stats[:6]] + [f"{v:.3f}" for v in stats[6:]])
+
+    # Write the I/O statistics of the block device of the observed filesystem
+    def log_disk_io(self, now, timestamp):
+        if self.disk_io is None:
+            if not self.filesystems:
+                return
+            self.disk_io = DiskIO(next(iter(self.filesystems)))
+        stats = self.disk_io.sample()
+        if stats is not None:
+            self.log_sample("dio", now, [timestamp] + [f"{v:.2f}" for v in stats])
+
+    # Write a comment line, e.g. a header, a summary or a label
+    def log_comment(self, line):
+        if self.store is not None:
+            self.store.comment(line)
+        self.writer.write(line)
+        self.publish(line)
+
+    # Write out all buffered lines and samples
+    def flush(self):
+        self.writer.flush()
+        if self.store is not None:
+            self.store.flush()
+
+    # Write out the binary store and record the size of the log it mirrors,
+    # like for a store converted from the log, so that the store is not used
+    # once the log grows without it
+    def sync_store(self):
+        self.store.flush()
+        store.write_source_offset(self.store.path, segments.log_size(segments.log_path(self.session)))
+
+    # Accept new clients and handle the commands they sent, given the result
+    # of select() on the control socket and the clients. Return True if one of
+    # the commands stopped the session.
+    def handle_clients(self, rlist, s):
+        for client in list(self.clients):
+            if not client.flush():
+                self.disconnect(client)
+
+        if self.sock in rlist:
+            try:
+                conn, _ = self.sock.accept()
+                self.clients.append(Client(conn))
+            except OSError:
+                pass
+
+        stop = False
+        for client in [c for c in self.clients if c in rlist]:
+            messages = client.receive()
+            if messages is None:
+                self.disconnect(client)
+                continue
+            for message in messages:
+                if self.handle_command(message.replace("\n", "").strip(), s, datetime.datetime.now(), client):
+                    stop = True
+        return stop
+
+    def disconnect(self, client):
+        self.subscribers.discard(client)
+        if client in self.clients:
+            self.clients.remove(client)
+        client.close(0)
+
+    # Send a line to every live view. Lines a view has no room for are dropped
+    # for it, views that are gone are forgotten.
+    def publish(self, line):
+        for client in list(self.subscribers):
+            if not client.send({"status": "line", "line": line}, droppable=True):
+                self.subscribers.discard(client)
+
+    # Send a reply to a client, if the command came from one. The final reply
+    # to a command has the "ok" or "error" status.
+    def reply(self, client, status="ok", **fields):
+        if client is not None:
+            client.send(dict(status=status, **fields))
+
+    # Render a plot in a background process, so that sampling is not stalled.
+    # The plot shows the state of the session at the moment of this call.
+    def start_render(self, fname, client=None, bounds=(None, None)):
+        args = (self.session, self.tmpfs_color, self.other_cache_color)
+        if fname:
+            args += (fname,)
+        snapshot = store.snapshot(self.session)
+
+        self.last_job += 1
+        job = self.jobs[self.last_job] = RenderJob(client, graph.output_path(*args[3:]))
+        job.thread = Thread(target=self.prepare_render, args=(job, args, snapshot, bounds), daemon=True)
+        job.thread.start()
+        self.reply(client, "pending", job=self.last_job)
+
+    # Parse the log up to a snapshot for the process that draws the plot. It
+    # runs on a thread of its own, so that sampling goes on meanwhile.
+    def prepare_render(self, job, args, snapshot, bounds):
+        with self.render_lock:
+            window = None
+            try:
+                if bounds != (None, None):
+                    window = store.find_window(self.session, bounds, snapshot)
+                else:
+                    # The worker and the following saves start from what
+                    # has already been parsed
+                    store.load_session(self.session, snapshot)
+            except Exception as e:
+                job.error = str(e)
+                return
+            job.render = (args, {"snapshot": snapshot, "resolution": self.resolution, "window": window})
+
+    # Fork the process that draws a plot. It is started from the command loop
+    # rather than from the thread that parsed the log, so that the worker
+    # does not inherit the locks that the parsing thread holds.
+    def fork_render(self, job):
+        args, kwargs = job.render
+        job.process = multiprocessing.get_context("fork").Process(target=graph.graph, args=args, kwargs=kwargs)
+        job.process.start()
+
+    # Start the workers of parsed logs and report rendering jobs that have
+    # finished
+    def poll_jobs(self):
+        for number, job in list(self.jobs.items()):
+            if job.thread.is_alive():
+                continue
+            if job.process is None and job.render is not None:
+                self.fork_render(job)
+            if job.process is not None and job.process.exitcode is None:
+                continue
+            if job.process is not None:
+                job.process.join()
+            del self.jobs[number]
+            if job.error is not None:
+                self.reply(job.client, "error", job=number, error=job.error)
+            elif job.process.exitcode == 0:
+                self.reply(job.client, job=number, output=job.path)
+            else:
+                self.reply(job.client, "error", job=number, error=f"Rendering job {number} failed")
+
+    # Wait for all rendering jobs to finish
+    def wait_jobs(self):
+        for job in self.jobs.values():
+            job.thread.join()
+            if job.process is None and job.render is not None:
+                self.fork_render(job)
+            if job.process is not None:
+                job.process.join()
+        self.poll_jobs()
 
     # Add a summary comment to 'data.txt'
     def summarize(self):
@@ -175,12 +1143,12 @@ class Watcher(abc.ABC):
         average_load = TOTAL_LOAD / float(SAMPLE_NUMBER)
         max_used_ram = MAX_USED_RAM * 1024.0
         total_ram = TOTAL_RAM * 1024.0
-        max_used_fs = MAX_USED_FS * 1024.0 * 1024.0
-        total_fs = TOTAL_FS * 1024 * 1024
-        max_tx = MAX_TX / 128 # kB/s to Mb/s
-        max_rx = MAX_RX / 128 # kB/s to Mb/s
-        total_tx = END_TX-START_TX
-        total_rx = END_RX-START_RX
+
+        # The first observed devices are summarized like when there is one
+        fs = next(iter(self.filesystems.values()), FsStats(None))
+        net = next(iter(self.interfaces.values()), IfaceStats(None))
+        total_fs, max_used_fs = fs.summary()
+        max_rx, max_tx, total_rx, total_tx = net.summary()
 
         sdt = datetime.datetime.strptime(START_DATE, '%Y-%m-%d %H:%M:%S')
         edt = datetime.datetime.strptime(END_DATE, '%Y-%m-%d %H:%M:%S')
@@ -188,17 +1156,18 @@ class Watcher(abc.ABC):
 
         summary = [
             f"# total ram: {total_ram:.2f} B",
-            f"total disk space: {total_fs:.2f} B",
+            total_fs,
             f"max ram used: {max_used_ram:.2f} B",
-            f"max disk used: {max_used_fs:.2f} B",
+            max_used_fs,
             f"average load: {average_load:.2f} %",
-            f"observed disk: {FS_NAME}",
-            f"max received: {max_rx:.2f} Mb/s",
-            f"max sent: {max_tx:.2f} Mb/s",
-            f"observed network: {IFACE_NAME}",
+            f"observed disk: {fs.name}",
+            max_rx,
+            max_tx,
+            f"observed network: {net.name}",
             f"duration: {delta_t} seconds",
-            f"total received: {total_rx} b",
-            f"total sent: {total_tx} b"
+            total_rx,
+            total_tx,
+            f"missed ticks: {sum(t.missed for t in self.tickers)}"
         ]
 
         if TOTAL_GPU_RAM != 0:
@@ -208,57 +1177,265 @@ class Watcher(abc.ABC):
                 f"average gpu load: {TOTAL_GPU_LOAD / SAMPLE_NUMBER:.2f} %"
             ])
 
-        self.logger.info(", ".join([str(i) for i in summary]))
+        if self.disk_io is not None and self.disk_io.samples:
+            d = self.disk_io
+            summary.extend([
+                f"io device: {d.name}",
+                f"max io read: {d.max_read:.2f} MB/s",
+                f"max io written: {d.max_write:.2f} MB/s",
+                f"max iops: {d.max_iops:.2f}",
+                f"average io wait: {d.total_await / d.samples:.2f} ms",
+                f"max io wait: {d.max_await:.2f} ms",
+                f"average io util: {d.total_util / d.samples:.2f} %",
+                f"max io util: {d.max_util:.2f} %"
+            ])
+
+        if self.overhead is not None:
+            summary.extend([
+                f"watcher load: {self.overhead.average_load():.2f} %",
+                f"watcher max rss: {self.overhead.max_rss:.2f} B",
+                f"watcher max latency: {self.overhead.max_latency * 1000:.3f} ms"
+            ])
+
+        if self.pressure is not None:
+            summary.extend(self.pressure.summary())
+
+        if self.top is not None:
+            summary.append(f"consumers: {'cgroups' if self.top.cgroups else 'processes'}")
+
+        if self.job is not None:
+            summary.extend(self.job.summary())
+
+        self.log_comment(", ".join([str(i) for i in summary]))
+
+        # Every device gets its own summary if more of them were observed
+        if len(self.filesystems) > 1:
+            for stats in self.filesystems.values():
+                self.log_comment(", ".join([f"# disk: {stats.name}"] + stats.summary()))
+        if len(self.interfaces) > 1:
+            for stats in self.interfaces.values():
+                self.log_comment(", ".join([f"# network: {stats.name}"] + stats.summary()))
+
+        # The processes or cgroups that used the most CPU time or memory
+        if self.top is not None:
+            for name in self.top.leaders():
+                self.log_comment(", ".join([
+                    f"# top consumer: {name}",
+                    f"cpu time: {self.top.cpu_time[name]:.2f} s",
+                    f"max cpu: {self.top.max_load[name]:.2f} %",
+                    f"max rss: {self.top.max_rss[name]:.2f} B"
+                ]))
+
+    # Return live aggregates of the session, as readable values by name
+    def status(self):
+        status = {
+            "session": self.session,
+            "pid": os.getpid(),
+            "samples": SAMPLE_NUMBER,
+            "start": START_DATE,
+            "last sample": END_DATE,
+            "average load": f"{TOTAL_LOAD / SAMPLE_NUMBER if SAMPLE_NUMBER else 0.0:.2f} %",
+            "total ram": unit_str(TOTAL_RAM * 1024, DATA_UNITS),
+            "max ram used": unit_str(MAX_USED_RAM * 1024, DATA_UNITS),
+            "missed ticks": sum(t.missed for t in self.tickers),
+            "rendering jobs": len(self.jobs),
+            "live views": len(self.subscribers)
+        }
+        for stats in self.filesystems.values():
+            status[f"disk {stats.name}"] = f"{unit_str(stats.max_used * 1024 * 1024, DATA_UNITS)} max used of {unit_str(stats.total * 1024 * 1024, DATA_UNITS)}"
+        for stats in self.interfaces.values():
+            status[f"network {stats.name}"] = f"max received {unit_str(stats.max_rx / 128, SPEED_UNITS)}, max sent {unit_str(stats.max_tx / 128, SPEED_UNITS)}"
+        if TOTAL_GPU_RAM != 0:
+            status["average gpu load"] = f"{TOTAL_GPU_LOAD / SAMPLE_NUMBER if SAMPLE_NUMBER else 0.0:.2f} %"
+            status["max gpu ram used"] = unit_str(MAX_USED_GPU_RAM * 1024 * 1024, DATA_UNITS)
+        if self.disk_io is not None and self.disk_io.samples:
+            status["io device"] = self.disk_io.name
+            status["max io util"] = f"{self.disk_io.max_util:.2f} %"
+        if self.job is not None:
+            cpu_time, _, _, _ = self.job.totals()
+            status["job command"] = self.job.command
+            status["job cpu time"] = f"{cpu_time:.2f} s"
+            status["job max rss"] = unit_str(self.job.max_rss, DATA_UNITS)
+        if self.top is not None:
+            status["top consumers"] = ", ".join(self.top.leaders())
+        if self.overhead is not None:
+            status["watcher max rss"] = unit_str(self.overhead.max_rss, DATA_UNITS)
+        return status
+
+    # Return the metric families of the latest samples and the aggregates of
+    # the session. It runs on the thread of the metrics exporter, so it only
+    # reads values that the sampling thread replaces as a whole.
+    def metrics(self):
+        samples = SAMPLE_NUMBER
+        families = [
+            ("sargraph_samples", "counter", "", "Samples taken", [({}, samples)]),
+            ("sargraph_missed_ticks", "counter", "", "Sampling deadlines that were missed", [({}, sum(t.missed for t in list(self.tickers)))]),
+            ("sargraph_average_cpu_load_percent", "gauge", "percent", "Average CPU load over the session", [({}, TOTAL_LOAD / samples if samples else 0.0)]),
+            ("sargraph_memory_total_bytes", "gauge", "bytes", "Total RAM", [({}, TOTAL_RAM * 1024)]),
+            ("sargraph_memory_max_used_bytes", "gauge", "bytes", "Most RAM used over the session", [({}, MAX_USED_RAM * 1024)]),
+        ]
+
+        filesystems = list(self.filesystems.values())
+        families.extend([
+            ("sargraph_filesystem_size_bytes", "gauge", "bytes", "Size of an observed filesystem",
+             [({"device": f.name}, f.total * 1024 * 1024) for f in filesystems]),
+            ("sargraph_filesystem_max_used_bytes", "gauge", "bytes", "Most space used on an observed filesystem over the session",
+             [({"device": f.name}, f.max_used * 1024 * 1024) for f in filesystems]),
+        ])
+
+        traffic = [(i.name, i.max_rx, i.max_tx, i.start, i.end) for i in list(self.interfaces.values())]
+        traffic = [(name, max_rx, max_tx, start or (0, 0), end or start or (0, 0)) for name, max_rx, max_tx, start, end in traffic]
+        families.extend([
+            ("sargraph_network_received_bytes", "counter", "bytes", "Data received by an observed interface over the session",
+             [({"interface": name}, end[0] - start[0]) for name, _, _, start, end in traffic]),
+            ("sargraph_network_sent_bytes", "counter", "bytes", "Data sent by an observed interface over the session",
+             [({"interface": name}, end[1] - start[1]) for name, _, _, start, end in traffic]),
+            ("sargraph_network_max_received_mbps", "gauge", "mbps", "Highest receive rate of an observed interface",
+             [({"interface": name}, max_rx / 128) for name, max_rx, _, _, _ in traffic]), # kB/s to Mb/s
+            ("sargraph_network_max_sent_mbps", "gauge", "mbps", "Highest send rate of an observed interface",
+             [({"interface": name}, max_tx / 128) for name, _, max_tx, _, _ in traffic]), # kB/s to Mb/s
+        ])
+
+        if TOTAL_GPU_RAM != 0:
+            families.extend([
+                ("sargraph_gpu_memory_total_bytes", "gauge", "bytes", "Total GPU memory", [({}, TOTAL_GPU_RAM * 1024 * 1024)]), # default units are MiB
+                ("sargraph_gpu_memory_max_used_bytes", "gauge", "bytes", "Most GPU memory used over the session", [({}, MAX_USED_GPU_RAM * 1024 * 1024)]),
+                ("sargraph_average_gpu_load_percent", "gauge", "percent", "Average GPU load over the session", [({}, TOTAL_GPU_LOAD / samples if samples else 0.0)]),
+            ])
+
+        if self.pressure is not None:
+            families.append(("sargraph_pressure_stall_seconds", "counter", "seconds", "Time tasks were stalled over the session",
+                             [({"resource": resource, "kind": kind}, stall) for resource, kind, stall in self.pressure.stalls()]))
+
+        job = self.job
+        if job is not None:
+            families.extend([
+                ("sargraph_job_cpu_seconds", "counter", "seconds", "CPU time of the command run in the session", [({}, job.cpu_time)]),
+                ("sargraph_job_max_rss_bytes", "gauge", "bytes", "Highest RSS of the command run in the session", [({}, job.max_rss)]),
+            ])
 
-    def get_meminfo(self, scheduler):
+        return families + metrics.sample_families(dict(self.latest))
+
+    # Return a scheduler running on a monotonic clock with a periodic task
+    # for each of given (interval, function) pairs
+    def schedule(self, *tasks):
+        s = sched.scheduler(time.monotonic, time.sleep)
+        if self.top is not None:
+            tasks += ((self.top_interval, self.log_top),)
+        if self.pressure is not None:
+            tasks += ((self.mem_interval, self.log_pressure),)
+        for interval, function in tasks:
+            self.add_task(s, interval, function)
+        if self.overhead is not None:
+            self.tickers.append(Ticker(s, self.interval, self.log_overhead))
+        return s
+
+    # Run a function periodically, also when the scheduler is already running
+    def add_task(self, s, interval, function):
+        if self.overhead is not None:
+            function = self.overhead.timed(function)
+        self.tickers.append(Ticker(s, interval, function))
+
+    # Log the resources used by sargraph since the last call
+    def log_overhead(self):
+        now = datetime.datetime.now()
+        load, rss, latency = self.overhead.sample()
+        line = [
+            now.strftime("%Y-%m-%d-%H:%M:%S.%f"),
+            f"{load:.2f}",
+            f"{rss:.2f}",
+            f"{latency:.3f}"
+        ]
+        self.log_sample("ovh", now, line)
+
+    # Write the memory usage read from /proc/meminfo: free, cached, used and
+    # shared memory, as psutil splits it on Linux, followed by swap used,
+    # dirty, writeback, slab and anonymous memory, all in % of the total RAM
+    def get_meminfo(self):
         global MAX_USED_RAM
-        scheduler.enter(0.1, 1, self.get_meminfo, (scheduler,))
         now = datetime.datetime.now()
-        date = now.strftime("%Y-%m-%d")
-        daytime = now.strftime("%H:%M:%S.%f")
-        ram_data = psutil.virtual_memory()
-        used = (ram_data.total - ram_data.free)
-        if used // 1024 > MAX_USED_RAM:
-            MAX_USED_RAM = used // 1024
-        if isinstance(self, PsUtilWatcher):
-            line = [
-                date + "-" + daytime,
-                100 * ram_data.free / ram_data.total,
-                0,
-                100 * used / ram_data.total,
-                0
-            ]
-        else:
-            line = [
-                date + "-" + daytime,
-                100 * ram_data.free / ram_data.total,
-                100 * ram_data.cached / ram_data.total,
-                100 * ram_data.used / ram_data.total,
-                100 * ram_data.shared / ram_data.total
-            ]
-        msg = " ".join(["psu"]+[str(i) for i in line])
-        self.logger.info(msg)
+        if self.meminfo is None:
+            self.meminfo = MemInfo()
+        total, free, buffers, cached, reclaimable, shared, swap_total, swap_free, dirty, writeback, slab, anon = self.meminfo.read()
+        cached += reclaimable
+        used = total - free - buffers - cached
+        if used < 0:
+            used = total - free
+        if total - free > MAX_USED_RAM:
+            MAX_USED_RAM = total - free
+        scale = 100 / total
+        line = [now.strftime("%Y-%m-%d-%H:%M:%S.%f")] + [
+            f"{v * scale:.2f}" for v in (free, cached, used, shared, swap_total - swap_free, dirty, writeback, slab, anon)
+        ]
+        self.log_sample("psu", now, line)
+
+    # Let the process that started the session know whether it is ready
+    def notify(self, message):
+        ready = os.environ.pop("SARGRAPH_READY_FD", None)
+        if ready is not None:
+            os.write(int(ready), message.encode("utf-8"))
+            os.close(int(ready))
+
+    # Close the log, the store and the files read for samples
+    def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.writer.close()
+        if self.store is not None:
+            # Closing a compressed log writes out its last lines
+            self.sync_store()
+            self.store.close()
+        if self.disk_io is not None:
+            self.disk_io.close()
+        if self.pressure is not None:
+            self.pressure.close()
+        if self.meminfo is not None:
+            self.meminfo.close()
 
     def start(self):
+        if self.exporter is not None:
+            try:
+                self.metrics_server = metrics.MetricsServer(self.exporter, self.session, self.metrics)
+            except OSError as e:
+                error = f"Cannot serve metrics on '{self.exporter}': {e.strerror}"
+                self.writer.write(f"# {error}")
+                self.notify(f"error:{error}")
+                self.close()
+                return
+            self.metrics_server.start()
         self.sock = get_bound_socket(self.socket_path)
         signal.signal(signal.SIGTERM, self.kill_handler)
+        self.notify("ready")
 
         try:
             self.watch()
         except Exception as e:
             # make sure we prepend '#' to every line, to make reading file work
-            self.logger.error("# Exception while watching!")
-            for line in traceback.format_exception(type(e), e, e.__traceback__):
-                self.logger.error(f"# {line}")
-        
+            self.writer.write("# Exception while watching!")
+            for line in "".join(traceback.format_exception(type(e), e, e.__traceback__)).splitlines():
+                self.writer.write(f"# {line}")
+
+        self.close()
+
         try:  # clean up after ourselves
             os.unlink(self.socket_path)
         except OSError:
             pass
 
+        # Let live views know that there will be nothing more, and the client
+        # that stopped the session that it is closed
+        for client in self.subscribers:
+            self.reply(client)
+        if self.stop_reply is not None:
+            client, output = self.stop_reply
+            self.reply(client, output=output)
+        for client in self.clients:
+            client.close()
+        self.sock.close()
+
         return
 
-    def handle_command(self, label_line: str, s: sched.scheduler, now: datetime.datetime):
+    def handle_command(self, label_line: str, s: sched.scheduler, now: datetime.datetime, client=None):
         if label_line.startswith("command:"):
             label_line = label_line[len("command:"):]
             if label_line.startswith("q:"):
@@ -266,31 +1443,66 @@ class Watcher(abc.ABC):
 
                 list(map(s.cancel, s.queue))
                 self.summarize()
+                self.flush()
+                output = None
                 if label_line == "none":
                     pass
                 elif label_line:
-                    graph.graph(self.session, self.tmpfs_color, self.other_cache_color, label_line)
+                    graph.graph(self.session, self.tmpfs_color, self.other_cache_color, label_line, resolution=self.resolution)
+                    output = graph.output_path(label_line)
                 elif not self.dont_plot:
-                    graph.graph(self.session, self.tmpfs_color, self.other_cache_color)
+                    graph.graph(self.session, self.tmpfs_color, self.other_cache_color, resolution=self.resolution)
+                    output = graph.output_path()
                 self.dont_plot = True
                 self.die = 1
+                self.stop_reply = (client, output)
                 return True
             elif label_line.startswith("s:"):
                 label_line = label_line[len("s:"):]
 
+                # The output name can follow the start and end of a time
+                # window, separated with tabs and "*" for an unset bound
+                bounds = (None, None)
+                if "\t" in label_line:
+                    start, end, *rest = label_line.split("\t") + [""]
+                    bounds = tuple(None if b == "*" else b for b in (start, end))
+                    label_line = rest[0]
+
                 self.dont_plot = True
 
                 if label_line != "none":
                     self.summarize()
-                if not label_line:
-                    graph.graph(self.session, self.tmpfs_color, self.other_cache_color)
-                else:
-                    graph.graph(self.session, self.tmpfs_color, self.other_cache_color, label_line)
+                self.flush()
+                self.start_render(label_line, client, bounds)
+            elif label_line.startswith("i:"):
+                self.reply(client, **self.status())
+            elif label_line.startswith("w:"):
+                # A live view subscribes to new log lines, it gets the final
+                # reply when the session is closed
+                if client is not None:
+                    self.subscribers.add(client)
+            elif label_line.startswith("j:"):
+                # A command was started by the client, follow its process tree
+                pid, _, command = label_line[len("j:"):].partition(" ")
+                self.job = Job(int(pid), command.replace(",", " "))
+                self.add_task(s, self.interval, self.log_job)
+                self.reply(client)
+            elif label_line.startswith("e:"):
+                # The command exited, with its exit code and optionally CPU time,
+                # bytes read and written and context switches of the whole tree
+                if self.job is not None:
+                    code, *totals = label_line[len("e:"):].split()
+                    self.job.finish(int(code), [float(v) for v in totals])
+                self.reply(client)
+            else:
+                self.reply(client, "error", error=f"unknown command '{label_line}'")
         elif label_line.startswith('label:'):
             label_line = label_line[len('label:'):]
-            with open(f"{self.session}.txt", "a") as f:
-                timestamp = now.strftime("%Y-%m-%d-%H:%M:%S")
-                print(f"# {timestamp} label: {label_line}", file=f)
+            timestamp = now.strftime("%Y-%m-%d-%H:%M:%S")
+            self.log_comment(f"# {timestamp} label: {label_line}")
+            self.reply(client)
+        else:
+            self.reply(client, "error", error="unknown message")
         return False
 
 class SarWatcher(Watcher):
@@ -319,7 +1531,9 @@ class SarWatcher(Watcher):
             f"pid: {os.getpid()}",
             f"machine: {uname}",
             f"cpu count: {cpus}",
-            f"cpu: {cpu_name}"
+            f"cpu: {cpu_name}",
+            f"interval: {self.interval} s",
+            f"memory interval: {self.mem_interval} s"
         ]
         try:
             pgpu = subprocess.run(
@@ -337,7 +1551,7 @@ class SarWatcher(Watcher):
             print(e)
             pass
 
-        self.logger.info(", ".join(header))
+        self.log_comment(", ".join(header))
 
     def watch(self):
         global SAMPLE_NUMBER
@@ -345,19 +1559,7 @@ class SarWatcher(Watcher):
         global END_DATE
         global TOTAL_LOAD
         global MAX_USED_RAM
-        global MAX_USED_FS
-        global MAX_RX
-        global MAX_TX
-        global TOTAL_FS
-        global START_RX
-        global START_TX
-        global END_RX
-        global END_TX
         global TOTAL_RAM
-        global FS_SAR_INDEX
-        global FS_NAME
-        global IFACE_NAME
-        global IFACE_SAR_INDEX
         global TOTAL_GPU_LOAD
         global TOTAL_GPU_RAM
         global MAX_USED_GPU_RAM
@@ -365,23 +1567,28 @@ class SarWatcher(Watcher):
         my_env = os.environ
         my_env["S_TIME_FORMAT"] = "ISO"
 
-        psar = run_or_fail("sar", "-F", "-u", "-n", "DEV", "1", stdout=subprocess.PIPE, env=my_env)
+        cpus = ["-P", "ALL"] if self.cpu_detail else []
+        psar = run_or_fail("sar", "-F", "-u", *cpus, "-n", "DEV", str(self.interval), stdout=subprocess.PIPE, env=my_env)
 
-        s = sched.scheduler(time.time, time.sleep)
-        mem_ev = s.enter(0, 1, self.get_meminfo, (s,))
+        s = self.schedule((self.mem_interval, self.get_meminfo))
         thread = Thread(target = s.run)
         thread.start()
 
         # subprocess for GPU data fetching in the background
         try:
             pgpu = subprocess.Popen(
-                'nvidia-smi --query-gpu=utilization.gpu,memory.used --format=csv,noheader,nounits -l 1'.split(' '),
+                f'nvidia-smi --query-gpu=utilization.gpu,memory.used --format=csv,noheader,nounits -l {self.interval}'.split(' '),
                 stdout=subprocess.PIPE,
                 env=my_env
             )
         except:
             pgpu = None
 
+        if self.overhead is not None:
+            self.overhead.watch_child(psar.pid)
+            if pgpu:
+                self.overhead.watch_child(pgpu.pid)
+
         machine = psar.stdout.readline().decode()
         self.initialize(machine)
         psar.stdout.readline()
@@ -390,28 +1597,24 @@ class SarWatcher(Watcher):
         curr_gpu_util = 0
         curr_gpu_mem = 0
 
-        socket_fd = self.sock.fileno()
-
         while 1:
             # Await sar output or a command sent from command handler in sargraph.py
-            readlist = [psar.stdout, socket_fd]
+            readlist = [psar.stdout, self.sock, *self.clients]
             if pgpu:
                 readlist.append(pgpu.stdout)
             rlist, _, _ = select.select(readlist, [], [], 0.25)
-            now = datetime.datetime.now()
-            
+            self.poll_jobs()
+
+            if self.handle_clients(rlist, s):
+                break
+
             if psar.stdout not in rlist:
                 continue
-
-            if socket_fd in rlist:
-                data = self.recv_data()
-                now = datetime.datetime.now()
-                if self.handle_command(data, s, now):
-                    break
-                
+            now = datetime.datetime.now()
 
             date = now.strftime("%Y-%m-%d")
             daytime = now.strftime("%H:%M:%S")
+            tick_start = time.perf_counter()
 
             # Read and process CPU data
             try:
@@ -426,47 +1629,32 @@ class SarWatcher(Watcher):
 
                 # Read and process network data
                 net_data = read_table(psar)
-                if IFACE_SAR_INDEX is None:
-                    if self.iface:
-                        IFACE_SAR_INDEX = net_data['IFACE'].index(self.iface)
-                    else:
-                        maxj, maxv = 0, 0
-                        for j, used in enumerate(net_data['IFACE']):
-                            v = stof(net_data['rxkB/s'][j])
-                            if maxv < v:
-                                maxj, maxv = j, v
-                            IFACE_SAR_INDEX = maxj
-                if IFACE_NAME is None:
-                    IFACE_NAME = net_data['IFACE'][IFACE_SAR_INDEX]
-                if START_RX <= 0 or START_TX <= 0:
-                    START_RX, START_TX = read_iface_stats(IFACE_NAME)
-                END_RX, END_TX = read_iface_stats(IFACE_NAME)
-                if MAX_RX < stof(net_data['rxkB/s'][IFACE_SAR_INDEX]):
-                    MAX_RX = stof(net_data['rxkB/s'][IFACE_SAR_INDEX])
-                if MAX_TX < stof(net_data['txkB/s'][IFACE_SAR_INDEX]):
-                    MAX_TX = stof(net_data['txkB/s'][IFACE_SAR_INDEX])
+                rates = {
+                    iface: (stof(net_data['rxkB/s'][j]), stof(net_data['txkB/s'][j]))
+                    for j, iface in enumerate(net_data['IFACE'])
+                }
 
                 # Read and process FS data
                 fs_data = read_table(psar)
-                if FS_SAR_INDEX is None:
-                    if self.fsdev:
-                        FS_SAR_INDEX = fs_data['FILESYSTEM'].index(self.fsdev)
-                    else:
-                        maxj, maxv = 0, 0
-                        for j, free in enumerate(fs_data['MBfsfree']):
-                            v = stof(fs_data['MBfsfree'][j]) + stof(fs_data['MBfsused'][j])
-                            # Skip shared memory device
-                            if fs_data["FILESYSTEM"][j] == "/dev/shm":
-                                continue
-                            if maxv < v:
-                                maxj, maxv = j, v
-                        FS_SAR_INDEX = maxj
-                if FS_NAME is None:
-                    FS_NAME = fs_data["FILESYSTEM"][FS_SAR_INDEX]
-                if TOTAL_FS == 0:
-                    TOTAL_FS = (stof(fs_data['MBfsused'][FS_SAR_INDEX]) + stof(fs_data['MBfsfree'][FS_SAR_INDEX]))
-                if MAX_USED_FS < int(fs_data['MBfsused'][FS_SAR_INDEX]):
-                    MAX_USED_FS = int(fs_data['MBfsused'][FS_SAR_INDEX])
+                fs = {
+                    name: (stof(fs_data['MBfsused'][j]), stof(fs_data['MBfsused'][j]) + stof(fs_data['MBfsfree'][j]))
+                    for j, name in enumerate(fs_data['FILESYSTEM'])
+                }
+
+                # Observe the chosen devices, or the busiest interface and the largest filesystem
+                if not self.filesystems:
+                    self.observe(
+                        choose_devices(self.fsdev, {name: total for name, (_, total) in fs.items()}, ["/dev/shm"]),
+                        choose_devices(self.iface, {iface: rx for iface, (rx, _) in rates.items()}, ["lo"])
+                    )
+
+                net = {}
+                for iface in self.interfaces:
+                    try:
+                        net[iface] = rates[iface] + read_iface_stats(iface)
+                    except (KeyError, OSError):
+                        # The interface is gone
+                        pass
 
                 END_DATE = date + " " + daytime
                 timestamp = date + "-" + daytime
@@ -500,36 +1688,69 @@ class SarWatcher(Watcher):
             line = [
                 timestamp,
                 cpu_data['%user'][0],
-                fs_data['%fsused'][FS_SAR_INDEX],
-                stof(net_data['rxkB/s'][IFACE_SAR_INDEX])/128, # kB/s to Mb/s
-                stof(net_data['txkB/s'][IFACE_SAR_INDEX])/128, # kB/s to Mb/s
+                *self.log_devices(now, timestamp, fs, net)
             ]
             if pgpu and TOTAL_GPU_RAM != 0:
                 line.extend([
                     f'{curr_gpu_util:.2f}',
                     f'{curr_gpu_mem / TOTAL_GPU_RAM * 100.0:.2f}'
                 ])
-            self.logger.info(" ".join(["sar"]+[str(i) for i in line]))
+            self.log_sample("sar", now, line)
+            self.log_disk_io(now, timestamp)
+
+            # The first row is the "all" one, then there is a row for every core
+            if self.cpu_detail:
+                breakdown = [stof(cpu_data[key][0]) for key in ["%user", "%nice", "%system", "%iowait", "%steal", "%idle"]]
+                cores = [
+                    100 - stof(cpu_data["%idle"][j]) - stof(cpu_data["%iowait"][j])
+                    for j in range(1, len(cpu_data["CPU"]))
+                ]
+                self.log_cpu_detail(now, timestamp, breakdown, cores)
+
+            if self.overhead is not None:
+                self.overhead.record(time.perf_counter() - tick_start)
 
             if self.die:
                 break
 
         list(map(s.cancel, s.queue))
         thread.join()
+        self.wait_jobs()
 
         # This runs if we were stopped by SIGTERM and no plot was made so far
         if not self.dont_plot:
             self.summarize()
-            graph.graph(self.session, self.tmpfs_color, self.other_cache_color)
+            self.flush()
+            graph.graph(self.session, self.tmpfs_color, self.other_cache_color, resolution=self.resolution)
 
 class PsUtilWatcher(Watcher):
 
+    # Memory usage as psutil gives it on every system, without a breakdown of the cache
+    def get_meminfo(self):
+        global MAX_USED_RAM
+        now = datetime.datetime.now()
+        ram_data = psutil.virtual_memory()
+        used = (ram_data.total - ram_data.free)
+        if used // 1024 > MAX_USED_RAM:
+            MAX_USED_RAM = used // 1024
+        line = [
+            now.strftime("%Y-%m-%d-%H:%M:%S.%f"),
+            100 * ram_data.free / ram_data.total,
+            0,
+            100 * used / ram_data.total,
+            0
+        ]
+        self.log_sample("psu", now, line)
+
     def initialize(self, _ = None):
         global TOTAL_RAM
         global TOTAL_GPU_RAM
 
         TOTAL_RAM = int(psutil.virtual_memory().total / 1024)
 
+        # Time of the previous readout of the network counters
+        self.last_clock = None
+
         cpus = psutil.cpu_count(logical=True)
 
         cpu_name = platform.processor() or "unknown"
@@ -539,29 +1760,41 @@ class PsUtilWatcher(Watcher):
             f"pid: {os.getpid()}",
             f"machine: {platform.system()}",
             f"cpu count: {cpus}",
-            f"cpu: {cpu_name}"
+            f"cpu: {cpu_name}",
+            f"interval: {self.interval} s",
+            f"memory interval: {self.mem_interval} s"
         ]
-        self.logger.info(", ".join(header))
+        self.log_comment(", ".join(header))
+
+    # Return the mount point of every filesystem by device
+    def find_filesystems(self):
+        # apfs implements lvm, so it's a better option for visualizing the place in the container (which is shared by all partitions).
+        if is_darwin():
+            return {"apfs container": "/"}
+        mounts = {}
+        for p in psutil.disk_partitions(all=False):
+            mounts.setdefault(p.device, p.mountpoint)
+        return mounts
+
+    # Return received and sent bytes of every network interface, of all of
+    # them together if none were chosen
+    def read_net(self):
+        if not self.iface:
+            stats = psutil.net_io_counters()
+            return {"all": (stats.bytes_recv, stats.bytes_sent)}
+        return {
+            iface: (stats.bytes_recv, stats.bytes_sent)
+            for iface, stats in psutil.net_io_counters(pernic=True).items()
+        }
 
     # sar is not available on macOS. This function creates the sar behavior, but use psutil instead. 
-    def psutil_sar_simulation(self, scheduler: sched.scheduler):
+    def psutil_sar_simulation(self):
         global START_DATE
         global TOTAL_LOAD
         global SAMPLE_NUMBER
         global TOTAL_RAM
-        global START_RX
-        global START_TX
-        global END_TX
-        global END_RX
-        global MAX_RX
-        global MAX_TX
-        global IFACE_NAME
-        global TOTAL_FS
-        global MAX_USED_FS
-        global FS_NAME
         global END_DATE
 
-        scheduler.enter(1, 1, self.psutil_sar_simulation, (scheduler,))
         now = datetime.datetime.now()
         date = now.strftime("%Y-%m-%d")
         daytime = now.strftime("%H:%M:%S")
@@ -572,75 +1805,284 @@ class PsUtilWatcher(Watcher):
         SAMPLE_NUMBER += 1
         if TOTAL_RAM == 0:
             TOTAL_RAM = psutil.virtual_memory().total // 1024
-        IFACE_NAME = "all"
-        net_stats = psutil.net_io_counters()
-        if START_RX <= 0 or START_TX <= 0:
-                START_RX, START_TX = net_stats.bytes_recv, net_stats.bytes_sent
-                END_RX, END_TX = net_stats.bytes_recv, net_stats.bytes_sent
-        curr_rx, curr_tx = (net_stats.bytes_recv - END_RX) / (1024 * 8), (net_stats.bytes_sent - END_TX) / (1024 * 8)
-        END_RX, END_TX = net_stats.bytes_recv, net_stats.bytes_sent
-        if MAX_RX < curr_rx:
-            MAX_RX = curr_rx
-        if MAX_TX < curr_tx:
-            MAX_TX = curr_tx
-        # apfs implements lvm, so it's a better option for visualizing the place in the container (which is shared by all partitions).
-        if is_darwin():
-            FS_NAME = "apfs container"
-            disk_stats = psutil.disk_usage('/')
-        else: 
-            largest_partition = max(
-                psutil.disk_partitions(all=False),
-                key=lambda p: psutil.disk_usage(p.mountpoint).total
+
+        clock = time.monotonic()
+        counters = self.read_net()
+        # Rates are computed over the time that actually passed, which is
+        # longer than the interval after missed samples
+        elapsed = max(clock - (self.last_clock or clock), 1e-9)
+        self.last_clock = clock
+        if not self.filesystems:
+            self.mounts = self.find_filesystems()
+            sizes = {device: psutil.disk_usage(mountpoint).total for device, mountpoint in self.mounts.items()}
+            self.observe(
+                choose_devices(self.fsdev, sizes),
+                choose_devices(self.iface, {iface: rx for iface, (rx, _) in counters.items()}, ["lo"])
             )
-            disk_stats = psutil.disk_usage(largest_partition.mountpoint)
-            FS_NAME = largest_partition.device
-            
-        curr_used = (disk_stats.total - disk_stats.free) / (1024 * 1024)
-        if TOTAL_FS == 0:
-            TOTAL_FS = disk_stats.total / (1024 * 1024)
-        if MAX_USED_FS < curr_used:
-            MAX_USED_FS = curr_used
+
+        net = {}
+        for iface, stats in self.interfaces.items():
+            if iface in counters:
+                rx, tx = counters[iface]
+                last_rx, last_tx = stats.end or (rx, tx)
+                net[iface] = ((rx - last_rx) / 1024 / elapsed, (tx - last_tx) / 1024 / elapsed, rx, tx)
+
+        fs = {}
+        for device in self.filesystems:
+            try:
+                disk_stats = psutil.disk_usage(self.mounts[device])
+                fs[device] = ((disk_stats.total - disk_stats.free) / (1024 * 1024), disk_stats.total / (1024 * 1024))
+            except OSError:
+                pass
+
         END_DATE = date + " " + daytime
-        timestamp = date + "-" + daytime
+        # Keep sub-second samples apart
+        if self.interval < 1:
+            timestamp = date + "-" + now.strftime("%H:%M:%S.%f")
+        else:
+            timestamp = date + "-" + daytime
 
         line = [
             timestamp,
             cpu_used,
-            ((disk_stats.total - disk_stats.free) / disk_stats.total) * 100,
-            curr_rx / 128,
-            curr_tx / 128,
+            *self.log_devices(now, timestamp, fs, net)
         ]
 
-        self.logger.info(" ".join(["sar"]+[str(i) for i in line]))
+        self.log_sample("sar", now, line)
+        self.log_disk_io(now, timestamp)
+
+        if self.cpu_detail:
+            t = psutil.cpu_times_percent()
+            breakdown = [
+                t.user,
+                getattr(t, "nice", 0),
+                t.system + getattr(t, "irq", 0) + getattr(t, "softirq", 0),
+                getattr(t, "iowait", 0),
+                getattr(t, "steal", 0),
+                t.idle
+            ]
+            self.log_cpu_detail(now, timestamp, breakdown, psutil.cpu_percent(percpu=True))
 
     def watch(self):
-        # Was a graph already produced by save command from sargraph?
-        dont_plot = False
-
         self.initialize(None)
-        s = sched.scheduler(time.time, time.sleep)
-        sar_ev = s.enter(0, 1, self.psutil_sar_simulation, (s,))
-        mem_ev = s.enter(0, 1, self.get_meminfo, (s,))
+        s = self.schedule(
+            (self.interval, self.psutil_sar_simulation),
+            (self.mem_interval, self.get_meminfo)
+        )
         thread = Thread(target = s.run)
         thread.start()
 
-        socket_fd = self.sock.fileno()
-
         while 1:
-            # Await sar output or a command sent from command handler in sargraph.py
-            readlist = [socket_fd]
-            rlist, _, _ = select.select(readlist, [], [], 0.25)
+            # Await a command sent from command handler in sargraph.py
+            rlist, _, _ = select.select([self.sock, *self.clients], [], [], 0.25)
+            self.poll_jobs()
+
+            if self.handle_clients(rlist, s):
+                break
+
+            if self.die:
+                break
+
+        list(map(s.cancel, s.queue))
+        thread.join()
+        self.wait_jobs()
+
+        # This runs if we were stopped by SIGTERM and no plot was made so far
+        if not self.dont_plot:
+            self.summarize()
+            self.flush()
+            graph.graph(self.session, self.tmpfs_color, self.other_cache_color, resolution=self.resolution)
+
+
+# Reads the kernel statistics directly from /proc, without running sar. The
+# files are opened once and read again from the start on every sample.
+class ProcWatcher(Watcher):
+
+    def initialize(self, _ = None):
+        global TOTAL_RAM
+
+        self.proc_stat = os.open("/proc/stat", os.O_RDONLY)
+        self.proc_net = os.open("/proc/net/dev", os.O_RDONLY)
+        self.meminfo = MemInfo()
+
+        # Previous readouts of the counters, rates are computed from their deltas
+        self.last_sample = None
+
+        # Every core gets a column by its number, also while it is offline
+        if self.cpu_detail:
+            online = [int(name[3:]) + 1 for name in self.read_cpu() if name != b"cpu"]
+            self.cores = [b"cpu%d" % i for i in range(max([os.cpu_count() or 0] + online))]
 
-            if socket_fd in rlist:
-                data = self.recv_data()
-                now = datetime.datetime.now()
-                if self.handle_command(data, s, now):
+        TOTAL_RAM = self.meminfo.read()[0]
+
+        self.mounts = self.find_filesystems()
+        sizes = {}
+        for device, mountpoint in self.mounts.items():
+            st = os.statvfs(mountpoint)
+            sizes[device] = st.f_blocks * st.f_frsize
+        self.fs_names = choose_devices(self.fsdev, sizes, ["/dev/shm"])
+
+        # Interfaces can be chosen by traffic only once there are two readouts
+        available = self.read_net()
+        for iface in self.iface:
+            if iface not in available and iface != "all":
+                raise ValueError(f"Network interface '{iface}' does not exist")
+
+        uname = os.uname()
+
+        cpu_name = "unknown"
+
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if "model name" in line:
+                    cpu_name = line.replace("\n", "").split(": ")[1]
                     break
+        header = [
+            f"# sargraph version: {SARGRAPH_VERSION}",
+            f"pid: {os.getpid()}",
+            f"machine: {uname.sysname} {uname.release}",
+            f"cpu count: {os.cpu_count()}",
+            f"cpu: {cpu_name}",
+            f"interval: {self.interval} s",
+            f"memory interval: {self.mem_interval} s"
+        ]
+        self.log_comment(", ".join(header))
+
+    # Return the mount point of every mounted block device
+    def find_filesystems(self):
+        mounts = {}
+        with open("/proc/self/mounts") as f:
+            for line in f:
+                device, mountpoint = line.split()[:2]
+                if device.startswith("/dev/") and device not in mounts:
+                    mounts[device] = mountpoint.replace("\\040", " ")
+        return mounts
+
+    # Return the time counters of the "cpu" line of /proc/stat and, in the
+    # detailed mode, of every "cpuN" line, by name
+    def read_cpu(self):
+        if not self.cpu_detail:
+            line = os.pread(self.proc_stat, 4096, 0).split(b"\n", 1)[0].split()
+            return {line[0]: [int(v) for v in line[1:]]}
+
+        times = {}
+        for line in os.pread(self.proc_stat, 1 << 16, 0).split(b"\n"):
+            if not line.startswith(b"cpu"):
+                break
+            line = line.split()
+            times[line[0]] = [int(v) for v in line[1:]]
+        return times
+
+    # Return received and sent bytes of every network interface
+    def read_net(self):
+        stats = {}
+        for line in os.pread(self.proc_net, 1 << 16, 0).decode().splitlines()[2:]:
+            iface, _, data = line.partition(":")
+            data = data.split()
+            stats[iface.strip()] = (int(data[0]), int(data[8]))
+        return stats
+
+    def proc_sar_simulation(self):
+        global START_DATE
+        global TOTAL_LOAD
+        global SAMPLE_NUMBER
+        global END_DATE
+
+        now = datetime.datetime.now()
+        clock = time.monotonic()
+        cpu = self.read_cpu()
+        net = self.read_net()
+
+        # Rates need two readouts, the first one is only remembered
+        last = self.last_sample
+        self.last_sample = (clock, cpu, net)
+        if last is None:
+            return
+        last_clock, last_cpu, last_net = last
+        elapsed = clock - last_clock
+
+        date = now.strftime("%Y-%m-%d")
+        daytime = now.strftime("%H:%M:%S")
+        if START_DATE == "":
+            START_DATE = date + " " + daytime
+        # Keep sub-second samples apart
+        if self.interval < 1:
+            timestamp = date + "-" + now.strftime("%H:%M:%S.%f")
+        else:
+            timestamp = date + "-" + daytime
+        breakdown = cpu_breakdown(last_cpu[b"cpu"], cpu[b"cpu"])
+        cpu_used = breakdown[0]
+        TOTAL_LOAD += cpu_used
+        SAMPLE_NUMBER += 1
+
+        # Observe the chosen interfaces or the one that received the most, like sar
+        if not self.interfaces:
+            received = {iface: rx - last_net.get(iface, (rx, 0))[0] for iface, (rx, _) in net.items()}
+            self.observe(self.fs_names, choose_devices(self.iface, received, ["lo"]))
+
+        rates = {}
+        for iface in self.interfaces:
+            if iface in net and iface in last_net:
+                (rx, tx), (last_rx, last_tx) = net[iface], last_net[iface]
+                rates[iface] = ((rx - last_rx) / 1024 / elapsed, (tx - last_tx) / 1024 / elapsed, rx, tx)
+
+        # Same definitions as in sar: used blocks include the reserved ones
+        fs = {}
+        for device in self.filesystems:
+            try:
+                st = os.statvfs(self.mounts[device])
+                fs[device] = ((st.f_blocks - st.f_bfree) * st.f_frsize / (1024 * 1024), st.f_blocks * st.f_frsize / (1024 * 1024))
+            except OSError:
+                pass
+        END_DATE = date + " " + daytime
+
+        line = [
+            timestamp,
+            f"{cpu_used:.2f}",
+            *self.log_devices(now, timestamp, fs, rates)
+        ]
+        self.log_sample("sar", now, line)
+        self.log_disk_io(now, timestamp)
+
+        # Cores that are offline or went offline in the meantime have no load
+        if self.cpu_detail:
+            cores = []
+            for name in self.cores:
+                if name in cpu and name in last_cpu:
+                    _, _, _, iowait, _, idle = cpu_breakdown(last_cpu[name], cpu[name])
+                    cores.append(100 - idle - iowait)
+                else:
+                    cores.append(float("nan"))
+            self.log_cpu_detail(now, timestamp, breakdown, cores)
+
+    def watch(self):
+        self.initialize(None)
+        s = self.schedule(
+            (self.interval, self.proc_sar_simulation),
+            (self.mem_interval, self.get_meminfo)
+        )
+        thread = Thread(target = s.run)
+        thread.start()
+
+        while 1:
+            # Await a command sent from command handler in sargraph.py
+            rlist, _, _ = select.select([self.sock, *self.clients], [], [], 0.25)
+            self.poll_jobs()
+
+            if self.handle_clients(rlist, s):
+                break
+
+            if self.die:
+                break
 
         list(map(s.cancel, s.queue))
         thread.join()
+        self.wait_jobs()
+        for fd in (self.proc_stat, self.proc_net):
+            os.close(fd)
 
         # This runs if we were stopped by SIGTERM and no plot was made so far
-        if not dont_plot:
+        if not self.dont_plot:
             self.summarize()
-            graph.graph(self.session, self.tmpfs_color, self.other_cache_color)
\ No newline at end of file
+            self.flush()
+            graph.graph(self.session, self.tmpfs_color, self.other_cache_color, resolution=self.resolution)